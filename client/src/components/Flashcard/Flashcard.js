@@ -205,7 +205,7 @@ const Flashcard = ({ flashcard, provided, handleGenerate }) => {
             <img
               src={`/getFlashcardImage/${
                 flashcard.id
-              }?v=${new Date().getTime()}`} // Force a fresh request rather than use the cached image.
+              }?size=card&v=${new Date().getTime()}`} // Force a fresh request rather than use the cached image.
               alt={`Visual aid for '${ariaTerm}' flashcard`}
               onError={() => {
                 setImageError(true);
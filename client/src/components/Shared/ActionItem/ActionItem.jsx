@@ -6,7 +6,6 @@ import { useOpenDeck } from '../../../contexts/DeckContext';
 import useNote from '../../../hooks/useNote';
 import useFlashcard from '../../../hooks/useFlashcard';
 import useTodo from '../../../hooks/useTodo';
-import useAI from '../../../hooks/useAI';
 import { ReactComponent as BackIcon } from '../../../assets/icons/arrow.svg';
 import { ReactComponent as NewIcon } from '../../../assets/icons/new.svg';
 import { ReactComponent as ExpandIcon } from '../../../assets/icons/expand.svg';
@@ -71,16 +70,20 @@ const ActionItem = ({
   const { setOpenDeckId } = useOpenDeck();
 
   // Custom Hooks (handling notes, flashcards, todos)
-  const { handleCreateNote, handleUpdateNote, handleDeleteNote } = useNote();
+  const {
+    handleCreateNote,
+    handleUpdateNote,
+    handlePatchNote,
+    handleDeleteNote,
+  } = useNote();
   const {
     handleCreateFlashcardDeck,
     handleUpdateFlashcardDeck,
     handleDeleteFlashcardDeck,
     handleCreateFlashcard,
-    handleUpdateFlashcard,
+    handleGenerateFlashcards,
   } = useFlashcard();
   const { handleCreateTodo } = useTodo();
-  const { askAI } = useAI();
 
   // Derived data
   const actionItems = { notes, flashcard_decks, todos }; // quizzes
@@ -244,7 +247,11 @@ const ActionItem = ({
 
     const initializeEditor = async () => {
       if (editorContainerRef.current) {
-        await initEditor(handleUpdateNote, note, action === 'generate');
+        await initEditor(
+          handlePatchNote,
+          note,
+          action === 'generate'
+        );
         setEditorState((prevState) => ({ ...prevState, initialized: true }));
       }
     };
@@ -309,8 +316,9 @@ const ActionItem = ({
           });
           targetElement.dispatchEvent(spaceEvent);
         } else if (action === 'multigen') {
-          // Handle multiple flashcard generation from file content into currently open deck
-          handleMultigenFlashcards(openSubItem.id, fileId, flashcards.length);
+          // Handle multiple flashcard generation from file content into currently open deck, with new cards
+          // rather than the ones already generated from the file
+          handleMultigenFlashcards(openSubItem.id, fileId, true);
         }
       } else {
         // Deck level actions (if no sub-item is open)
@@ -327,8 +335,7 @@ const ActionItem = ({
           if (action === 'multigen') {
             deck['flashcards'] = await handleMultigenFlashcards(
               deck.id,
-              fileId,
-              0
+              fileId
             );
           }
           // Set the new deck as the open sub-item and make sure it opens in edit mode
@@ -352,26 +359,9 @@ const ActionItem = ({
     }
   };
 
-  const handleMultigenFlashcards = async (deckId, fileId, currentCount) => {
-    const response = await askAI('Flashcards', 'multigen', fileId);
-    const flashcardRegex = /F:\s(.*?)\nB:\s(.*?)(?=\nF:|\n$)/gs;
-    let match;
-    let order = currentCount + 1;
-
-    // Create and update flashcards concurrently
-    const flashcardPromises = [];
-    while ((match = flashcardRegex.exec(response)) !== null) {
-      const front = match[1].trim();
-      const back = match[2].trim();
-      const flashcardPromise = handleCreateFlashcard(deckId, order).then(
-        (flashcard) =>
-          handleUpdateFlashcard(flashcard.id, { term: front, definition: back })
-      );
-      flashcardPromises.push(flashcardPromise);
-      order += 1;
-    }
-
-    const flashcards = await Promise.all(flashcardPromises);
+  const handleMultigenFlashcards = async (deckId, fileId, regenerate = false) => {
+    // Cards are parsed and added to the deck on the server, in one request
+    const flashcards = await handleGenerateFlashcards(deckId, fileId, regenerate);
     setScrollToListItem('noFocus');
 
     return flashcards;
@@ -14,7 +14,10 @@ import { ReactComponent as FileIllustration } from '../../../assets/icons/file.s
  * @returns {JSX.Element} The rendered file component.
  */
 const File = () => {
-  const { id, name, type } = useFileContext();
+  const { id, name, type, version } = useFileContext();
+
+  // Versioned with the content hash so the browser can cache the file for good
+  const fileUrl = version ? `/files/${id}?v=${version}` : `/files/${id}`;
   const fileType = type.split('/')[0];
   const [openEditMenu, setOpenEditMenu] = useState(false);
   const [menuPos, setMenuPos] = useState('no-position');
@@ -153,10 +156,10 @@ const File = () => {
       <div className="file__thumbnail">
         {/* Render file preview based on its type */}
         {fileType === 'image' ? (
-          <img src={`/files/${id}`} alt={`Preview of ${name}`} />
+          <img src={fileUrl} alt={`Preview of ${name}`} />
         ) : fileType === 'video' ? (
           <video>
-            <source src={`/files/${id}`} type={type} />
+            <source src={fileUrl} type={type} />
           </video>
         ) : (
           <FileIllustration />
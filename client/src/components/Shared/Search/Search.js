@@ -50,7 +50,9 @@ const Search = () => {
   useEffect(() => {
     const fetchSuggestions = async () => {
       try {
-        const response = await fetch(`/api/search?query=${searchTerm}`);
+        const response = await fetch(
+          `/api/search?query=${searchTerm}&mode=autocomplete`
+        );
         const data = await response.json();
         setSuggestions(data.items);
       } catch (error) {
@@ -25,6 +25,7 @@ import Undo from 'editorjs-undo';
 import AlignmentTuneTool from 'editorjs-text-alignment-blocktune';
 import IndentTune from 'editorjs-indent-tune';
 import { debounce } from 'lodash';
+import { diffNoteContent, rebaseNoteContent } from '../utils/patchUtils';
 
 const EditorContext = createContext();
 
@@ -46,11 +47,51 @@ export const EditorProvider = ({ children }) => {
   const [paddingBottom, setPaddingBottom] = useState(300);
   const [numBlocks, setNumBlocks] = useState(1);
 
-  const initEditor = (updateNote, note, autofocus = false) => {
-    const debouncedUpdateNote = debounce(
-      (id, element, value) => updateNote(id, { [element]: value }),
-      200
-    );
+  const initEditor = (patchNote, note, autofocus = false) => {
+    // Content and version the server has, edits are sent as patches against them
+    const saved = { content: note.content, version: note.version };
+    let saving = Promise.resolve();
+
+    const saveContent = async (content) => {
+      const patch = diffNoteContent(saved.content, content);
+      if (!patch.length) return;
+
+      const result = await patchNote(note.id, patch, saved.version, content);
+      if (result?.note) {
+        saved.content = content;
+        saved.version = result.note.version;
+      } else if (result?.conflict) {
+        await resolveConflict(result.conflict);
+      }
+      // Other failures leave the edit unsaved, it is sent again with the next one
+    };
+
+    // The note was edited elsewhere since the saved version: replay the edits made here on its current
+    // content, or let the user choose between the two versions when they change the same blocks
+    const resolveConflict = async (current) => {
+      const local = await editor.save();
+      const merged = rebaseNoteContent(saved.content, local, current.content);
+      saved.content = current.content;
+      saved.version = current.version;
+
+      if (merged) {
+        await editor.render(merged);
+        await saveContent(merged);
+      } else if (
+        window.confirm(
+          'This note was changed elsewhere in the same places as here. Keep your version? Cancel loads the other one.'
+        )
+      ) {
+        await saveContent(local);
+      } else {
+        await editor.render(current.content);
+      }
+    };
+
+    // Saves run one after the other, so each patch is made against the version the previous one created
+    const debouncedSaveContent = debounce((content) => {
+      saving = saving.then(() => saveContent(content));
+    }, 200);
 
     const editor = new EditorJS({
       holder: 'editorjs',
@@ -301,7 +342,7 @@ export const EditorProvider = ({ children }) => {
 
         // Save content updates to note
         const updatedData = await editor.save();
-        debouncedUpdateNote(note.id, 'content', updatedData);
+        debouncedSaveContent(updatedData);
       },
 
       data: note.content,
@@ -10,6 +10,7 @@ export const FileProvider = ({ children, file }) => {
     id,
     name,
     type,
+    version,
     created_at,
     subject,
     project,
@@ -24,6 +25,7 @@ export const FileProvider = ({ children, file }) => {
         id,
         name,
         type,
+        version,
         created_at,
         subject,
         project,
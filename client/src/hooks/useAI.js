@@ -37,7 +37,11 @@ const useAI = () => {
           return await sendRequest(context, keyword, { flashcardId: id });
 
         default: // custom keyword handling
-          return await sendRequest(context, 'custom', { prompt: keyword });
+          // The file lets the server add the parts of it related to the prompt
+          return await sendRequest(context, 'custom', {
+            ...requestBody,
+            prompt: keyword,
+          });
       }
     } catch (error) {
       console.error('Error:', error);
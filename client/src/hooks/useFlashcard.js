@@ -7,7 +7,9 @@ import { useDataContext } from '../contexts/DataContext';
  *
  * @returns {{
  *   handleCreateFlashcard: Function,
+ *   handleGenerateFlashcards: Function,
  *   handleUpdateFlashcard: Function,
+ *   handleMoveFlashcard: Function,
  *   handleUploadFlashcardImage: Function,
  *   handleDeleteFlashcardImage: Function,
  *   handleDeleteFlashcard: Function,
@@ -128,6 +130,35 @@ const useFlashcard = () => {
     }
   };
 
+  /**
+   * Generates flashcards from a file's content and adds them at the end of a deck on the server.
+   *
+   * @async
+   * @param {number} deckId - The ID of the flashcard deck the flashcards are added to.
+   * @param {number} fileId - The ID of the file the flashcards are generated from.
+   * @param {boolean} [regenerate] - Whether to ask for new flashcards rather than the ones generated from the file before.
+   * @returns {Promise<Array<Object>>} The created flashcard objects, empty if failed.
+   */
+  const handleGenerateFlashcards = async (deckId, fileId, regenerate = false) => {
+    console.log('Generating flashcards');
+    try {
+      const response = await axios.post(`/generateFlashcards/${deckId}`, {
+        fileId,
+        regenerate,
+      });
+      fetchData();
+      console.log(response.data.message);
+      return response.data.flashcards;
+    } catch (error) {
+      if (error.response) {
+        console.error(error.response.data.error);
+      } else {
+        console.error('Error generating flashcards:', error.message);
+      }
+      return [];
+    }
+  };
+
   /**
    * Updates an existing flashcard on the server.
    *
@@ -160,6 +191,32 @@ const useFlashcard = () => {
     }
   };
 
+  /**
+   * Moves a flashcard to a new position in its deck.
+   *
+   * @async
+   * @param {number} flashcardId - The ID of the flashcard to move.
+   * @param {number} order - The new 1-based position of the flashcard.
+   * @returns {Promise<void>}
+   */
+  const handleMoveFlashcard = async (flashcardId, order) => {
+    console.log('Moving flashcard');
+
+    try {
+      const response = await axios.post(
+        `/moveFlashcard/${flashcardId}/${order}`
+      );
+      fetchData();
+      console.log(response.data.message);
+    } catch (error) {
+      if (error.response?.status === 400) {
+        console.error(error.response.data.error);
+      } else {
+        console.error('Error moving flashcard:', error.message);
+      }
+    }
+  };
+
   /**
    * Uploads an image for a specific flashcard.
    *
@@ -241,7 +298,9 @@ const useFlashcard = () => {
     handleUpdateFlashcardDeck,
     handleDeleteFlashcardDeck,
     handleCreateFlashcard,
+    handleGenerateFlashcards,
     handleUpdateFlashcard,
+    handleMoveFlashcard,
     handleUploadFlashcardImage,
     handleDeleteFlashcardImage,
     handleDeleteFlashcard,
@@ -7,11 +7,12 @@ import { useDataContext } from '../contexts/DataContext';
  * @returns {{
  *   handleCreateNote: Function,
  *   handleUpdateNote: Function,
+ *   handlePatchNote: Function,
  *   handleDeleteNote: Function,
  * }}
  */
 const useNote = () => {
-  const { fetchData } = useDataContext();
+  const { fetchData, setData } = useDataContext();
 
   /**
    * Creates a new note on the server.
@@ -64,6 +65,47 @@ const useNote = () => {
     }
   };
 
+  /**
+   * Applies JSON Patch operations to the content of a note, made against a version of it.
+   *
+   * The note is updated in the data context from the patched content, without fetching all the data again.
+   *
+   * @async
+   * @param {number} noteId - The ID of the note to patch.
+   * @param {Object[]} patch - The JSON Patch operations to apply.
+   * @param {number} baseVersion - The version of the note the operations were made against.
+   * @param {Object} content - The content of the note once patched.
+   * @returns {Promise<Object|undefined>} { note } with the new version of the note, { conflict } with the
+   *   current content and version of a note edited meanwhile, or undefined if the patch failed otherwise.
+   */
+  const handlePatchNote = async (noteId, patch, baseVersion, content) => {
+    console.log('Patching note');
+    try {
+      const response = await axios.post(`/updateNote/${noteId}`, {
+        patch,
+        baseVersion,
+      });
+      const { version } = response.data.note;
+      setData((prevData) => ({
+        ...prevData,
+        notes: prevData.notes.map((note) =>
+          note.id === noteId ? { ...note, content, version } : note
+        ),
+      }));
+      console.log(response.data.message);
+      return { note: response.data.note };
+    } catch (error) {
+      if (error.response && error.response.status === 409) {
+        const { content: currentContent, version } = error.response.data;
+        return { conflict: { content: currentContent, version } };
+      } else if (error.response && error.response.status === 400) {
+        console.error(error.response.data.error);
+      } else {
+        console.error('Error patching note:', error.message);
+      }
+    }
+  };
+
   /**
    * Deletes a note from the server.
    *
@@ -89,6 +131,7 @@ const useNote = () => {
   return {
     handleCreateNote,
     handleUpdateNote,
+    handlePatchNote,
     handleDeleteNote,
   };
 };
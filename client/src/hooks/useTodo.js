@@ -8,6 +8,7 @@ import { useDataContext } from '../contexts/DataContext';
  * @returns {{
  *   handleCreateTodo: Function,
  *   handleUpdateTodo: Function,
+ *   handleMoveTodo: Function,
  *   handleDeleteTodo: Function,
  * }}
  */
@@ -64,6 +65,30 @@ const useTodo = () => {
     }
   };
 
+  /**
+   * Move a todo to a new position in its file's list.
+   *
+   * @async
+   * @param {number} todoId - The ID of the todo to move.
+   * @param {number} order - The new 1-based position of the todo.
+   * @returns {Promise<void>} Resolves when the move is complete.
+   */
+  const handleMoveTodo = async (todoId, order) => {
+    console.log('Moving todo');
+
+    try {
+      const response = await axios.post(`/moveTodo/${todoId}/${order}`);
+      fetchData();
+      console.log(response.data.message);
+    } catch (error) {
+      if (error.response?.status === 400) {
+        console.error(error.response.data.error);
+      } else {
+        console.error('Error moving todo:', error.message);
+      }
+    }
+  };
+
   /**
    * Delete a todo from the server.
    *
@@ -90,6 +115,7 @@ const useTodo = () => {
   return {
     handleCreateTodo,
     handleUpdateTodo,
+    handleMoveTodo,
     handleDeleteTodo,
   };
 };
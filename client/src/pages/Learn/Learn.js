@@ -36,8 +36,8 @@ const Learn = () => {
       if (a.done !== b.done) return a.done - b.done; // compare by done property
       return a.order - b.order; // if done is the same compare by order
     }) || [];
-  const { handleUpdateFlashcard } = useFlashcard();
-  const { handleUpdateTodo } = useTodo();
+  const { handleMoveFlashcard } = useFlashcard();
+  const { handleMoveTodo } = useTodo();
   const [isEnlarged, setIsEnlarged] = useState({
     notes: false,
     todos: false,
@@ -98,13 +98,17 @@ const Learn = () => {
 
   /**
    * Handles drag-and-drop reordering of items.
+   * Only the dragged item is moved, in front of the item it was dropped before,
+   * so the position sent counts all items in their stored order even when they
+   * are displayed differently (done todos last).
    *
    * @param {Array} items - The items to reorder.
-   * @param {function(number, object): Promise<void>} handleUpdateItem - Function to update the order of an item.
+   * @param {function(number, number): Promise<void>} handleMoveItem - Function to move an item to a position.
    * @returns {Function} A function to be used as the `onDragEnd` handler for drag-and-drop.
    */
-  const onDragEnd = (items, handleUpdateItem) => (result) => {
+  const onDragEnd = (items, handleMoveItem) => (result) => {
     if (!result.destination) return;
+    if (result.destination.index === result.source.index) return;
 
     const reorderedItems = reorder(
       items,
@@ -112,9 +116,13 @@ const Learn = () => {
       result.destination.index
     );
 
-    reorderedItems.forEach((item, index) => {
-      handleUpdateItem(item.id, { order: index + 1 });
-    });
+    const moved = items[result.source.index];
+    const next = reorderedItems[result.destination.index + 1];
+    const order = next
+      ? next.order - (moved.order < next.order ? 1 : 0)
+      : items.length;
+
+    handleMoveItem(moved.id, order);
   };
 
   return (
@@ -131,7 +139,9 @@ const Learn = () => {
             aria-labelledby="file-name"
           >
             <div id="file-name">{file?.name}</div>
-            <DocViewer uri={`/files/${id}`} />
+            <DocViewer
+              uri={file?.version ? `/files/${id}?v=${file.version}` : `/files/${id}`}
+            />
           </div>
           {/* Action Items for Notes, Flashcards, Todos, Quizzes */}
           <div
@@ -150,7 +160,7 @@ const Learn = () => {
             </ActionItem>
             {/* Flashcards Section with Drag-and-Drop */}
             <DragDropContext
-              onDragEnd={onDragEnd(openDeckFlashcards, handleUpdateFlashcard)}
+              onDragEnd={onDragEnd(openDeckFlashcards, handleMoveFlashcard)}
             >
               <Droppable droppableId="flashcards">
                 {(provided) => (
@@ -193,7 +203,7 @@ const Learn = () => {
               </Droppable>
             </DragDropContext>
             {/* Todos Section with Drag-and-Drop */}
-            <DragDropContext onDragEnd={onDragEnd(todos, handleUpdateTodo)}>
+            <DragDropContext onDragEnd={onDragEnd(todos, handleMoveTodo)}>
               <Droppable droppableId="todos">
                 {(provided) => (
                   <ActionItem
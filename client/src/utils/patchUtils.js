@@ -0,0 +1,144 @@
+const escapePointer = (key) => key.replace(/~/g, '~0').replace(/\//g, '~1');
+
+const isSame = (a, b) => JSON.stringify(a) === JSON.stringify(b);
+
+/**
+ * Finds the blocks that differ between two lists of blocks.
+ *
+ * @param {Object[]} before - The blocks before the change.
+ * @param {Object[]} after - The blocks after the change.
+ * @returns {{ start: number, end: number }} The number of unchanged blocks at the start and at the end.
+ */
+const changedBlocks = (before, after) => {
+  let start = 0;
+  while (
+    start < before.length &&
+    start < after.length &&
+    isSame(before[start], after[start])
+  ) {
+    start++;
+  }
+
+  let end = 0;
+  while (
+    end < before.length - start &&
+    end < after.length - start &&
+    isSame(before[before.length - 1 - end], after[after.length - 1 - end])
+  ) {
+    end++;
+  }
+
+  return { start, end };
+};
+
+/**
+ * Computes the JSON Patch (RFC 6902) operations turning a note's Editor.js content into another.
+ *
+ * Blocks are compared whole: the unchanged blocks at the start and the end are skipped and the ones in
+ * between are replaced, added or removed, so typing in a block only sends that block.
+ *
+ * @param {Object} previous - The content the server has, e.g. { time, blocks, version }.
+ * @param {Object} next - The content saved by the editor.
+ * @returns {Object[]} The operations, empty if nothing changed.
+ */
+export const diffNoteContent = (previous, next) => {
+  previous = previous || {};
+  next = next || {};
+  const operations = [];
+
+  // Fields other than blocks (time, version) are small and replaced as a whole
+  Object.keys(previous).forEach((key) => {
+    if (!(key in next)) {
+      operations.push({ op: 'remove', path: `/${escapePointer(key)}` });
+    }
+  });
+  Object.keys(next).forEach((key) => {
+    if (key === 'blocks' && Array.isArray(previous.blocks)) return;
+    if (!(key in previous) || !isSame(previous[key], next[key])) {
+      operations.push({
+        op: key in previous ? 'replace' : 'add',
+        path: `/${escapePointer(key)}`,
+        value: next[key],
+      });
+    }
+  });
+  if (!Array.isArray(previous.blocks) || !Array.isArray(next.blocks)) {
+    return operations;
+  }
+
+  const before = previous.blocks;
+  const after = next.blocks;
+  const { start, end } = changedBlocks(before, after);
+
+  const removed = before.length - start - end;
+  const added = after.length - start - end;
+  const replaced = Math.min(removed, added);
+
+  for (let i = 0; i < replaced; i++) {
+    operations.push({
+      op: 'replace',
+      path: `/blocks/${start + i}`,
+      value: after[start + i],
+    });
+  }
+  for (let i = replaced; i < added; i++) {
+    operations.push({
+      op: 'add',
+      path: `/blocks/${start + i}`,
+      value: after[start + i],
+    });
+  }
+  // From the last one, so the indexes of the blocks left to remove do not shift
+  for (let i = removed - 1; i >= added; i--) {
+    operations.push({ op: 'remove', path: `/blocks/${start + i}` });
+  }
+
+  return operations;
+};
+
+/**
+ * Replays a local edit of a note on the content another client saved meanwhile.
+ *
+ * Both edits are compared with the content they were made from, block by block: they merge when they
+ * change different blocks, otherwise they conflict.
+ *
+ * @param {Object} base - The content both edits were made from.
+ * @param {Object} local - The content with the local edit.
+ * @param {Object} remote - The content the server has now.
+ * @returns {Object|null} The remote content with the local edit replayed, or null if the edits conflict.
+ */
+export const rebaseNoteContent = (base, local, remote) => {
+  const baseBlocks = base?.blocks || [];
+  const localBlocks = local?.blocks || [];
+  const remoteBlocks = remote?.blocks || [];
+
+  const ours = changedBlocks(baseBlocks, localBlocks);
+  const theirs = changedBlocks(baseBlocks, remoteBlocks);
+  const oursEnd = baseBlocks.length - ours.end;
+  const theirsEnd = baseBlocks.length - theirs.end;
+  const edited = localBlocks.slice(ours.start, localBlocks.length - ours.end);
+
+  let blocks;
+  if (oursEnd <= theirs.start && ours.start < theirs.start) {
+    // Our edit comes before theirs, at the same place in their content
+    blocks = [
+      ...remoteBlocks.slice(0, ours.start),
+      ...edited,
+      ...remoteBlocks.slice(oursEnd),
+    ];
+  } else if (theirsEnd <= ours.start && theirs.start < ours.start) {
+    // Our edit comes after theirs, shifted by the blocks they added or removed
+    const shift = remoteBlocks.length - baseBlocks.length;
+    blocks = [
+      ...remoteBlocks.slice(0, ours.start + shift),
+      ...edited,
+      ...remoteBlocks.slice(oursEnd + shift),
+    ];
+  } else if (isSame(localBlocks, remoteBlocks)) {
+    blocks = remoteBlocks;
+  } else {
+    return null;
+  }
+
+  return { ...remote, ...local, blocks };
+};
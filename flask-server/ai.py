@@ -0,0 +1,666 @@
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from flask import current_app
+from openai import OpenAI, APIConnectionError, APIStatusError, InternalServerError, RateLimitError
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+from models import db, CompletionCache, FilePage
+
+try:
+    import tiktoken
+except ImportError: # token counts are estimated from the text length instead
+    tiktoken = None
+
+
+# Model and completion length used by askAI
+MODEL = "gpt-3.5-turbo"
+MAX_TOKENS = 200
+
+# Cached completions expire after COMPLETION_TTL. Past MAX_CACHED_COMPLETIONS rows, the least recently
+# used ones are evicted, every EVICTION_INTERVAL stores.
+COMPLETION_TTL = timedelta(days=7)
+MAX_CACHED_COMPLETIONS = 10000
+EVICTION_INTERVAL = 100
+
+# Most recently used completions, also kept in memory in front of the database
+MEMORY_CACHE_SIZE = 256
+
+client = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the OpenAI client, created on first use once the environment is loaded."""
+    global client
+    with client_lock:
+        if client is None:
+            client = OpenAI(
+                organization=os.getenv("OPENAI_ORGANIZATION"),
+                project=os.getenv("OPENAI_PROJECT"),
+                api_key=os.getenv("OPENAI_API_KEY"),
+                # Any OpenAI-compatible server, e.g. a local stub in development
+                base_url=os.getenv("OPENAI_BASE_URL"),
+                # Retries are made by create_completion, which also honors Retry-After
+                max_retries=0,
+                timeout=REQUEST_TIMEOUT,
+            )
+        return client
+
+
+# At most MAX_IN_FLIGHT requests to the API at a time, across all server threads, which also bounds the
+# connections the client opens. Callers wait up to QUEUE_TIMEOUT for a slot, then give up rather than
+# holding a server worker for as long as the API is slow.
+MAX_IN_FLIGHT = 8
+QUEUE_TIMEOUT = 10  # seconds
+REQUEST_TIMEOUT = 60  # seconds
+
+# Requests that are rate limited, time out or fail on the server side are retried with exponential
+# backoff and full jitter, waiting at least as long as the API's Retry-After
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 1  # seconds
+BACKOFF_MAX = 20  # seconds, longer Retry-After are not waited for
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# After FAILURE_THRESHOLD consecutive failed requests, requests fail fast for BREAKER_COOLDOWN, then a
+# single trial request decides whether the API is back
+FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 30  # seconds
+
+in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+# Requests retried, rejected for lack of a slot and refused by the open breaker, since the server started
+gateway_counters = Counter()
+
+
+class AIUnavailableError(Exception):
+    """Raised instead of calling the API when it is saturated or failing, with the seconds to wait before retrying."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calls to a failing service for a while, then lets one trial call through to probe it."""
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown or self.trial_running:
+            return "open"
+        return "half-open"
+
+    def before_call(self):
+        """Raise AIUnavailableError if calls are stopped, otherwise let the call through."""
+        with self.lock:
+            state = self.state
+            if state == "open":
+                gateway_counters["breaker_rejected"] += 1
+                remaining = self.cooldown - (time.monotonic() - self.opened_at)
+                raise AIUnavailableError("The AI service is failing, try again later.", max(math.ceil(remaining), 1))
+            if state == "half-open":
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release_trial(self):
+        """Let another call be the trial when the trial call ended without telling whether the service is back."""
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+breaker = CircuitBreaker(FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+
+
+def retry_after(error):
+    """Return the seconds the API asked to wait before retrying, if it did."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    if response.headers.get("retry-after-ms"):
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+def create_completion(**kwargs):
+    """
+    Create a chat completion, with concurrency limits, retries and the circuit breaker.
+
+    Args:
+        **kwargs: Arguments of client.chat.completions.create.
+
+    Returns:
+        The completion, or for stream=True the stream, which holds its in-flight slot until
+        release_slot is called once it is closed.
+
+    Raises:
+        AIUnavailableError: If no slot frees up in time or the circuit breaker is open.
+        openai.APIError: If the request fails, after retries for transient errors.
+    """
+    return call_api(get_client().chat.completions.create, **kwargs)
+
+
+def call_api(create, **kwargs):
+    """
+    Make a request to the API through the gateway, with concurrency limits, retries and the circuit breaker.
+
+    Args:
+        create (callable): The client method making the request, e.g. client.embeddings.create.
+        **kwargs: Arguments of the method.
+
+    Returns:
+        The response, or for stream=True the stream, which holds its in-flight slot until
+        release_slot is called once it is closed.
+
+    Raises:
+        AIUnavailableError: If no slot frees up in time or the circuit breaker is open.
+        openai.APIError: If the request fails, after retries for transient errors.
+    """
+    breaker.before_call()
+    acquire_slot()
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = create(**kwargs)
+            break
+
+        except RETRYABLE_ERRORS as e:
+            in_flight.release()
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            requested_delay = retry_after(e)
+            if requested_delay is not None:
+                delay = max(delay, requested_delay)
+
+            if attempt == MAX_ATTEMPTS - 1 or delay > BACKOFF_MAX:
+                breaker.record_failure()
+                raise
+
+        except APIStatusError:
+            in_flight.release()
+            # Rejected requests still show the API is up
+            breaker.record_success()
+            raise
+
+        except BaseException:
+            in_flight.release()
+            breaker.release_trial()
+            raise
+
+        gateway_counters["retries"] += 1
+        # Waited for without the slot, which other requests can use meanwhile
+        time.sleep(delay)
+        acquire_slot()
+
+    breaker.record_success()
+    if not kwargs.get("stream"):
+        in_flight.release()
+    return response
+
+
+def acquire_slot():
+    """Take an in-flight slot, waiting up to QUEUE_TIMEOUT for one to free up."""
+    if not in_flight.acquire(timeout=QUEUE_TIMEOUT):
+        gateway_counters["rejected"] += 1
+        breaker.release_trial()
+        raise AIUnavailableError("The AI service is busy, try again later.", QUEUE_TIMEOUT)
+
+
+def release_slot():
+    """Release the in-flight slot of a streamed completion."""
+    in_flight.release()
+
+
+def gateway_stats():
+    """Return the gateway counters and the state of the circuit breaker."""
+    return {
+        "in_flight": MAX_IN_FLIGHT - in_flight._value,
+        "retries": gateway_counters["retries"],
+        "rejected": gateway_counters["rejected"],
+        "breaker_rejected": gateway_counters["breaker_rejected"],
+        "breaker": breaker.state,
+    }
+
+
+# key -> (completion, created_at), in least recently used order
+memory_cache = OrderedDict()
+cache_lock = threading.Lock()
+
+# Cache hits by tier and misses, since the server started
+cache_counters = Counter()
+
+
+def utcnow():
+    """Return the current UTC time as a naive datetime, as stored by SQLite."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def completion_key(model, prompt, max_tokens):
+    """Return the cache key of a completion request."""
+    return hashlib.sha256(json.dumps([model, prompt, max_tokens]).encode()).hexdigest()
+
+
+def remember_completion(key, completion, created_at):
+    """Keep a completion in the memory tier, evicting the least recently used ones."""
+    with cache_lock:
+        memory_cache[key] = (completion, created_at)
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > MEMORY_CACHE_SIZE:
+            memory_cache.popitem(last=False)
+
+
+def cached_completion(key):
+    """Return a cached completion that has not expired, or None."""
+    expired_before = utcnow() - COMPLETION_TTL
+
+    with cache_lock:
+        completion, created_at = memory_cache.get(key, (None, None))
+        if completion is not None and created_at > expired_before:
+            memory_cache.move_to_end(key)
+            cache_counters["memory_hits"] += 1
+            return completion
+
+    row = db.session.get(CompletionCache, key)
+    if row is None or row.created_at <= expired_before:
+        with cache_lock:
+            cache_counters["misses"] += 1
+        return None
+
+    # Hits served from memory do not touch used_at, so the database tier only sees the colder reads
+    row.used_at = utcnow()
+    db.session.commit()
+
+    remember_completion(key, row.completion, row.created_at)
+    with cache_lock:
+        cache_counters["database_hits"] += 1
+    return row.completion
+
+
+def store_completion(key, model, completion):
+    """Cache a completion in both tiers."""
+    now = utcnow()
+    # Upserted, the same prompt may be completed by concurrent requests
+    values = {"key": key, "model": model, "completion": completion, "created_at": now, "used_at": now}
+    db.session.execute(
+        insert(CompletionCache)
+        .values(**values)
+        .on_conflict_do_update(index_elements=[CompletionCache.key], set_=values)
+    )
+    db.session.commit()
+    remember_completion(key, completion, now)
+
+    with cache_lock:
+        cache_counters["stores"] += 1
+        evict = cache_counters["stores"] % EVICTION_INTERVAL == 0
+    if evict:
+        evict_completions()
+
+
+def evict_completions():
+    """Delete expired completions and the least recently used ones past MAX_CACHED_COMPLETIONS."""
+    db.session.execute(delete(CompletionCache).where(CompletionCache.created_at <= utcnow() - COMPLETION_TTL))
+
+    kept = select(CompletionCache.key).order_by(CompletionCache.used_at.desc()).limit(MAX_CACHED_COMPLETIONS)
+    db.session.execute(
+        delete(CompletionCache)
+        .where(CompletionCache.key.not_in(kept.scalar_subquery()))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def complete(prompt, max_tokens=MAX_TOKENS, model=MODEL, cache=False):
+    """
+    Ask the model to complete a prompt.
+
+    Args:
+        prompt (str): The user message sent to the model.
+        max_tokens (int): Maximum length of the completion.
+        model (str): The chat model to use.
+        cache (bool): Whether the completion may be served from and stored in the completion cache.
+            Only worth it for prompts that are asked again verbatim.
+
+    Returns:
+        str: The completion.
+
+    Raises:
+        AIUnavailableError: If the API is saturated or failing.
+        openai.APIError: If the request to the API fails.
+    """
+    key = completion_key(model, prompt, max_tokens) if cache else None
+    if cache:
+        completion = cached_completion(key)
+        if completion is not None:
+            return completion
+
+    response = create_completion(
+        model=model,
+        messages=[{
+            "role": "user",
+            "content": prompt,
+        }],
+        max_tokens=max_tokens,
+    )
+    completion = response.choices[0].message.content
+
+    if cache and completion is not None:
+        store_completion(key, model, completion)
+
+    return completion
+
+
+# Number of recent streamed completions whose timings are kept
+STREAM_SAMPLES = 1000
+
+# Seconds from sending the request to the first token, and to the last one, of recent streams
+first_token_times = deque(maxlen=STREAM_SAMPLES)
+stream_durations = deque(maxlen=STREAM_SAMPLES)
+
+# Streams completed, disconnected by the client or failed upstream, since the server started
+stream_counters = Counter()
+stream_lock = threading.Lock()
+
+
+class CompletionStream:
+    """
+    Iterator over the text of a completion as the model generates it.
+
+    Records the time to the first token and the total duration of the stream. Closing it before the
+    end, e.g. when the client disconnects, closes the request to the API so generation stops there too.
+    """
+
+    def __init__(self, stream=None, started=None, key=None, model=None, completion=None):
+        self.stream = stream
+        self.started = started
+        self.key = key
+        self.model = model
+        self.pieces = []
+        self.pending = [completion] if completion is not None else []
+        self.finished = stream is None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pending:
+            return self.pending.pop()
+        if self.finished:
+            raise StopIteration
+
+        while True:
+            try:
+                chunk = next(self.stream)
+            except StopIteration:
+                self.finish()
+                raise
+            except Exception:
+                self.close("failed")
+                raise
+
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                if not self.pieces:
+                    with stream_lock:
+                        first_token_times.append(time.perf_counter() - self.started)
+                self.pieces.append(text)
+                return text
+
+    def finish(self):
+        """Record a stream that ran to the end and cache its completion if allowed."""
+        self.close("completed")
+        with stream_lock:
+            stream_durations.append(time.perf_counter() - self.started)
+
+        if self.key is not None and self.pieces:
+            store_completion(self.key, self.model, "".join(self.pieces))
+
+    def close(self, outcome="disconnected"):
+        """Stop the stream, closing the request to the API if it is still open."""
+        if self.finished:
+            return
+        self.finished = True
+        self.stream.close()
+        release_slot()
+        with stream_lock:
+            stream_counters[outcome] += 1
+
+
+def stream_completion(prompt, max_tokens=MAX_TOKENS, model=MODEL, cache=False):
+    """
+    Ask the model to complete a prompt, streaming the completion as it is generated.
+
+    Args:
+        prompt (str): The user message sent to the model.
+        max_tokens (int): Maximum length of the completion.
+        model (str): The chat model to use.
+        cache (bool): Whether the completion may be served from and stored in the completion cache.
+            Cached completions are sent in one piece, streamed ones are cached once complete.
+
+    Returns:
+        CompletionStream: The text of the completion, piece by piece.
+
+    Raises:
+        AIUnavailableError: If the API is saturated or failing.
+        openai.APIError: If the request to the API fails before the completion starts.
+    """
+    key = completion_key(model, prompt, max_tokens) if cache else None
+    if cache:
+        completion = cached_completion(key)
+        if completion is not None:
+            return CompletionStream(completion=completion)
+
+    started = time.perf_counter()
+    stream = create_completion(
+        model=model,
+        messages=[{
+            "role": "user",
+            "content": prompt,
+        }],
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    return CompletionStream(stream, started, key, model)
+
+
+def percentile(samples, fraction):
+    """Return a percentile of samples, or None if there are none."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def stream_stats():
+    """Return the outcome counters and timing percentiles of recent streamed completions, in seconds."""
+    with stream_lock:
+        return {
+            **{outcome: stream_counters[outcome] for outcome in ("completed", "disconnected", "failed")},
+            "first_token_p50": percentile(first_token_times, 0.5),
+            "first_token_p95": percentile(first_token_times, 0.95),
+            "duration_p50": percentile(stream_durations, 0.5),
+            "duration_p95": percentile(stream_durations, 0.95),
+        }
+
+
+def cache_stats():
+    """Return the completion cache counters and hit rate since the server started."""
+    with cache_lock:
+        hits = cache_counters["memory_hits"] + cache_counters["database_hits"]
+        lookups = hits + cache_counters["misses"]
+        return {
+            "memory_hits": cache_counters["memory_hits"],
+            "database_hits": cache_counters["database_hits"],
+            "misses": cache_counters["misses"],
+            "hit_rate": hits / lookups if lookups else None,
+            "memory_entries": len(memory_cache),
+        }
+
+
+# Tokens of material sent in one prompt. Longer files are summarized chunk by chunk first (map), then the
+# prompt is asked about the partial summaries (reduce).
+CHUNK_TOKENS = 3000
+
+# Length of the summary of each chunk, and number of chunks summarized at the same time
+CHUNK_SUMMARY_MAX_TOKENS = 300
+MAX_CONCURRENT_CHUNKS = 4
+
+# Average length of a token, used to estimate counts without tiktoken
+CHARS_PER_TOKEN = 4
+
+CHUNK_SUMMARY_PROMPT = (
+    "The following text is one part of a longer study material. Summarize it as concise bullet points, "
+    "keeping every key concept, definition, fact and example, and nothing that is not in the text. Text: "
+)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding of a model."""
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text, model=MODEL):
+    """Count the tokens of a text for a model, or estimate them when tiktoken is not installed."""
+    if tiktoken is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(get_encoding(model).encode(text))
+
+
+def page_token_counts(file):
+    """
+    Return the text and token count of each page of a file.
+
+    Counts are stored on the pages the first time they are needed, so a document is only tokenized once.
+    """
+    pages = FilePage.query.filter_by(file_id=file.id).order_by(FilePage.number).all()
+
+    counted = False
+    for page in pages:
+        if page.token_count is None:
+            page.token_count = count_tokens(page.text)
+            counted = True
+    if counted:
+        db.session.commit()
+
+    return [(page.text, page.token_count) for page in pages]
+
+
+def split_to_budget(text, tokens, budget):
+    """Split a text of the given token count into consecutive pieces of about budget tokens at most."""
+    if tokens <= budget:
+        return [(text, tokens)]
+
+    count = math.ceil(tokens / budget)
+    size = math.ceil(len(text) / count)
+    return [(text[start:start + size], math.ceil(tokens / count)) for start in range(0, len(text), size)]
+
+
+def plan_chunks(pieces, budget=CHUNK_TOKENS):
+    """
+    Group consecutive texts into chunks that fit in a token budget.
+
+    Args:
+        pieces (list of tuple): (text, token count) in document order.
+        budget (int): Maximum tokens per chunk.
+
+    Returns:
+        list of str: The chunks, in document order. Texts longer than the budget are split.
+    """
+    chunks = []
+    current, current_tokens = [], 0
+
+    for text, tokens in pieces:
+        for piece, piece_tokens in split_to_budget(text, tokens, budget):
+            if current and current_tokens + piece_tokens > budget:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def summarize_chunks(chunks):
+    """Summarize chunks concurrently, at most MAX_CONCURRENT_CHUNKS at a time, keeping their order."""
+    app = current_app._get_current_object()
+
+    def summarize(chunk):
+        with app.app_context():
+            return complete(CHUNK_SUMMARY_PROMPT + chunk, max_tokens=CHUNK_SUMMARY_MAX_TOKENS, cache=True)
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHUNKS, thread_name_prefix="chunk") as executor:
+        return list(executor.map(summarize, chunks))
+
+
+def prompt_material(file):
+    """
+    Return the text of a file to embed in a prompt.
+
+    Files within CHUNK_TOKENS are returned whole. Longer ones are split into chunks that are summarized
+    concurrently, and the summaries are summarized again until they fit, so the prompt sees the whole
+    document in a condensed form. Chunk summaries are cached like other completions, so the work is
+    only done once per document.
+
+    Args:
+        file (File): A file whose text was extracted.
+
+    Returns:
+        str: The content of the file, or the summaries of its parts.
+    """
+    pieces = page_token_counts(file)
+
+    while sum(tokens for _, tokens in pieces) > CHUNK_TOKENS:
+        chunks = plan_chunks(pieces)
+        summaries = summarize_chunks(chunks)
+        pieces = [(summary + "\n", count_tokens(summary + "\n")) for summary in summaries]
+
+        # The summaries of a single chunk cannot be condensed further by another pass
+        if len(chunks) == 1:
+            break
+
+    return "".join(text for text, _ in pieces)
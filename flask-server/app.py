@@ -1,20 +1,47 @@
 import os
 from dotenv import load_dotenv
 import json
-from flask import Flask, session, request, jsonify, send_file, Response, stream_with_context
+import math
+from datetime import datetime, timedelta, timezone
+from flask import Flask, session, request, jsonify, Response, stream_with_context
 from flask_session import Session
 from flask_cors import CORS
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import ClientDisconnected
 import magic
-from pypdf import PdfReader
-from openai import OpenAI, APIError, APIConnectionError, RateLimitError
+from openai import APIError, APIConnectionError, RateLimitError
 from validator_collection import is_email
-from models import db, User, File, Subject, Tag, Project, Note, FlashcardDeck, Flashcard, Todo
+from models import db, User, File, FilePage, Subject, Tag, Project, Note, FlashcardDeck, Flashcard, Todo, Tombstone, Job, Upload
 from flask_migrate import Migrate
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import or_
-from helpers import login_required, logout_required, generate_untitled_name
+from sqlalchemy import inspect, or_
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from search import include_object, create_search_index, rebuild_search_index, search_items
+from typeahead import autocomplete
+from jobs import init_jobs, job_handler, submit_job
+from extraction import EXTRACTION_MODES, extract_text_from_pdf, split_text_into_pages
+from ai import (
+    AIUnavailableError, complete, stream_completion, prompt_material, retry_after,
+    cache_stats, stream_stats, gateway_stats,
+)
+from flashcards import FlashcardParser, parse_flashcards, add_flashcards
+from batch import Batch, BatchError, MAX_BATCH_OPERATIONS
+from deletion import delete_items, removal_job, remove_files
+from patches import COMPACTION_DELAY, PatchError, compact_note, note_content, note_version, patch_note, replace_note_content
+from writebuffer import init_write_buffer, write_behind, buffer_changes, buffer_note, flush_writes
+from ordering import item_position, move_item, rebalance_job, with_positions
+from retrieval import index_file, relevant_material, unused_indexes
+from images import IMAGE_VARIANTS, make_image_variants, remove_image, variant_path
+from storage import (
+    stage_stream, store_blob, reusable_pages, create_upload, write_chunk, finish_upload, discard_upload,
+)
+from helpers import login_required, logout_required, conditional_on_data_version, send_stored_file, generate_untitled_name
+from serializers import (
+    serialize, collection_query, COLLECTIONS, FILE_FIELDS, SUBJECT_FIELDS, PROJECT_FIELDS,
+    NOTE_FIELDS, DECK_FIELDS, FLASHCARD_FIELDS, TODO_FIELDS, TAG_FIELDS, JOB_FIELDS, UPLOAD_FIELDS,
+)
 
 
 # Configure application
@@ -27,24 +54,30 @@ app.config["SESSION_TYPE"] = "filesystem"
 Session(app)
 
 # Configure Flask-SQLAlchemy to use SQLite database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///learnmate.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:///learnmate.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  # Disable modification tracking
+# Optionally buffer autosaves of notes, flashcards and todos for this many seconds, merging the ones of the
+# same row into one write (see writebuffer.py). Only for a server running in a single process.
+app.config["WRITE_BEHIND_WINDOW"] = float(os.getenv("WRITE_BEHIND_WINDOW", 0))
 db.init_app(app)
 migrate = Migrate()
-migrate.init_app(app, db)
+migrate.init_app(app, db, include_object=include_object)
 
-# Create database tables
+# Create database tables and the full-text search index. Nothing here may query the tables of the models,
+# whose columns only exist once `flask db upgrade` ran on existing databases.
 with app.app_context():
-    db.create_all()
+    # Databases managed by migrations only change with `flask db upgrade`
+    if not inspect(db.engine).has_table("alembic_version"):
+        db.create_all()
+    create_search_index(db.session.connection())
+    db.session.commit()
 
-load_dotenv()
+    # Extraction pool workers re-import this module as __mp_main__, only the server process runs jobs
+    if __name__ != "__mp_main__":
+        init_jobs(app)
+        init_write_buffer(app)
 
-# Initialize OpenAI client
-client = OpenAI(
-  organization=os.getenv("OPENAI_ORGANIZATION"),
-  project=os.getenv("OPENAI_PROJECT"),
-  api_key=os.getenv("OPENAI_API_KEY"),
-)
+load_dotenv()
 
 @logout_required
 @app.route("/")
@@ -208,29 +241,28 @@ def dashboard():
     return jsonify({"message": "Dashboard loaded successfully"}), 200
 
 
-# Mock data for suggestions
-suggestions_data = [
-    {"label": "Home", "link": "/", "favicon": ""},
-    {"label": "About Us", "link": "/about", "favicon": ""},
-    {"label": "Contact", "link": "/contact", "favicon": ""},
-    {"label": "Products", "link": "/products", "favicon": ""},
-    {"label": "Services", "link": "/services", "favicon": ""},
-]
-
 # TODO: Remove api/ from route
 @app.route("/api/search", methods=["GET"])
+@login_required
 def search():
-    query = request.args.get("query", "").lower()
+    """
+    Search the user's items.
+
+    With mode=autocomplete, match names of files, notes, decks, subjects, projects and tags by
+    prefix from memory. Otherwise search files, notes and flashcards in full text, ranked by relevance.
+    """
+    query = request.args.get("query", "")
+    limit = min(request.args.get("limit", 20, type=int), 100)
+
+    if request.args.get("mode") == "autocomplete":
+        results = autocomplete(session["user_id"], query, limit)
+    else:
+        results = search_items(session["user_id"], query, limit)
 
-    # Filter suggestions based on the query
-    filtered_suggestions = [
-        {"label": suggestion["label"], "link": suggestion["link"]}
-        for suggestion in suggestions_data
-        if query in suggestion["label"].lower()
-    ]
+    for result in results:
+        result["link"] = f"/learn/{result['fileId']}" if result["fileId"] else "/courses"
 
-    # Return the filtered suggestions
-    return jsonify({"items": filtered_suggestions})
+    return jsonify({"items": results})
 
 
 @app.route("/courses")
@@ -248,6 +280,12 @@ def learn(id):
 # Configure file upload destination
 app.config["UPLOADED_FILES_DEST"] = "uploads"
 
+# Optionally let the front proxy send stored files: "x-sendfile" (Apache, lighttpd) or "x-accel-redirect"
+# (nginx, with SENDFILE_PREFIX an internal location aliased to the upload destination)
+app.config["SENDFILE_MODE"] = os.getenv("SENDFILE_MODE")
+app.config["SENDFILE_PREFIX"] = os.getenv("SENDFILE_PREFIX", "/protected-uploads/")
+app.config["USE_X_SENDFILE"] = app.config["SENDFILE_MODE"] is not None
+
 
 @login_required
 @app.route("/upload", methods=["POST"])
@@ -256,268 +294,538 @@ def upload_files():
     
     files = request.files.getlist("files")
     if files:
+        new_jobs = []
         for file in files:
             # Sanitize file name to prevent security vulnerabilities like directory traversal attacks
             filename = secure_filename(file.filename)
             user_id = session["user_id"]
-            
-            existing_file = File.query.filter_by(name=filename, user_id=user_id).first()
-
-            if filename == "":
-                return jsonify({"error": "Problem generating secure file name"}), 400
-            
-            if existing_file:
-                # TODO: I should rename the file instead of triggering an error like how I've done with notes
-                # or I can trigger a pop up to ask whether to rename or replace existing file or to cancel upload
-                return jsonify({"error": "File already exists"}), 400
 
-            # Validate file type
+            # Validate file name and type
             file_type = magic.from_buffer(file.read(2048), mime=True)  
             file.seek(0)  # Move file pointer back to the start
 
-            if "executable" in file_type.lower():
-                return jsonify({"error": "Executable files are not allowed"}), 400
+            error = upload_error(filename, user_id, file_type)
+            if error:
+                return jsonify({"error": error}), 400
 
-            # Create user folder if it doesn't exist
-            user_folder = os.path.join(app.config["UPLOADED_FILES_DEST"], f"user_{user_id}")
-            os.makedirs(user_folder, exist_ok=True)
+            # Store the content once per distinct file, hashing it while it is written to disk
+            staging_path, digest, size = stage_stream(file.stream)
+            new_job = add_uploaded_file(user_id, filename, file_type, staging_path, digest, size)
+            if new_job:
+                new_jobs.append(new_job)
 
-            # Create subfolder for files if it doesn't exist
-            user_files_folder = os.path.join(user_folder, "files")
-            os.makedirs(user_files_folder, exist_ok=True)
+        db.session.commit()
 
-            # Save file to user folder
-            file_path = os.path.join(user_files_folder, filename)
-            file.save(file_path)
+        for job in new_jobs:
+            submit_job(job.id)
 
-            # Extract file content
-            try:
-                if "pdf" in file_type.lower():
-                    # TODO: find a better pdf to text converter 
-                    file_content = extract_text_from_pdf(file)
+        return jsonify({
+            "message": "Files uploaded successfully",
+            "jobs": [serialize(job, JOB_FIELDS) for job in new_jobs],
+        }), 202
+    else:
+        return jsonify({"error": "No files provided"}), 400
 
-                else:
-                    #text, code, markup, and data files
-                    with open(file_path, 'r') as f:
-                        file_content = f.read()
 
-            except Exception:
-                    file_content = "Error reading file"
+def upload_error(filename, user_id, file_type=None):
+    """Return why a file cannot be uploaded under this name and type, or None if it can."""
+    if filename == "":
+        return "Problem generating secure file name"
 
+    if File.query.filter_by(name=filename, user_id=user_id).first():
+        # TODO: I should rename the file instead of triggering an error like how I've done with notes
+        # or I can trigger a pop up to ask whether to rename or replace existing file or to cancel upload
+        return "File already exists"
 
-            # Save file information to the database
-            new_file = File(
-                name=filename,
-                type=file_type,
-                user_id=user_id,
-                path=file_path,
-                content=file_content,
-            )
-            db.session.add(new_file)
+    if file_type and "executable" in file_type.lower():
+        return "Executable files are not allowed"
+
+    return None
+
+
+def add_uploaded_file(user_id, filename, file_type, staging_path, digest, size):
+    """
+    Move a staged upload into the blob store and save its file information.
+
+    Returns:
+        Job: The job extracting the text of the file, or None if the text of the same content was reused.
+    """
+    blob, already_stored = store_blob(staging_path, digest, size)
+
+    # Save file information to the database
+    new_file = File(
+        name=filename,
+        type=file_type,
+        user_id=user_id,
+        path=blob.path,
+        blob=blob,
+    )
+    db.session.add(new_file)
+
+    # Reuse the text extracted from the same content, otherwise extract it in the background
+    pages = reusable_pages(blob) if already_stored else None
+    if pages is not None:
+        new_file.set_content(pages)
+        return None
+
+    new_job = Job(kind="extract_text", user_id=user_id, file=new_file)
+    db.session.add(new_job)
+    return new_job
+
+
+# Chunked uploads left unfinished for longer are discarded
+UPLOAD_EXPIRY = timedelta(days=7)
+
+
+@app.route("/uploads", methods=["POST"])
+@login_required
+def start_upload():
+    """
+    Start a resumable upload, sent in chunks with PUT /uploads/<id>?offset=<bytes received>.
+
+    Expects JSON: {"name": file name, "size": total size in bytes}
+    """
+    user_id = session["user_id"]
+    data = request.json or {}
+
+    filename = secure_filename(data.get("name") or "")
+    size = data.get("size")
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({"error": "Size must be a positive integer."}), 400
+
+    error = upload_error(filename, user_id)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Forget uploads that were abandoned
+    expired = Upload.query.filter(
+        Upload.user_id == user_id,
+        Upload.modified_at < (datetime.now(timezone.utc) - UPLOAD_EXPIRY).replace(tzinfo=None),
+    )
+    for upload in expired:
+        discard_upload(upload)
+
+    upload = create_upload(user_id, filename, size)
+    db.session.commit()
+
+    return jsonify({"upload": serialize(upload, UPLOAD_FIELDS)}), 201
+
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+@login_required
+def get_upload(upload_id):
+    """Report how many bytes of an upload were received, i.e. the offset to resume it from"""
+    upload = Upload.query.filter_by(id=upload_id, user_id=session["user_id"]).first()
+
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+
+    return jsonify({"upload": serialize(upload, UPLOAD_FIELDS)}), 200
+
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+@login_required
+def put_upload_chunk(upload_id):
+    """
+    Append the request body to an upload.
+
+    Query args:
+        offset: Position of the chunk in the file, which must be the number of bytes received so far.
+    """
+    upload = Upload.query.filter_by(id=upload_id, user_id=session["user_id"]).first()
+
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+
+    offset = request.args.get("offset", type=int)
+    if offset != upload.received:
+        # Sent again or out of order, the client resumes from the offset returned
+        return jsonify({"error": "Chunk offset does not match the bytes received.", "upload": serialize(upload, UPLOAD_FIELDS)}), 409
+
+    try:
+        write_chunk(upload, request.stream)
+    except ValueError as e:
+        db.session.commit()
+        return jsonify({"error": str(e), "upload": serialize(upload, UPLOAD_FIELDS)}), 400
+    except ClientDisconnected:
+        # Keep what was received before the connection dropped
+        db.session.commit()
+        raise
+
+    db.session.commit()
+
+    return jsonify({"upload": serialize(upload, UPLOAD_FIELDS)}), 200
+
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+@login_required
+def complete_upload(upload_id):
+    """Turn a fully received upload into a file, like the files sent to /upload"""
+    user_id = session["user_id"]
+    upload = Upload.query.filter_by(id=upload_id, user_id=user_id).first()
+
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+
+    if upload.received < upload.size:
+        return jsonify({"error": "Upload is incomplete.", "upload": serialize(upload, UPLOAD_FIELDS)}), 400
 
+    # Validate file name and type
+    with open(upload.path, "rb") as f:
+        file_type = magic.from_buffer(f.read(2048), mime=True)
+
+    error = upload_error(upload.name, user_id, file_type)
+    if error:
+        discard_upload(upload)
         db.session.commit()
+        return jsonify({"error": error}), 400
+
+    filename = upload.name
+    staging_path, digest, size = finish_upload(upload)
+    new_job = add_uploaded_file(user_id, filename, file_type, staging_path, digest, size)
+    db.session.commit()
+
+    new_jobs = [new_job] if new_job else []
+    for job in new_jobs:
+        submit_job(job.id)
+
+    return jsonify({
+        "message": "Files uploaded successfully",
+        "jobs": [serialize(job, JOB_FIELDS) for job in new_jobs],
+    }), 202
+
+
+def store_file_text(file, pages):
+    """Replace the extracted text of a file, removing the retrieval index of its previous text if now unused."""
+    previous_text = file.content_hash
+    file.set_content(pages)
+
+    # Indexes are built again when missing, so the previous one can go before the new text is committed
+    if previous_text not in (None, file.content_hash):
+        remove_files(unused_indexes([previous_text]))
+
+
+def mark_file_unreadable(job):
+    """Store the placeholder content of files whose text could not be extracted."""
+    if job.file:
+        store_file_text(job.file, ["Error reading file"])
+
+
+@job_handler("extract_text", on_failure=mark_file_unreadable)
+def extract_file_text(job, progress):
+    """Extract the text of an uploaded file page by page and store it as the file content."""
+    file = job.file
+    if file is None: # file deleted before its job ran
+        return
+
+    if "pdf" in file.type.lower():
+        # TODO: find a better pdf to text converter 
+        file_pages = extract_text_from_pdf(file.path, (job.payload or {}).get("mode", "plain"), progress, file.blob_hash)
 
-        return jsonify({"message": "Files uploaded successfully"}), 200
     else:
-        return jsonify({"error": "No files provided"}), 400
+        #text, code, markup, and data files
+        with open(file.path, 'r') as f:
+            file_pages = split_text_into_pages(f.read())
+        progress(1, 1)
+
+    store_file_text(file, file_pages)
+    db.session.commit()
+
+    # Embed the text for retrieval now rather than on the first question about it
+    index_file(file)
+
+
+@app.route("/files/<file_id>/extract", methods=["POST"])
+@login_required
+def reextract_file(file_id):
+    """Extract the text of a pdf again with another extraction mode, e.g. layout"""
+    file = File.query.filter_by(id=file_id, user_id=session["user_id"]).first()
+
+    if file is None:
+        return jsonify({"error": "File not found"}), 404
+
+    mode = (request.json or {}).get("mode", "plain")
+    if mode not in EXTRACTION_MODES:
+        return jsonify({"error": f"Extraction mode must be one of {', '.join(EXTRACTION_MODES)}."}), 400
+
+    if "pdf" not in file.type.lower():
+        return jsonify({"error": "Only pdf files support extraction modes."}), 400
+
+    job = Job(kind="extract_text", user_id=file.user_id, file=file, payload={"mode": mode})
+    db.session.add(job)
+    db.session.commit()
+    submit_job(job.id)
 
-def extract_text_from_pdf(pdf_file):
-    reader = PdfReader(pdf_file)
-    text = ''
-    for page_num in range(reader.get_num_pages()):
-        text += reader.get_page(page_num).extract_text()
-        # extract text in a fixed width format that closely adheres to the rendered layout in the source pdf 
-        # extract_text(extraction_mode="layout")
+    return jsonify({"message": "Extraction queued", "job": serialize(job, JOB_FIELDS)}), 202
 
-        # extract text preserving horizontal positioning without excess vertical whitespace (removes blank and "whitespace only" lines)
-        # extract_text(extraction_mode="layout", layout_mode_space_vertically=False)
 
-        # adjust horizontal spacing
-        # extract_text(extraction_mode="layout", layout_mode_scale_weight=1.0)
+@app.route("/jobs/<job_id>")
+@login_required
+def get_job(job_id):
+    """Report the status and progress of a background job"""
+    job = Job.query.filter_by(id=job_id, user_id=session["user_id"]).first()
 
-        # exclude (default) or include (as shown below) text rotated w.r.t. the page
-        # extract_text(extraction_mode="layout", layout_mode_strip_rotated=False)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
 
-    return text.strip()
+    return jsonify({"job": serialize(job, JOB_FIELDS)}), 200
 
 
 @login_required
 @app.route("/data", methods=["GET"])
+@conditional_on_data_version(cache=True)
 def get_user_data():
-    user = User.query.filter_by(id=session["user_id"]).first()
+    # Large libraries can ask for the payload to be streamed instead of built in memory
+    if request.args.get("stream") == "1":
+        return stream_user_data(session["user_id"])
+
+    # Eager load every collection walked below so the payload is built from a fixed number of
+    # queries (one per relationship) instead of one lazy load per file, deck and collection
+    user = User.query.filter_by(id=session["user_id"]).options(
+        selectinload(User.files).options(
+            selectinload(File.pages),
+            selectinload(File.subject),
+            selectinload(File.project),
+            selectinload(File.notes).selectinload(Note.patches),
+            selectinload(File.flashcard_decks).selectinload(FlashcardDeck.flashcards).options(with_positions(Flashcard)),
+            selectinload(File.todos).options(with_positions(Todo)),
+            selectinload(File.tags),
+        ),
+        selectinload(User.subjects),
+        selectinload(User.projects),
+        selectinload(User.notes).selectinload(Note.patches),
+        selectinload(User.flashcard_decks).selectinload(FlashcardDeck.flashcards).options(with_positions(Flashcard)),
+        selectinload(User.flashcards).options(with_positions(Flashcard)),
+        selectinload(User.todos).options(with_positions(Todo)),
+        selectinload(User.tags),
+    ).first()
     
     username = user.username
 
-    files = user.files
-    file_list = [
-        {
-            "id": file.id,
-            "name": file.name,
-            "type": file.type,
-            #  "path": file.path,
-            "content": file.content,
-            "created_at": file.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            "subject": [{
-                "id": file.subject.id,
-                "name": file.subject.name,
-                "color": file.subject.color,
-            }]
-            if file.subject
-            else [],
-            "project": [{
-                "id": file.project.id,
-                "name": file.project.name,
-                "color": file.project.color,
-            }]
-            if file.project
-            else [],
-            "notes": [
-                {
-                    "type": Note.__tablename__,
-                    "id": note.id,
-                    "name": note.name,
-                    "content": note.content,
-                    "modified_at" : note.modified_at,
-                } 
-                for note in file.notes
-            ],
-            "flashcard_decks": [
-                {
-                    "type": FlashcardDeck.__tablename__,
-                    "id": flashcard_deck.id,
-                    "name": flashcard_deck.name,
-                    "modified_at": flashcard_deck.modified_at,
-                    "flashcards": [
-                        {
-                            "id": flashcard.id,
-                            "term": flashcard.term,
-                            "definition": flashcard.definition,
-                            "order": flashcard.order,
-                            "imagePath": flashcard.image_path,
-                        } 
-                        for flashcard in flashcard_deck.flashcards
-                    ],
-                } 
-                for flashcard_deck in file.flashcard_decks
-            ],
-            "todos": [
-                {
-                    "id": todo.id,
-                    "content": todo.content,
-                    "done": todo.done,
-                    "order": todo.order,
-                } 
-                for todo in file.todos
-            ],            
-            "tags": [
-                {
-                    "id": tag.id,
-                    "name": tag.name,
-                    "color": tag.color,
-                } 
-                for tag in file.tags
-            ],
-        }
-        for file in files
-    ]
-    
-    subjects = user.subjects
-    subjects_list = [
-        {
-            "id": subject.id,
-            "name": subject.name,
-            "color": subject.color,
-        }
-        for subject in subjects
-    ]
-
-    projects = user.projects
-    projects_list = [
-        {
-            "id": project.id,
-            "name": project.name,
-            "color": project.color,
-        }
-        for project in projects
-    ]
-
-    notes = user.notes
-    notes_list = [
-        {
-            "id": note.id,
-            "name": note.name,
-            "content": note.content,
-        }
-        for note in notes
-    ]
-
-    flashcard_decks = user.flashcard_decks
-    flashcard_decks_list = [
-        {
-            "id": flashcard_deck.id,
-            "name": flashcard_deck.name,
-            "modified_at": flashcard_deck.modified_at,
-            "flashcards": [
-                {
-                    "id": flashcard.id,
-                    "term": flashcard.term,
-                    "definition": flashcard.definition,
-                    "order": flashcard.order,
-                    "imagePath": flashcard.image_path,
-                } 
-                for flashcard in flashcard_deck.flashcards
-            ],
-        }
-        for flashcard_deck in flashcard_decks
-    ]
-
-    flashcards = user.flashcards
-    flashcards_list = [
-        {
-            "id": flashcard.id,
-            "term": flashcard.term,
-            "definition": flashcard.definition,
-            "order": flashcard.order,
-            "imagePath": flashcard.image_path,
-        } 
-        for flashcard in flashcards
-    ]
-
-    todos = user.todos
-    todos_list = [
-        {
-            "id": todo.id,
-            "content": todo.content,
-            "done": todo.done,
-            "order": todo.order,
-        }
-        for todo in todos
-    ]
-
-    tags = user.tags
-    tags_list = [
-        {
-            "id": tag.id,
-            "name": tag.name,
-            "color": tag.color,
-        }
-        for tag in tags
-    ]
+    file_list = [serialize(file, FILE_FIELDS) for file in user.files]
+    subjects_list = [serialize(subject, SUBJECT_FIELDS) for subject in user.subjects]
+    projects_list = [serialize(project, PROJECT_FIELDS) for project in user.projects]
+    notes_list = [serialize(note, NOTE_FIELDS) for note in user.notes]
+    flashcard_decks_list = [serialize(flashcard_deck, DECK_FIELDS) for flashcard_deck in user.flashcard_decks]
+    flashcards_list = [serialize(flashcard, FLASHCARD_FIELDS) for flashcard in user.flashcards]
+    todos_list = [serialize(todo, TODO_FIELDS) for todo in user.todos]
+    tags_list = [serialize(tag, TAG_FIELDS) for tag in user.tags]
     
     return jsonify({"username": username, "files": file_list, "subjects": subjects_list, "projects": projects_list, "notes": notes_list, "flashcard_decks": flashcard_decks_list, "flashcards": flashcards_list, "todos": todos_list, "tags": tags_list}), 200
 
 
+# Number of rows fetched per batch when streaming the user payload
+STREAM_BATCH_SIZE = 100
+
+# Payload keys of /data and the collections they are built from
+PAYLOAD_COLLECTIONS = [
+    ("files", "files"),
+    ("subjects", "subjects"),
+    ("projects", "projects"),
+    ("notes", "notes"),
+    ("flashcard_decks", "decks"),
+    ("flashcards", "flashcards"),
+    ("todos", "todos"),
+    ("tags", "tags"),
+]
+
+
+def stream_user_data(user_id):
+    """
+    Stream the /data payload as JSON, serializing one row at a time.
+
+    Rows are fetched in batches of STREAM_BATCH_SIZE with their relationships loaded per batch, so
+    memory use stays flat however large the library is. The bytes are the ones jsonify gives outside
+    debug mode (compact, keys sorted, ending with a newline), so clients cannot tell the two apart.
+    """
+    username = db.session.query(User.username).filter_by(id=user_id).scalar()
+    collection_names = dict(PAYLOAD_COLLECTIONS)
+    keys = ["username", *collection_names]
+    if app.json.sort_keys:
+        keys.sort()
+
+    def dumps(value):
+        return app.json.dumps(value, separators=(",", ":"))
+
+    def generate_json():
+        for index, key in enumerate(keys):
+            yield ("," if index else "{") + dumps(key) + ":"
+            if key == "username":
+                yield dumps(username)
+                continue
+
+            collection = COLLECTIONS[collection_names[key]]
+            yield "["
+            items = collection_query(collection, user_id).yield_per(STREAM_BATCH_SIZE)
+            for item_index, item in enumerate(items):
+                yield ("," if item_index else "") + dumps(serialize(item, collection["fields"]))
+            yield "]"
+
+        yield "}\n"
+
+    return Response(stream_with_context(generate_json()), status=200, mimetype="application/json")
+
+
+# Page size limits for the sectioned data API
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+@app.route("/data/<collection_name>", methods=["GET"])
+@login_required
+@conditional_on_data_version
+def get_user_collection(collection_name):
+    """
+    Return one page of a user collection (files, notes, decks, flashcards, todos, tags, subjects or projects).
+
+    Query args:
+        cursor: id of the last item of the previous page (keyset pagination).
+        limit: page size, capped at MAX_PAGE_SIZE.
+        fields: comma-separated output fields, e.g. fields=id,name to leave out heavy content columns.
+    """
+    collection = COLLECTIONS.get(collection_name)
+    if collection is None:
+        return jsonify({"error": f"Unknown collection {collection_name}"}), 404
+
+    fields = request.args.get("fields")
+    if fields is not None:
+        fields = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown_fields = fields - collection["fields"].keys()
+        if unknown_fields:
+            return jsonify({"error": f"Unknown fields: {', '.join(sorted(unknown_fields))}"}), 400
+
+    cursor = request.args.get("cursor", type=int)
+    limit = min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE)
+    if limit < 1:
+        return jsonify({"error": "Limit must be a positive integer."}), 400
+
+    Model = collection["model"]
+    query = collection_query(collection, session["user_id"], fields)
+    if cursor is not None:
+        query = query.filter(Model.id > cursor)
+
+    # Fetch one extra row to know whether another page follows
+    items = query.limit(limit + 1).all()
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    return jsonify({
+        "items": [serialize(item, collection["fields"], fields) for item in items],
+        "next_cursor": items[-1].id if has_more else None,
+    }), 200
+
+
+# Tombstones older than this are pruned daily, sync tokens older than this require a full refetch
+SYNC_RETENTION = timedelta(days=30)
+# Rows are matched from slightly before the token so writes committed just after a token was issued
+# are not missed. Clients apply changes as upserts, so the overlap is harmless.
+SYNC_OVERLAP = timedelta(seconds=5)
+
+
+@app.route("/data/changes", methods=["GET"])
+@login_required
+def get_user_changes():
+    """
+    Return the items created, updated or deleted since a sync token.
+
+    Query args:
+        since: token returned by a previous call. Without it every item is returned.
+
+    Returns a new token to pass as since on the next call.
+    """
+    user_id = session["user_id"]
+    now = datetime.now(timezone.utc)
+    token = str(int(now.timestamp() * 1_000_000))
+
+    since = request.args.get("since", type=int)
+    if since is not None:
+        since = datetime.fromtimestamp(since / 1_000_000, timezone.utc)
+        if since < now - SYNC_RETENTION:
+            return jsonify({"error": "Sync token expired, fetch /data again."}), 410
+
+        # Timestamps are stored as naive UTC datetimes
+        since = (since - SYNC_OVERLAP).replace(tzinfo=None)
+
+    changes = {}
+    for collection_name, collection in COLLECTIONS.items():
+        Model = collection["model"]
+        query = collection_query(collection, user_id)
+        if since is not None:
+            query = query.filter(Model.modified_at >= since)
+        changes[collection_name] = [serialize(item, collection["fields"]) for item in query]
+
+    deleted = []
+    if since is not None:
+        tombstones = Tombstone.query.filter(
+            Tombstone.user_id == user_id,
+            Tombstone.deleted_at >= since,
+        ).order_by(Tombstone.id)
+        deleted = [{"type": tombstone.item_type, "id": tombstone.item_id} for tombstone in tombstones]
+
+    user = db.session.get(User, user_id)
+    user_data = {"username": user.username} if since is None or (user.modified_at or user.joined_at) >= since else None
+
+    return jsonify({"token": token, "user": user_data, "changes": changes, "deleted": deleted}), 200
+
+
 @login_required
 @app.route("/files/<file_id>")
 def serve_file(file_id):
     file = db.session.get(File, file_id)
 
     if file:
-        return send_file(file.path)
+        # A file's content never changes, so URLs versioned with its hash (see FILE_FIELDS) are cached for good
+        immutable = file.blob_hash is not None and request.args.get("v") == file.blob_hash
+        return send_stored_file(file.path, file.type, file.name, etag=file.blob_hash, immutable=immutable)
     else:
         return jsonify({"error": "File not found"}), 404
 
 
+@app.route("/files/<file_id>/content")
+@login_required
+def get_file_content(file_id):
+    """
+    Return a slice of the extracted text of a file.
+
+    Query args:
+        page: 1-based page number to read, or
+        offset, length: character range to read. Without arguments the whole text is returned.
+    """
+    file = File.query.filter_by(id=file_id, user_id=session["user_id"]).first()
+
+    if file is None:
+        return jsonify({"error": "File not found"}), 404
+
+    page_count, size = db.session.query(
+        db.func.count(FilePage.id), db.func.coalesce(db.func.sum(FilePage.length), 0)
+    ).filter_by(file_id=file.id).one()
+
+    page_number = request.args.get("page", type=int)
+    if page_number is not None:
+        page = FilePage.query.filter_by(file_id=file.id, number=page_number).first()
+        if page is None:
+            return jsonify({"error": "Page not found"}), 404
+
+        offset, content = page.offset, page.text
+
+    else:
+        offset = request.args.get("offset", 0, type=int)
+        length = request.args.get("length", type=int)
+        if offset < 0 or (length is not None and length < 0):
+            return jsonify({"error": "Offset and length must be positive integers."}), 400
+
+        content = file.read_content(offset, length)
+
+    return jsonify({
+        "content": content,
+        "offset": offset,
+        "length": len(content),
+        "page": page_number,
+        "pages": page_count,
+        "size": size,
+    }), 200
+
+
 @login_required
 @app.route("/updateName/<file_id>", methods=["POST"])
 def update_fileName(file_id):
@@ -534,19 +842,10 @@ def update_fileName(file_id):
             return jsonify({"error": "File name cannot start with a period."}), 400
 
         try:
-            # Define paths
-            user_folder = os.path.join(app.config["UPLOADED_FILES_DEST"], f"user_{session['user_id']}", "files")
-            old_path = os.path.join(user_folder, file.name)
-            new_path = os.path.join(user_folder, file_name)
-
-            # update file in database
+            # update file in database, its content is stored under its hash so nothing moves on disk
             file.name = file_name
-            file.path = new_path
             db.session.commit()
 
-            # update file in user folder after successful database update
-            os.rename(old_path, new_path)
-
             return jsonify({"message": "File updated successfully"}), 200
         
         except IntegrityError as e:
@@ -564,16 +863,15 @@ def update_fileName(file_id):
 @login_required
 @app.route("/delete/<file_id>", methods=["POST"])
 def delete_file(file_id):
-    file = File.query.filter_by(id=file_id).first()
+    file = File.query.filter_by(id=file_id, user_id=session["user_id"]).first()
 
     if file:
-        # delete file from user folder
-        user_folder = os.path.join(app.config["UPLOADED_FILES_DEST"], f"user_{session['user_id']}", "files")
-        os.remove(os.path.join(user_folder, file.name))
-
-        # delete file from database
-        db.session.delete(file)
+        # delete file from database with its notes, decks, flashcards and todos, its content is removed
+        # in the background with the last file using it
+        removed_paths = delete_items(File, file.user_id, File.id == file.id)
+        cleanup = removal_job(removed_paths, file.user_id)
         db.session.commit()
+        submit_queued(cleanup)
 
         return jsonify({"message": "File deleted successfully"}), 200
 
@@ -628,18 +926,7 @@ def add_property(property_type, property_id):
     # Add property to file
     file_id = data.get("fileId")
     file = File.query.filter_by(id=file_id).first()
-    
-    if property_type == 'Subject':
-        file.subject = property
-    elif property_type == 'Project':
-        file.project = property
-    elif property_type == 'Tag':
-        if property not in file.tags:
-            file.tags.append(property)
-    elif property_type == 'Note':
-        if property not in file.notes:
-            file.notes.append(property)
-    
+    file.add_property(property)
     db.session.commit()
 
     return jsonify({"message": f"{property_type} created and/or added successfully"}), 200
@@ -663,16 +950,7 @@ def remove_property(property_type, property_id):
     if property:
         file_id = data.get("fileId")
         file = File.query.filter_by(id=file_id).first()
-        
-        if property_type == 'Subject':
-            file.subject = None
-        elif property_type == 'Project':
-            file.project = None 
-        elif property_type == 'Tag':
-            file.tags.remove(property)
-        elif property_type == 'Note':
-            file.notes.remove(property)
-
+        file.remove_property(property)
         db.session.commit()
 
         return jsonify({"message": f"{property_type} removed successfully"}), 200
@@ -776,6 +1054,7 @@ def create_note(file_id, note_name=None):
             "id": new_note.id,
             "name": new_note.name,
             "content": new_note.content,
+            "version": new_note.version,
         }
 
         return jsonify({"message": "Note created successfully", "note": note_data}), 200
@@ -787,16 +1066,34 @@ def create_note(file_id, note_name=None):
 @login_required
 @app.route("/updateNote/<note_id>", methods=["POST"])
 def update_note(note_id):
-    note = Note.query.filter_by(id=note_id).first()
+    """
+    Update the name or content of a note.
+
+    The content is either replaced with "content", or edited with "patch", a list of JSON Patch
+    operations made against "baseVersion", the version of the note they were made from. A patch made
+    against another version is refused with 409, as is a content replaced with an outdated baseVersion.
+    """
     data = request.json
+    if not data or not data.keys() & {"name", "content", "patch"}:
+        return jsonify({"error": "Nothing to update, send a name, content or patch."}), 400
+
+    deferred = write_behind(Note, data)
+    note = Note.query.filter_by(id=note_id, user_id=session["user_id"]).first()
     
     if note:
+        compaction = None
         try:
             if "name" in data:
                 note.name = data["name"].strip()
 
-            if "content" in data:
-                note.content = data["content"]
+            if deferred:
+                buffer_note(note, data.get("baseVersion"), data.get("content"), data.get("patch"))
+
+            elif "content" in data:
+                replace_note_content(note, data["content"], data.get("baseVersion"))
+
+            elif "patch" in data:
+                compaction = patch_note(note, data["patch"], data.get("baseVersion"))
 
             db.session.commit()
 
@@ -804,10 +1101,27 @@ def update_note(note_id):
                 "type": Note.__tablename__,
                 "id": note.id,
                 "name": note.name,
-                "content": note.content,
+                "version": note_version(note),
             }
+            # A patched note is not sent back, so responses stay the size of the edit
+            if "patch" not in data:
+                note_data["content"] = note_content(note)
+
+            if compaction is not None:
+                submit_queued(compaction, COMPACTION_DELAY)
             return jsonify({"message": "Note updated successfully", "note": note_data}), 200
-        
+
+        except PatchError as e:
+            db.session.rollback()
+            if e.status == 409:
+                return note_conflict(note, e.message)
+            return jsonify({"error": e.message, "version": note_version(note)}), e.status
+
+        except StaleDataError:
+            # Another request changed the note between its loading and this update
+            db.session.rollback()
+            return note_conflict(note, "Note changed, try again")
+
         except IntegrityError as e:
             db.session.rollback()
             if f"UNIQUE constraint failed: note.name" in str(e.orig):
@@ -819,12 +1133,20 @@ def update_note(note_id):
         return jsonify({"error": "Note not found"}), 404
 
 
+def note_conflict(note, message):
+    """Refuse an edit made against an outdated version of a note, with its current version for the client to rebase on."""
+    return jsonify({"error": message, "version": note_version(note), "content": note_content(note)}), 409
+
+
 @login_required
 @app.route("/deleteNote/<note_id>", methods=["POST"])
 def delete_note(note_id):
     
-    note = Note.query.filter_by(id=note_id).first()
-    db.session.delete(note)
+    note = Note.query.filter_by(id=note_id, user_id=session["user_id"]).first()
+    if note is None:
+        return jsonify({"error": "Note not found"}), 404
+
+    delete_items(Note, note.user_id, Note.id == note.id)
 
     try:
         db.session.commit()
@@ -834,6 +1156,14 @@ def delete_note(note_id):
         return jsonify({"error": str(e)}), 400
 
 
+# Keywords whose prompt only depends on stored content, so the same click asks the same prompt.
+# custom, improve and continue prompts include text the user just typed and are rarely repeated.
+CACHED_KEYWORDS = {"summarize", "multigen", "predict"}
+
+# Asks for cards in the "F: <Front>\nB: <Back>" format parsed by flashcards.FlashcardParser
+MULTIGEN_PROMPT = "Generate mixed types of flashcards (e.g., definitions, applications, True False, Multi Choice, Fill in the Blank, etc.) from the following text using this format: \nF: <Front>\nB: <Back>\nUse only information provided by the text. text: "
+
+
 @login_required
 @app.route('/askAI/<context>/<keyword>', methods=["POST"])
 def askAI(context, keyword):
@@ -852,10 +1182,29 @@ def askAI(context, keyword):
                 return jsonify({'error': 'File not found'}), 404
             
             file_content = file.content
+            if file_content is None:
+                return jsonify({"error": "File content is still being extracted"}), 409
             if file_content == "Error reading file":
                 return jsonify({"error": "File content not available"}), 400
         
-            file_content = "\nMaterial:\n" + file_content
+            try:
+                if keyword == "continue" and (data.get("notes") or "").strip():
+                    # Only the parts of long files related to the notes, found by embedding search
+                    file_content = "\nMaterial:\n" + relevant_material(file, data["notes"])
+                else:
+                    # Long files are condensed chunk by chunk so the whole material fits in the prompt
+                    file_content = "\nMaterial:\n" + prompt_material(file)
+            except Exception as e:
+                return ai_error_response(e)
+
+        if keyword == "custom" and data.get("fileId"):
+            # Custom prompts are answered with the parts of the file they relate to, when it is readable
+            file = File.query.filter_by(id=data["fileId"]).first()
+            if file is not None and file.content not in (None, "Error reading file"):
+                try:
+                    file_content = "\nUse the following study material where relevant:\n" + relevant_material(file, data.get("prompt") or "")
+                except Exception as e:
+                    return ai_error_response(e)
         
         if keyword in ['continue', 'improve']:
             # Retrieve user notes from database
@@ -869,7 +1218,7 @@ def askAI(context, keyword):
         elif keyword == "improve": # uses only note content as input
             prompt = "Improve writing." + note_content
         elif keyword == "custom": # case when the user input is the prompt
-            prompt = data.get("prompt")
+            prompt = data.get("prompt") + file_content
     
     elif context == "Flashcards":
         if keyword == "multigen":
@@ -881,10 +1230,17 @@ def askAI(context, keyword):
             
             file_content = file.content
             
+            if file_content is None:
+                return jsonify({"error": "File content is still being extracted"}), 409
             if file_content == "Error reading file":
                 return jsonify({"error": "File content not available"}), 400
         
-            prompt = "Generate mixed types of flashcards (e.g., definitions, applications, True False, Multi Choice, Fill in the Blank, etc.) from the following text using this format: \nF: <Front>\nB: <Back>\nUse only information provided by the text. text: " + file_content
+            # Long files are condensed chunk by chunk so the whole material fits in the prompt
+            try:
+                file_content = prompt_material(file)
+            except Exception as e:
+                return ai_error_response(e)
+            prompt = MULTIGEN_PROMPT + file_content
 
         elif keyword == "predict":
             id = data.get("flashcardId")
@@ -900,43 +1256,83 @@ def askAI(context, keyword):
             custom_prompt = data.get("prompt")
             prompt = "Create one flashcard to the following prompt. Organize your response using term and definition distinctions. prompt: " + custom_prompt
 
-    # Make request to OpenAI API
+    # Make request to OpenAI API, answering prompts that are asked again verbatim from the cache
     try:
-        # stream = client.chat.completions.create(
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{
-                "role": "user", 
-                "content": prompt,
-            }],
-            # stream=True,
-            max_tokens=200,
-        )
+        # Clients can ask for the completion to be streamed as it is generated
+        if request.args.get("stream") == "1":
+            return stream_ai_response(stream_completion(prompt, cache=keyword in CACHED_KEYWORDS))
+
+        completion = complete(prompt, cache=keyword in CACHED_KEYWORDS)
+
+    except Exception as e:
+        return ai_error_response(e)
+    
+    return jsonify({'message': completion}), 200
+
+
+def ai_error_response(e):
+    """Turn an exception raised while asking the OpenAI API into an error response"""
+
+    # The gateway refused to call the API because it is saturated or failing
+    if isinstance(e, AIUnavailableError):
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
 
     # Handle OpenAI API errors
-    except RateLimitError as e:
-        return jsonify({'error': f'OpenAI API request exceeded rate limit: {e}'}), 429
+    if isinstance(e, RateLimitError):
+        delay = retry_after(e)
+        headers = {'Retry-After': str(math.ceil(delay))} if delay is not None else {}
+        return jsonify({'error': f'OpenAI API request exceeded rate limit: {e}'}), 429, headers
     
-    except APIConnectionError as e:
+    if isinstance(e, APIConnectionError):
         return jsonify({'error': f'Failed to connect to OpenAI API: {e}'}), 500
     
-    except APIError as e:
+    if isinstance(e, APIError):
         return jsonify({'error': f'OpenAI API returned an API Error: {e}'}), 500
     
     # Handle other exceptions
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-    
-    return jsonify({'message': completion.choices[0].message.content}), 200
+    return jsonify({'error': str(e)}), 500
 
-    # def generate_chunks():
-    #     # Yield each chunk from the stream
-    #     for chunk in stream:
-    #         if chunk.choices[0].delta.content is not None:
-    #             yield chunk.choices[0].delta.content
-    
-    # # Stream AI response chunks to client
-    # return Response(stream_with_context(generate_chunks()), status=200, content_type='text/plain')
+
+def server_sent_event(event, data):
+    """Format a server-sent event whose data is JSON, so newlines in the text cannot break the stream."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_ai_response(chunks):
+    """
+    Stream a completion to the client as server-sent events.
+
+    A "token" event is sent for each piece of text, then "done", or "error" if the API fails midway.
+    When the client disconnects, the response is closed and so is the request to the API.
+    """
+    def generate_events():
+        try:
+            for text in chunks:
+                yield server_sent_event("token", {"text": text})
+        except Exception as e:
+            yield server_sent_event("error", {"error": str(e)})
+            return
+
+        yield server_sent_event("done", {})
+
+    return event_stream_response(generate_events(), chunks)
+
+
+def event_stream_response(events, chunks):
+    """Return a response streaming server-sent events generated from a completion stream."""
+    response = Response(stream_with_context(events), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # let proxies pass events through as they are generated
+    # Also covers clients leaving before the first event, when the generator has not started
+    response.call_on_close(chunks.close)
+    return response
+
+
+@app.route("/askAI/stats")
+@login_required
+def get_ai_stats():
+    """Report the completion cache counters, the timings of streamed completions and the state of the gateway"""
+    return jsonify({"cache": cache_stats(), "streams": stream_stats(), "gateway": gateway_stats()}), 200
 
 
 @login_required
@@ -978,6 +1374,12 @@ def update_flashcard_deck(deck_id):
             
             db.session.commit()
 
+            # The whole deck is loaded, so positions come from one window over it
+            flashcards = (
+                Flashcard.query.filter_by(deck_id=deck.id)
+                .options(with_positions(Flashcard))
+                .order_by(Flashcard.rank, Flashcard.id)
+            )
             deck_data = {
                 "type": FlashcardDeck.__tablename__,
                 "id": deck.id,
@@ -987,10 +1389,10 @@ def update_flashcard_deck(deck_id):
                         "id": flashcard.id,
                         "term": flashcard.term,
                         "definition": flashcard.definition,
-                        "order": flashcard.order,
+                        "order": flashcard.position,
                         "imagePath": flashcard.image_path,
                     } 
-                    for flashcard in deck.flashcards
+                    for flashcard in flashcards
                 ],
             }
 
@@ -1011,18 +1413,15 @@ def update_flashcard_deck(deck_id):
 @login_required
 @app.route("/deleteFlashcardDeck/<deck_id>", methods=["POST"])
 def delete_flashcard_deck(deck_id):
-    deck = FlashcardDeck.query.filter_by(id=deck_id).first()
+    deck = FlashcardDeck.query.filter_by(id=deck_id, user_id=session["user_id"]).first()
 
     if deck:
-        # Delete flashcards in the deck
-        flashcards = Flashcard.query.filter_by(deck_id=deck_id).order_by(Flashcard.order).all()
-
-        for flashcard in flashcards:
-            delete_flashcard(flashcard.id, True)
-
-        # delete flashcard deck from database
-        db.session.delete(deck)
+        # delete flashcard deck from database, its flashcards go with it and their images are removed
+        # in the background
+        removed_paths = delete_items(FlashcardDeck, deck.user_id, FlashcardDeck.id == deck.id)
+        cleanup = removal_job(removed_paths, deck.user_id)
         db.session.commit()
+        submit_queued(cleanup)
 
         return jsonify({"message": "Flashcard deck deleted successfully"}), 200
 
@@ -1035,18 +1434,19 @@ def delete_flashcard_deck(deck_id):
 def create_flashcard(deck_id, order):
     try:
         new_flashcard = Flashcard(
-            order=order,
             term='',
             definition='',
             user_id=session["user_id"],
             deck_id=deck_id,
         )
+        rebalance = move_item(new_flashcard, int(order))
         db.session.add(new_flashcard)
         db.session.commit()
+        submit_queued(rebalance)
 
         flashcard_data = {
             "id": new_flashcard.id,
-            "order": new_flashcard.order,
+            "order": item_position(new_flashcard),
         }
 
         return jsonify({"message": "Flashcard created successfully", "flashcard": flashcard_data}), 200
@@ -1055,11 +1455,99 @@ def create_flashcard(deck_id, order):
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/generateFlashcards/<deck_id>", methods=["POST"])
+@login_required
+def generate_flashcards(deck_id):
+    """
+    Generate flashcards from a file's content and add them at the end of a deck.
+
+    The completion is parsed on the server and all the cards are inserted in one transaction. With
+    ?stream=1, each card is inserted as soon as it is generated and sent as a "flashcard" server-sent
+    event, followed by "done", or "error" if the generation fails midway.
+
+    Completions are cached, unless the body sets "regenerate" to ask for new cards from the same file.
+    """
+    deck = FlashcardDeck.query.filter_by(id=deck_id, user_id=session["user_id"]).first()
+    if deck is None:
+        return jsonify({"error": "Flashcard deck not found"}), 404
+
+    data = request.json or {}
+    file = File.query.filter_by(id=data.get("fileId"), user_id=session["user_id"]).first()
+    if file is None:
+        return jsonify({"error": "File not found"}), 404
+    if file.content is None:
+        return jsonify({"error": "File content is still being extracted"}), 409
+    if file.content == "Error reading file":
+        return jsonify({"error": "File content not available"}), 400
+
+    try:
+        prompt = MULTIGEN_PROMPT + prompt_material(file)
+        cache = not data.get("regenerate")
+
+        if request.args.get("stream") == "1":
+            return stream_generated_flashcards(deck, stream_completion(prompt, cache=cache))
+
+        completion = complete(prompt, cache=cache)
+
+    except Exception as e:
+        return ai_error_response(e)
+
+    try:
+        flashcards = add_flashcards(deck, parse_flashcards(completion), session["user_id"])
+        db.session.flush()
+        # Serialized before the commit expires them, which would reload each one
+        flashcards_data = [serialize(flashcard, FLASHCARD_FIELDS) for flashcard in flashcards]
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"message": "Flashcards generated successfully", "flashcards": flashcards_data}), 201
+
+
+def stream_generated_flashcards(deck, chunks):
+    """Insert flashcards into a deck as their completion streams in, sending each one as a server-sent event."""
+    user_id = session["user_id"]
+
+    def insert_cards(cards):
+        flashcards = add_flashcards(deck, cards, user_id)
+        db.session.flush()
+        flashcards_data = [serialize(flashcard, FLASHCARD_FIELDS) for flashcard in flashcards]
+        db.session.commit()
+        return flashcards_data
+
+    def generate_events():
+        parser = FlashcardParser()
+        count = 0
+        try:
+            for text in chunks:
+                cards = parser.feed(text)
+                if cards:
+                    # Committed right away so a deck refreshed meanwhile already shows them
+                    for flashcard_data in insert_cards(cards):
+                        count += 1
+                        yield server_sent_event("flashcard", flashcard_data)
+
+            for flashcard_data in insert_cards(parser.close()):
+                count += 1
+                yield server_sent_event("flashcard", flashcard_data)
+
+        except Exception as e:
+            db.session.rollback()
+            yield server_sent_event("error", {"error": str(e)})
+            return
+
+        yield server_sent_event("done", {"count": count})
+
+    return event_stream_response(generate_events(), chunks)
+
+
 @login_required
 @app.route("/updateFlashcard/<flashcard_id>", methods=["POST"])
 def update_flashcard(flashcard_id):
-    flashcard = Flashcard.query.filter_by(id=flashcard_id).first()
     data = request.json
+    deferred = write_behind(Flashcard, data)
+    flashcard = Flashcard.query.filter_by(id=flashcard_id, user_id=session["user_id"]).first()
 
     if flashcard:
         try:
@@ -1070,16 +1558,21 @@ def update_flashcard(flashcard_id):
             if "definition" in data:
                 flashcard.definition = data["definition"].strip()
 
+            rebalance = None
             if "order" in data:
-                flashcard.order = data["order"]
+                rebalance = move_item(flashcard, int(data["order"]))
+
+            if deferred:
+                buffer_changes(flashcard)
             
             db.session.commit()
+            submit_queued(rebalance)
 
             flashcard_data = {
                 "id": flashcard.id,
                 "term": flashcard.term,
                 "definition": flashcard.definition,
-                "order": flashcard.order,
+                "order": item_position(flashcard),
                 "imagePath": flashcard.image_path,
             }
 
@@ -1112,15 +1605,22 @@ def upload_flashcard_image(flashcard_id):
         _, ext = os.path.splitext(filename)
 
         try:   
+            # Remove the previous image and its variants, which may have another extension
+            if flashcard.image_path:
+                remove_image(flashcard.image_path)
+
             # Save image to flashcards folder using flashcard_id as its name
             image_path = os.path.join(flashcards_folder, f"{flashcard_id}{ext}")
             image.save(image_path)
 
-            # Save image path to the flashcard database
+            # Save image path to the flashcard database, its smaller variants are generated in the background
             flashcard.image_path = image_path
+            job = Job(kind="flashcard_image_variants", user_id=flashcard.user_id, payload={"flashcard_id": flashcard.id})
+            db.session.add(job)
             db.session.commit()
+            submit_job(job.id)
 
-            return jsonify({"message": "Flashcard image uploaded successfully"}), 200
+            return jsonify({"message": "Flashcard image uploaded successfully", "job": serialize(job, JOB_FIELDS)}), 200
     
         except Exception as e:
             return jsonify({"error": str(e)}), 400
@@ -1129,13 +1629,38 @@ def upload_flashcard_image(flashcard_id):
         return jsonify({"error": "No image provided"}), 400
 
 
+@job_handler("flashcard_image_variants")
+def generate_flashcard_image_variants(job, progress):
+    """Generate the thumbnail and card size variants of a flashcard image."""
+    flashcard = db.session.get(Flashcard, job.payload["flashcard_id"])
+    if flashcard is None or flashcard.image_path is None: # flashcard or image deleted before the job ran
+        return
+
+    make_image_variants(flashcard.image_path, progress)
+
+
 @login_required
 @app.route("/getFlashcardImage/<flashcard_id>")
 def serve_image(flashcard_id):
+    """
+    Serve a flashcard image.
+
+    Query args:
+        size: "thumbnail", "card" or "original" (default). Until the variants are generated, the
+        original image is served.
+    """
     flashcard = db.session.get(Flashcard, flashcard_id)
 
-    if flashcard:
-        return send_file(flashcard.image_path)
+    if flashcard and flashcard.image_path:
+        size = request.args.get("size", "original")
+        if size != "original" and size not in IMAGE_VARIANTS:
+            return jsonify({"error": f"Size must be one of original, {', '.join(IMAGE_VARIANTS)}."}), 400
+
+        path = flashcard.image_path
+        if size != "original" and os.path.exists(variant_path(path, size)):
+            path = variant_path(path, size)
+
+        return send_stored_file(path)
     else:
         return jsonify({"error": "Image file not found"}), 404
 
@@ -1147,9 +1672,9 @@ def delete_image(flashcard_id):
 
     if flashcard:
         try:
-            # delete flashcard image from folder
+            # delete flashcard image and its variants from folder
             if flashcard.image_path:
-                os.remove(flashcard.image_path)
+                remove_image(flashcard.image_path)
 
             # reset image_path
             flashcard.image_path = None
@@ -1164,31 +1689,74 @@ def delete_image(flashcard_id):
         return jsonify({"error": "Flashcard not found"}), 404
 
 
+def submit_queued(job, delay=0):
+    """Submit a committed job returned by move_item, removal_job or patch_note, if any."""
+    if job is not None:
+        submit_job(job.id, delay)
+
+
+@job_handler("compact_note")
+def compact_note_patches(job, progress):
+    """Fold the patches logged for a note into its content."""
+    note = db.session.get(Note, job.payload["note_id"])
+    if note is not None: # note deleted before the job ran
+        compact_note(note)
+    progress(1, 1)
+
+
+@job_handler("remove_files")
+def remove_deleted_files(job, progress):
+    """Remove the images and stored content released by a deletion."""
+    remove_files(job.payload["paths"])
+    progress(1, 1)
+
+
+@job_handler("prune_tombstones", every=timedelta(days=1))
+def prune_tombstones(job, progress):
+    """Remove the tombstones no valid sync token can ask for anymore."""
+    expired_before = (datetime.now(timezone.utc) - SYNC_RETENTION).replace(tzinfo=None)
+    Tombstone.query.filter(Tombstone.deleted_at < expired_before).delete()
+    db.session.commit()
+    progress(1, 1)
+
+
+@job_handler("rebalance_order")
+def rebalance_ranks(job, progress):
+    """Spread the ranks of a deck's flashcards or a file's todos apart again."""
+    rebalance_job(job)
+    progress(1, 1)
+
+
+@app.route("/moveFlashcard/<flashcard_id>/<int:order>", methods=["POST"])
 @login_required
-@app.route("/deleteFlashcard/<flashcard_id>", methods=["POST"])
-def delete_flashcard(flashcard_id, batch_deletion=False):
-    flashcard = Flashcard.query.filter_by(id=flashcard_id).first()
+def move_flashcard(flashcard_id, order):
+    """Move a flashcard to a 1-based position in its deck"""
+    flashcard = Flashcard.query.filter_by(id=flashcard_id, user_id=session["user_id"]).first()
+    if flashcard is None:
+        return jsonify({"error": "Flashcard not found"}), 404
 
-    if flashcard:
-        # Save deck_id to extract remaining_flashcards later
-        deck_id = flashcard.deck_id
+    rebalance = move_item(flashcard, order)
+    db.session.commit()
+    submit_queued(rebalance)
 
-        # delete flashcard image from folder if it exists
-        if flashcard.image_path:
-            os.remove(flashcard.image_path)
+    return jsonify({
+        "message": "Flashcard moved successfully",
+        "flashcard": {"id": flashcard.id, "order": item_position(flashcard)},
+    }), 200
 
-        # delete flashcard from database
-        db.session.delete(flashcard)
 
-        if not batch_deletion:
-            # Update order of remaining flashcards in the same deck
-            remaining_flashcards = Flashcard.query.filter_by(deck_id=deck_id).order_by(Flashcard.order).all()
-            
-            for index, card in enumerate(remaining_flashcards):
-                card.order = index + 1
-                db.session.add(card)
-        
-            db.session.commit()
+@login_required
+@app.route("/deleteFlashcard/<flashcard_id>", methods=["POST"])
+def delete_flashcard(flashcard_id):
+    flashcard = Flashcard.query.filter_by(id=flashcard_id, user_id=session["user_id"]).first()
+
+    if flashcard:
+        # delete flashcard from database, the ranks of the remaining flashcards keep them in order.
+        # Its image and variants are removed in the background.
+        removed_paths = delete_items(Flashcard, flashcard.user_id, Flashcard.id == flashcard.id)
+        cleanup = removal_job(removed_paths, flashcard.user_id)
+        db.session.commit()
+        submit_queued(cleanup)
 
         return jsonify({"message": "Flashcard deleted successfully"}), 200
 
@@ -1201,17 +1769,18 @@ def delete_flashcard(flashcard_id, batch_deletion=False):
 def create_todo(file_id, order):
     try:
         new_todo = Todo(
-            order=order,
             content='',
             user_id=session["user_id"],
             file_id=file_id,
         )
+        rebalance = move_item(new_todo, int(order))
         db.session.add(new_todo)
         db.session.commit()
+        submit_queued(rebalance)
 
         todo_data = {
             "id": new_todo.id,
-            "order": new_todo.order,
+            "order": item_position(new_todo),
         }
 
         return jsonify({"message": "Todo created successfully", "todo": todo_data}), 200
@@ -1223,8 +1792,9 @@ def create_todo(file_id, order):
 @login_required
 @app.route("/updateTodo/<todo_id>", methods=["POST"])
 def update_todo(todo_id):
-    todo = Todo.query.filter_by(id=todo_id).first()
     data = request.json
+    deferred = write_behind(Todo, data)
+    todo = Todo.query.filter_by(id=todo_id, user_id=session["user_id"]).first()
 
     if todo:
         try:
@@ -1233,10 +1803,15 @@ def update_todo(todo_id):
                 todo.content = data["content"].strip()
             if "done" in data:
                 todo.done = data["done"]
+            rebalance = None
             if "order" in data:
-                todo.order = data["order"]
+                rebalance = move_item(todo, int(data["order"]))
+
+            if deferred:
+                buffer_changes(todo)
             
             db.session.commit()
+            submit_queued(rebalance)
 
             return jsonify({"message": "Todo updated successfully"}), 200
         
@@ -1247,25 +1822,29 @@ def update_todo(todo_id):
         return jsonify({"error": "Todo not found"}), 404
 
 
+@app.route("/moveTodo/<todo_id>/<int:order>", methods=["POST"])
+@login_required
+def move_todo(todo_id, order):
+    """Move a todo to a 1-based position in its file"""
+    todo = Todo.query.filter_by(id=todo_id, user_id=session["user_id"]).first()
+    if todo is None:
+        return jsonify({"error": "Todo not found"}), 404
+
+    rebalance = move_item(todo, order)
+    db.session.commit()
+    submit_queued(rebalance)
+
+    return jsonify({"message": "Todo moved successfully", "todo": {"id": todo.id, "order": item_position(todo)}}), 200
+
+
 @login_required
 @app.route("/deleteTodo/<todo_id>", methods=["POST"])
 def delete_todo(todo_id):
-    todo = Todo.query.filter_by(id=todo_id).first()
+    todo = Todo.query.filter_by(id=todo_id, user_id=session["user_id"]).first()
 
     if todo:
-        # Save file_id to extract remaining_todos later
-        file_id = todo.file_id
-
-        # delete todo from database
-        db.session.delete(todo)
-        db.session.commit()
-
-        # Update order of remaining todos
-        remaining_todos = Todo.query.filter_by(file_id=file_id).order_by(Todo.order).all()
-        
-        for index, item in enumerate(remaining_todos):
-            item.order = index + 1
-            db.session.add(item)
+        # delete todo from database, the ranks of the remaining todos keep them in order
+        delete_items(Todo, todo.user_id, Todo.id == todo.id)
         db.session.commit()
 
         return jsonify({"message": "Todo deleted successfully"}), 200
@@ -1274,5 +1853,49 @@ def delete_todo(todo_id):
         return jsonify({"error": "Todo not found"}), 404
 
 
+@app.route("/batch", methods=["POST"])
+@login_required
+def apply_batch():
+    """
+    Apply an ordered list of create, update and delete operations in one transaction.
+
+    Either every operation is applied or none is. See batch.Batch for the format of operations.
+    """
+    operations = (request.json or {}).get("operations")
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations must be a non-empty list"}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({"error": f"A batch holds at most {MAX_BATCH_OPERATIONS} operations"}), 400
+
+    # Buffered autosaves come before the operations
+    flush_writes()
+
+    batch = Batch(session["user_id"])
+    for index, operation in enumerate(operations):
+        try:
+            batch.apply(operation)
+        except BatchError as e:
+            db.session.rollback()
+            return jsonify({"error": e.message, "index": index}), e.status
+
+    # Serialized before committing, so the items are not loaded again once expired by the commit
+    results = batch.serialized_results()
+    cleanup = removal_job(batch.removed_paths, session["user_id"])
+    db.session.commit()
+
+    for job in [*batch.rebalances, cleanup]:
+        submit_queued(job)
+    for job in batch.compactions:
+        submit_queued(job, COMPACTION_DELAY)
+
+    return jsonify({"message": "Batch applied successfully", "results": results}), 200
+
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Fill the full-text search index again from every file, note and flashcard."""
+    rebuild_search_index()
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,303 @@
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, File, Subject, Project, Tag, Note, FlashcardDeck, Flashcard, Todo
+from helpers import generate_untitled_name
+from deletion import delete_items
+from ordering import move_item
+from patches import PatchError, patch_note, replace_note_content
+from serializers import (
+    serialize, SUBJECT_FIELDS, PROJECT_FIELDS, TAG_FIELDS, NOTE_FIELDS, DECK_FIELDS, FLASHCARD_FIELDS, TODO_FIELDS,
+)
+
+
+# Most operations accepted in one batch
+MAX_BATCH_OPERATIONS = 500
+
+
+class BatchError(Exception):
+    """An operation that cannot be applied, which fails its whole batch."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Batch:
+    """
+    Ordered create, update and delete operations applied for a user in one transaction.
+
+    Operations are dictionaries like {"op": "update", "type": "flashcard", "id": 3, "data": {"term": "x"}}.
+    A create can name its item with "ref", so later operations of the batch can refer to it as "$<ref>",
+    in "id" or in the parent ids of their data (fileId, deckId). Note updates take "content" or "patch"
+    with "baseVersion" in their data, as /updateNote does. Subjects, projects, tags and notes also take
+    "addProperty" and "removeProperty", which attach them to or detach them from the file given by
+    "fileId" in their data, as /addProperty and /removeProperty do.
+
+    Each operation is flushed before the next one runs, so it sees the operations before it, e.g. the
+    ranks of items moved earlier. Nothing is committed here: the caller queues the removal of
+    removed_paths and commits once every operation applied, then submits the jobs.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.refs = {}
+        self.rebalances = []  # rebalance_order jobs to submit once committed
+        self.compactions = []  # compact_note jobs to submit, with their delay, once committed
+        self.removed_paths = []  # images and content released by deletions, to remove once committed
+        self.results = []  # (result, item) per operation, items are serialized once all operations applied
+
+    def resolve(self, value):
+        """Return the id a "$<ref>" stands for, or the value itself."""
+        if isinstance(value, str) and value.startswith("$"):
+            if value[1:] not in self.refs:
+                raise BatchError(f"Unknown reference {value}")
+            return self.refs[value[1:]]
+        return value
+
+    def get(self, Model, id, required=True):
+        """Return an item of the user by its id or reference, None when no id is given and it is optional."""
+        id = self.resolve(id)
+        if id is None and not required:
+            return None
+
+        item = Model.query.filter_by(id=id, user_id=self.user_id).first() if id is not None else None
+        if item is None:
+            raise BatchError(f"{ITEM_NAMES[Model]} not found", 404)
+        return item
+
+    def move(self, item, position):
+        """Place an ordered item at a 1-based position, at the end when no position is given."""
+        if position is not None:
+            try:
+                position = int(position)
+            except (TypeError, ValueError):
+                raise BatchError("order must be an integer")
+
+        job = move_item(item, position)
+        if job is not None:
+            self.rebalances.append(job)
+
+    def apply(self, operation):
+        """Apply one operation, raising BatchError if it cannot be."""
+        if not isinstance(operation, dict):
+            raise BatchError("Operation must be an object")
+
+        op, item_type = operation.get("op"), operation.get("type")
+        handler = OPERATIONS.get(item_type, {}).get(op)
+        if handler is None:
+            raise BatchError(f"Unsupported operation {op} on {item_type}")
+
+        data = operation.get("data") or {}
+        if not isinstance(data, dict):
+            raise BatchError("data must be an object")
+
+        Model = MODELS[item_type]
+        try:
+            if op == "create":
+                item = handler(self, data)
+                db.session.add(item)
+                db.session.flush()
+                if operation.get("ref") is not None:
+                    self.refs[str(operation["ref"])] = item.id
+            else:
+                item = self.get(Model, operation.get("id"))
+                handler(self, item, data)
+                db.session.flush()
+
+        except IntegrityError as e:
+            if f"UNIQUE constraint failed: {Model.__tablename__}.name" in str(e.orig):
+                raise BatchError(f"{ITEM_NAMES[Model]} name already exists.")
+            raise BatchError(str(e.orig))
+        except PatchError as e:
+            raise BatchError(e.message, e.status)
+        except StaleDataError:
+            raise BatchError(f"{ITEM_NAMES[Model]} changed, try again", 409)
+
+        result = {"op": op, "type": item_type, "id": item.id, "status": 201 if op == "create" else 200}
+        self.results.append((result, item if op != "delete" else None))
+
+    def serialized_results(self):
+        """Return the result of each operation, with the final state of the items it created or updated."""
+        results = []
+        for result, item in self.results:
+            # Items deleted by a later operation are left out
+            if item is not None and inspect(item).persistent:
+                if isinstance(item, (Flashcard, Todo)):
+                    # Positions loaded with the item may have changed with later moves
+                    db.session.expire(item, ["position"])
+                fields, selected = SERIALIZED_FIELDS[result["type"]]
+                result = {**result, "item": serialize(item, fields, selected)}
+            results.append(result)
+        return results
+
+
+def text(data, key, default=""):
+    """Return a stripped string field of an operation's data."""
+    value = data.get(key, default)
+    if not isinstance(value, str):
+        raise BatchError(f"{key} must be a string")
+    return value.strip()
+
+
+def required_name(data):
+    name = text(data, "name")
+    if not name:
+        raise BatchError("Name can't be empty.")
+    return name
+
+
+def create_property(Model):
+    def create(batch, data):
+        item = Model(name=required_name(data), user_id=batch.user_id)
+        if "color" in data:
+            item.color = text(data, "color")
+        return item
+    return create
+
+
+def update_property(batch, item, data):
+    if "name" in data:
+        item.name = required_name(data)
+    if "color" in data:
+        item.color = text(data, "color")
+
+
+def create_note(batch, data):
+    file = batch.get(File, data.get("fileId"), required=False)
+    note = Note(
+        name=required_name(data) if "name" in data else generate_untitled_name('note'),
+        user_id=batch.user_id,
+        file_id=file.id if file else None,
+    )
+    if "content" in data:
+        note.content = data["content"]
+    return note
+
+
+def update_note(batch, note, data):
+    if "name" in data:
+        note.name = required_name(data)
+    if "content" in data:
+        replace_note_content(note, data["content"], data.get("baseVersion"))
+    elif "patch" in data:
+        job = patch_note(note, data["patch"], data.get("baseVersion"))
+        if job is not None:
+            batch.compactions.append(job)
+
+
+def create_deck(batch, data):
+    file = batch.get(File, data.get("fileId"), required=False)
+    return FlashcardDeck(
+        name=required_name(data) if "name" in data else generate_untitled_name('deck'),
+        user_id=batch.user_id,
+        file_id=file.id if file else None,
+    )
+
+
+def update_deck(batch, deck, data):
+    if "name" in data:
+        deck.name = required_name(data)
+
+
+def create_flashcard(batch, data):
+    deck = batch.get(FlashcardDeck, data.get("deckId"))
+    flashcard = Flashcard(
+        term=text(data, "term"),
+        definition=text(data, "definition"),
+        user_id=batch.user_id,
+        deck_id=deck.id,
+    )
+    batch.move(flashcard, data.get("order"))
+    return flashcard
+
+
+def update_flashcard(batch, flashcard, data):
+    if "term" in data:
+        flashcard.term = text(data, "term")
+    if "definition" in data:
+        flashcard.definition = text(data, "definition")
+    if "order" in data:
+        batch.move(flashcard, data["order"])
+
+
+def create_todo(batch, data):
+    file = batch.get(File, data.get("fileId"))
+    todo = Todo(content=text(data, "content"), done=bool(data.get("done", False)), user_id=batch.user_id, file_id=file.id)
+    batch.move(todo, data.get("order"))
+    return todo
+
+
+def update_todo(batch, todo, data):
+    if "content" in data:
+        todo.content = text(data, "content")
+    if "done" in data:
+        todo.done = bool(data["done"])
+    if "order" in data:
+        batch.move(todo, data["order"])
+
+
+def add_file_property(batch, item, data):
+    batch.get(File, data.get("fileId")).add_property(item)
+
+
+def remove_file_property(batch, item, data):
+    batch.get(File, data.get("fileId")).remove_property(item)
+
+
+def delete_item(batch, item, data):
+    Model = type(item)
+    batch.removed_paths.extend(delete_items(Model, batch.user_id, Model.id == item.id))
+
+
+def delete_property(batch, item, data):
+    # Through the ORM, which touches the files and notes that lose their subject, project or tag
+    db.session.delete(item)
+
+
+MODELS = {
+    "subject": Subject,
+    "project": Project,
+    "tag": Tag,
+    "note": Note,
+    "deck": FlashcardDeck,
+    "flashcard": Flashcard,
+    "todo": Todo,
+}
+
+ITEM_NAMES = {
+    File: "File",
+    Subject: "Subject",
+    Project: "Project",
+    Tag: "Tag",
+    Note: "Note",
+    FlashcardDeck: "Flashcard deck",
+    Flashcard: "Flashcard",
+    Todo: "Todo",
+}
+
+OPERATIONS = {
+    "subject": {"create": create_property(Subject), "update": update_property, "delete": delete_property,
+        "addProperty": add_file_property, "removeProperty": remove_file_property},
+    "project": {"create": create_property(Project), "update": update_property, "delete": delete_property,
+        "addProperty": add_file_property, "removeProperty": remove_file_property},
+    "tag": {"create": create_property(Tag), "update": update_property, "delete": delete_property,
+        "addProperty": add_file_property, "removeProperty": remove_file_property},
+    "note": {"create": create_note, "update": update_note, "delete": delete_item,
+        "addProperty": add_file_property, "removeProperty": remove_file_property},
+    "deck": {"create": create_deck, "update": update_deck, "delete": delete_item},
+    "flashcard": {"create": create_flashcard, "update": update_flashcard, "delete": delete_item},
+    "todo": {"create": create_todo, "update": update_todo, "delete": delete_item},
+}
+
+# Fields of the items returned in results, decks are returned without their flashcards
+SERIALIZED_FIELDS = {
+    "subject": (SUBJECT_FIELDS, None),
+    "project": (PROJECT_FIELDS, None),
+    "tag": (TAG_FIELDS, None),
+    "note": (NOTE_FIELDS, None),
+    "deck": (DECK_FIELDS, [name for name in DECK_FIELDS if name != "flashcards"]),
+    "flashcard": (FLASHCARD_FIELDS, None),
+    "todo": (TODO_FIELDS, None),
+}
@@ -0,0 +1,109 @@
+"""
+Measure the pdf text extraction throughput, in pages per second, against the previous sequential extraction.
+
+The previous extraction read the pages one after the other in the calling process and joined them with
+text += page.extract_text(). A generated pdf is extracted with it, then with extract_text_from_pdf with an
+empty page cache and again once its pages are cached. Run from flask-server:
+
+    python benchmarks/extraction_throughput.py [--pages 300] [--mode plain]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pypdf import PdfReader, PdfWriter  # noqa: E402
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject  # noqa: E402
+
+LINES_PER_PAGE = 50
+
+
+def write_pdf(path, page_count, rng):
+    """Write a pdf of page_count letter pages, each holding LINES_PER_PAGE lines of random words."""
+    words = ["cell", "membrane", "protein", "enzyme", "nucleus", "energy", "ribosome", "molecule", "gene", "acid"]
+    font = DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    })
+
+    writer = PdfWriter()
+    for page_number in range(page_count):
+        page = writer.add_blank_page(612, 792)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font}),
+        })
+        lines = [f"Page {page_number + 1}"] + [" ".join(rng.choices(words, k=12)) for line in range(LINES_PER_PAGE - 1)]
+        content = DecodedStreamObject()
+        content.set_data(("BT /F1 10 Tf 14 TL 50 760 Td " + " ".join(f"({line}) '" for line in lines) + " ET").encode())
+        page.replace_contents(content)
+
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def extract_text_sequentially(path):
+    """The extraction replaced by extract_text_from_pdf, kept as the baseline."""
+    reader = PdfReader(path)
+    text = ''
+    for page_num in range(reader.get_num_pages()):
+        text += reader.get_page(page_num).extract_text()
+    return text.strip()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--mode", default="plain")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # The app creates its database and sessions folder when imported, both go to a temporary folder
+    workdir = tempfile.mkdtemp(prefix="learnmate-benchmark-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'learnmate.db')}"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.chdir(workdir)
+    from app import app
+    from extraction import EXTRACTION_MODES, EXTRACTION_PROCESSES, PAGES_PER_TASK, extract_text_from_pdf
+
+    if args.mode not in EXTRACTION_MODES:
+        parser.error(f"mode must be one of {', '.join(EXTRACTION_MODES)}")
+
+    rng = random.Random(args.seed)
+    path = os.path.join(workdir, "document.pdf")
+    write_pdf(path, args.pages, rng)
+    # Extracted first so the process pool is started before timing
+    warm_up_path = os.path.join(workdir, "warm-up.pdf")
+    write_pdf(warm_up_path, PAGES_PER_TASK * 2, rng)
+
+    with app.app_context():
+        extract_text_from_pdf(warm_up_path, args.mode)
+
+        text, baseline = timed(extract_text_sequentially, path) if args.mode == "plain" else (None, None)
+        pages, cold = timed(extract_text_from_pdf, path, args.mode)
+        cached_pages, cached = timed(extract_text_from_pdf, path, args.mode)
+
+    assert cached_pages == pages
+    if text is not None:
+        # Same text, apart from the separators the baseline did not put between pages
+        assert "".join(pages).split() == text.split()
+
+    print(f"{args.pages} pages, mode {args.mode}, {EXTRACTION_PROCESSES} extraction processes")
+    print(f"{'extraction':<24}{'seconds':>10}{'pages/s':>10}")
+    for label, seconds in [("sequential (baseline)", baseline), ("parallel, empty cache", cold), ("parallel, cached", cached)]:
+        if seconds is not None:
+            print(f"{label:<24}{seconds:>10.2f}{args.pages / seconds:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Measure the latency of /api/search queries on a corpus of files, notes and flashcards.
+
+The corpus is written to a temporary database through the ORM, so the search index is filled by the
+same incremental updates as the routes. Run from flask-server:
+
+    python benchmarks/search_latency.py [--documents 10000] [--runs 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Documents written per commit while building the corpus
+BATCH_SIZE = 500
+
+
+def vocabulary(size, rng):
+    """Return distinct made-up words, which the corpus uses with frequencies falling with their rank."""
+    syllables = ["ba", "ce", "di", "fo", "gu", "ka", "le", "mi", "no", "pu", "ra", "se", "ti", "vo", "zu"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(syllables, k=rng.randint(2, 4))))
+    return sorted(words, key=lambda word: rng.random())
+
+
+def sentence(words, weights, rng, length):
+    return " ".join(rng.choices(words, weights, k=length))
+
+
+def build_corpus(user_id, documents, words, rng):
+    """Add a user's files, notes and flashcards, in equal parts, returning the seconds spent indexing them."""
+    from models import db, File, Note, FlashcardDeck, Flashcard
+
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    deck = FlashcardDeck(name=f"benchmark deck of user {user_id}", user_id=user_id)
+    db.session.add(deck)
+
+    start = time.perf_counter()
+    for number in range(documents):
+        kind = number % 3
+        if kind == 0:
+            item = File(
+                name=f"file {number} of user {user_id}.pdf",
+                path=f"file {number}.pdf",
+                type="application/pdf",
+                user_id=user_id,
+            )
+            item.set_content([sentence(words, weights, rng, 150) for page in range(2)])
+        elif kind == 1:
+            blocks = [{"type": "paragraph", "data": {"text": sentence(words, weights, rng, 40)}} for block in range(3)]
+            item = Note(name=f"note {number} of user {user_id}", content={"blocks": blocks}, user_id=user_id)
+        else:
+            item = Flashcard(
+                term=sentence(words, weights, rng, 3),
+                definition=sentence(words, weights, rng, 20),
+                rank=float(number),
+                user_id=user_id,
+                deck=deck,
+            )
+        db.session.add(item)
+
+        if number % BATCH_SIZE == BATCH_SIZE - 1:
+            db.session.commit()
+    db.session.commit()
+    return time.perf_counter() - start
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=200, help="runs of each query")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # The app creates its database and sessions folder when imported, both go to a temporary folder
+    workdir = tempfile.mkdtemp(prefix="learnmate-benchmark-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'learnmate.db')}"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.chdir(workdir)
+    from app import app
+    from models import db, User
+
+    rng = random.Random(args.seed)
+    words = vocabulary(2000, rng)
+
+    with app.app_context():
+        user = User(username="benchmark", email="benchmark@example.com", password="password")
+        other = User(username="other", email="other@example.com", password="password")
+        db.session.add_all([user, other])
+        db.session.commit()
+        user_id = user.id
+
+        seconds = build_corpus(user_id, args.documents, words, rng)
+        # Another user's items, which searches must skip
+        build_corpus(other.id, args.documents // 10, words, rng)
+    print(f"Indexed {args.documents} documents in {seconds:.1f} s ({args.documents / seconds:.0f} documents/s)")
+
+    queries = {
+        "common word": words[0],
+        "uncommon word": words[200],
+        "rare word": words[1500],
+        "two words": f"{words[5]} {words[50]}",
+        "prefix": words[100][:3],
+        "no match": "zzzz",
+    }
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+    print(f"{'query':<15}{'results':>9}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for label, query in queries.items():
+        samples = []
+        for run in range(args.runs):
+            start = time.perf_counter()
+            response = client.get("/api/search", query_string={"query": query})
+            samples.append((time.perf_counter() - start) * 1000)
+        results = len(response.json["items"])
+        print(
+            f"{label:<15}{results:>9}{statistics.mean(samples):>10.2f}"
+            f"{percentile(samples, 0.5):>10.2f}{percentile(samples, 0.95):>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
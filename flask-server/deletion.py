@@ -0,0 +1,169 @@
+import os
+from datetime import datetime, timezone
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.orm.util import identity_key
+from models import db, Blob, File, FlashcardDeck, Flashcard, Todo, Note, Tombstone, Job, TRACKED_DELETIONS, bump_data_version
+from search import ITEM_TYPES as SEARCHED_MODELS, unindex_ids
+from typeahead import ITEM_TYPES as NAMED_MODELS, record_removals
+from storage import release_blobs
+from images import image_files
+from retrieval import unused_indexes
+from ordering import ORDERED_MODELS, parent_column, touch_parent
+from writebuffer import BUFFERED_FIELDS as BUFFERED_MODELS, discard_writes
+
+
+# Items deleted by the database with their parent (ON DELETE CASCADE), which have bookkeeping of their
+# own: parent model -> [(child model, foreign key column)]. File pages and tag links are left to the
+# database alone.
+CASCADES = {
+    File: [(Note, Note.file_id), (FlashcardDeck, FlashcardDeck.file_id), (Todo, Todo.file_id)],
+    FlashcardDeck: [(Flashcard, Flashcard.deck_id)],
+}
+
+
+def collect(Model, ids_query, removed):
+    """
+    Add the items selected by ids_query, and the items they cascade to, to removed.
+
+    removed maps each model to the (id, user_id) rows of its items and the query selecting their ids.
+    """
+    rows = db.session.execute(select(Model.id, Model.user_id).where(Model.id.in_(ids_query))).all()
+    if not rows:
+        return
+
+    removed[Model] = (rows, ids_query)
+    for Child, column in CASCADES.get(Model, []):
+        collect(Child, select(Child.id).where(column.in_(ids_query)), removed)
+
+
+def delete_items(Model, user_id, *criteria):
+    """
+    Delete a user's items matching criteria, with everything that belongs to them, in set-based statements.
+
+    The database cascades the delete of the items to their notes, decks, flashcards, todos, pages and tag
+    links. What the ORM flush listeners would do for each deleted object is done here for all of them at
+    once: tombstones, search index and autocomplete entries, data versions, blob reference counts and
+    updates left in the write-behind buffer.
+
+    Nothing is removed from disk, the paths returned are to be passed to removal_job. They include the
+    retrieval indexes of extracted texts no file has anymore.
+
+    Args:
+        Model (db.Model): File, FlashcardDeck, Flashcard, Todo or Note.
+        user_id (int): The owner of the items, others are never deleted.
+        *criteria: Conditions selecting the items, e.g. FlashcardDeck.id == deck_id.
+
+    Returns:
+        list of str: Paths of the images, stored content and retrieval indexes no longer used.
+    """
+    # Pending changes must be in the database before the items they may touch are selected
+    db.session.flush()
+
+    criteria = (Model.user_id == user_id, *criteria)
+    removed = {}
+    collect(Model, select(Model.id).where(*criteria), removed)
+    if not removed:
+        return []
+
+    now = datetime.now(timezone.utc)
+    tombstones = [
+        {"item_type": Removed.__tablename__, "item_id": item_id, "user_id": owner_id, "deleted_at": now}
+        for Removed, (rows, _) in removed.items() if Removed in TRACKED_DELETIONS
+        for item_id, owner_id in rows
+    ]
+    if tombstones:
+        db.session.execute(insert(Tombstone), tombstones)
+
+    connection = db.session.connection()
+    for Removed, (rows, _) in removed.items():
+        if Removed in SEARCHED_MODELS:
+            unindex_ids(connection, Removed, [item_id for item_id, _ in rows])
+        if Removed in NAMED_MODELS:
+            record_removals(db.session, Removed, rows)
+
+    paths = []
+    if Flashcard in removed:
+        _, flashcard_ids = removed[Flashcard]
+        for image_path in db.session.scalars(
+            select(Flashcard.image_path).where(Flashcard.id.in_(flashcard_ids), Flashcard.image_path.isnot(None))
+        ):
+            paths.extend(image_files(image_path))
+    if Model is File:
+        released_blobs, owned_paths = unreference_blobs(criteria)
+        paths.extend(owned_paths)
+        indexed_texts = db.session.scalars(
+            select(File.content_hash).where(*criteria, File.content_hash.isnot(None)).distinct()
+        ).all()
+
+    # Siblings of deleted flashcards or todos changed position
+    if Model in ORDERED_MODELS:
+        for parent_id in db.session.scalars(select(parent_column(Model)).where(*criteria).distinct()):
+            touch_parent(Model, parent_id)
+
+    bump_data_version(db.session, {owner_id for rows, _ in removed.values() for _, owner_id in rows})
+
+    db.session.execute(delete(Model).where(*criteria).execution_options(synchronize_session=False))
+
+    # Only once no file references them
+    if Model is File:
+        paths.extend(release_blobs(db.session, released_blobs))
+        paths.extend(unused_indexes(indexed_texts))
+
+    # Objects of the deleted rows loaded in the session must not be flushed or served again, nor their
+    # buffered updates written
+    for Removed, (rows, _) in removed.items():
+        if Removed in BUFFERED_MODELS:
+            discard_writes(Removed, [item_id for item_id, _ in rows])
+        for item_id, _ in rows:
+            item = db.session.identity_map.get(identity_key(Removed, item_id))
+            if item is not None:
+                db.session.expunge(item)
+
+    return paths
+
+
+def unreference_blobs(criteria):
+    """
+    Decrement the reference counts of the blobs of the files about to be deleted.
+
+    Returns:
+        tuple: (hashes of the blobs to release once the files are deleted, paths of the files' own copies)
+    """
+    counts = db.session.execute(
+        select(File.blob_hash, func.count()).where(*criteria, File.blob_hash.isnot(None)).group_by(File.blob_hash)
+    ).all()
+    if counts:
+        db.session.execute(
+            update(Blob.__table__)
+            .where(Blob.hash == bindparam("digest"))
+            .values(ref_count=Blob.ref_count - bindparam("count")),
+            [{"digest": digest, "count": count} for digest, count in counts],
+        )
+
+    # Files uploaded before the blob store own their copy
+    paths = db.session.scalars(select(File.path).where(*criteria, File.blob_hash.is_(None))).all()
+    return [digest for digest, _ in counts], paths
+
+
+def removal_job(paths, user_id):
+    """
+    Queue the removal of files from disk, once the deletion that released them is committed.
+
+    Returns:
+        Job or None: The new job, to submit once committed.
+    """
+    if not paths:
+        return None
+
+    job = Job(kind="remove_files", user_id=user_id, payload={"paths": list(paths)})
+    db.session.add(job)
+    return job
+
+
+def remove_files(paths):
+    """Remove files from disk, ignoring the ones that are already gone."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,138 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pypdf import PdfReader
+from models import db, PageTextCache
+
+
+# Number of characters per stored page for files without pages of their own (text, code, data...)
+TEXT_PAGE_SIZE = 16384
+
+# pypdf options of each extraction mode
+EXTRACTION_MODES = {
+    "plain": {},
+    # extract text in a fixed width format that closely adheres to the rendered layout in the source pdf
+    "layout": {"extraction_mode": "layout"},
+    # extract text preserving horizontal positioning without excess vertical whitespace (removes blank and "whitespace only" lines)
+    "layout_compact": {"extraction_mode": "layout", "layout_mode_space_vertically": False},
+    # adjust horizontal spacing
+    "layout_scaled": {"extraction_mode": "layout", "layout_mode_scale_weight": 1.0},
+    # include text rotated w.r.t. the page
+    "layout_rotated": {"extraction_mode": "layout", "layout_mode_strip_rotated": False},
+}
+
+# Pages extracted per task sent to the process pool. Documents with fewer missing pages are
+# extracted in the calling process, where starting a pool would cost more than it saves.
+PAGES_PER_TASK = 16
+
+EXTRACTION_PROCESSES = os.cpu_count() or 1
+
+# Created on first use. Workers are spawned rather than forked because extraction is requested from
+# threads of the job worker pool.
+process_pool = None
+
+
+def get_process_pool():
+    """Return the process pool used to extract pages in parallel."""
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(
+            max_workers=EXTRACTION_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return process_pool
+
+
+def document_hash(path):
+    """Return the sha256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_page_range(path, start, end, mode):
+    """Extract the text of pages [start, end) of a pdf. Runs in pool worker processes."""
+    reader = PdfReader(path)
+    options = EXTRACTION_MODES[mode]
+    return start, [reader.get_page(page_num).extract_text(**options) for page_num in range(start, end)]
+
+
+def page_ranges(page_numbers):
+    """Group sorted page numbers into [start, end) ranges of consecutive pages, at most PAGES_PER_TASK long."""
+    ranges = []
+    for page_num in page_numbers:
+        if ranges and ranges[-1][1] == page_num and ranges[-1][1] - ranges[-1][0] < PAGES_PER_TASK:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([page_num, page_num + 1])
+    return ranges
+
+
+def split_text_into_pages(text):
+    """Split plain text into pages of TEXT_PAGE_SIZE characters."""
+    return [text[start:start + TEXT_PAGE_SIZE] for start in range(0, len(text), TEXT_PAGE_SIZE)]
+
+
+def extract_text_from_pdf(path, mode="plain", progress=None, digest=None):
+    """
+    Extract the text of each page of a pdf, stripping whitespace around the whole document.
+
+    Pages already extracted from the same document with the same mode are read from the page cache.
+    The others are spread across a process pool in ranges of consecutive pages and cached.
+
+    Args:
+        path (str): Path of the pdf.
+        mode (str): One of EXTRACTION_MODES.
+        progress (callable, optional): Called with (pages done, total pages) as pages are extracted.
+        digest (str, optional): The sha256 of the pdf, when already known. Computed otherwise.
+
+    Returns:
+        list of str: The text of each page.
+    """
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown extraction mode {mode}")
+
+    digest = digest or document_hash(path)
+    page_count = PdfReader(path).get_num_pages()
+
+    pages = [None] * page_count
+    for cached_page in PageTextCache.query.filter_by(document_hash=digest, mode=mode):
+        if cached_page.page_number < page_count:
+            pages[cached_page.page_number] = cached_page.text
+
+    missing = [page_num for page_num, text in enumerate(pages) if text is None]
+    done = page_count - len(missing)
+    if progress:
+        progress(done, page_count)
+
+    if len(missing) <= PAGES_PER_TASK:
+        results = (extract_page_range(path, start, end, mode) for start, end in page_ranges(missing))
+    else:
+        pool = get_process_pool()
+        results = (
+            future.result() for future in as_completed([
+                pool.submit(extract_page_range, path, start, end, mode)
+                for start, end in page_ranges(missing)
+            ])
+        )
+
+    for start, texts in results:
+        pages[start:start + len(texts)] = texts
+        db.session.add_all(
+            PageTextCache(document_hash=digest, mode=mode, page_number=start + offset, text=text)
+            for offset, text in enumerate(texts)
+        )
+        done += len(texts)
+        if progress:
+            progress(done, page_count)
+
+    db.session.commit()
+
+    if pages:
+        pages[0] = pages[0].lstrip()
+        pages[-1] = pages[-1].rstrip()
+
+    return pages
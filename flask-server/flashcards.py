@@ -0,0 +1,113 @@
+import re
+from models import db, Flashcard
+from ordering import append_ranks
+
+
+# Start of the front and back of a card in the "F: <Front>\nB: <Back>" format the model is asked for,
+# tolerating list markers and Markdown emphasis the model sometimes adds around the labels
+SIDE_LABEL = re.compile(r"^\s*(?:[-*]\s+|\d+[.)]\s+)?(?:\*\*|__)?([FB])\s*:\s*(?:\*\*|__)?\s*", re.IGNORECASE)
+
+
+class FlashcardParser:
+    """
+    Incremental parser of generated flashcards.
+
+    Text is fed as it arrives, possibly cut mid-line. A card is complete once the front of the next card
+    starts, or when the text ends. Cards missing a front or a back are dropped.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.front = None
+        self.back = None
+
+    def feed(self, text):
+        """Add text to the parser, returning the (front, back) of the cards it completes."""
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        cards = []
+        for line in lines:
+            card = self.parse_line(line)
+            if card:
+                cards.append(card)
+        return cards
+
+    def close(self):
+        """End the text, returning the (front, back) of the cards still pending."""
+        cards = self.feed("\n")
+        card = self.take_card()
+        if card:
+            cards.append(card)
+        return cards
+
+    def parse_line(self, line):
+        match = SIDE_LABEL.match(line)
+        if match is None:
+            # Continuation of the side being read, text before the first card is ignored
+            if self.back is not None:
+                self.back.append(line)
+            elif self.front is not None:
+                self.front.append(line)
+            return None
+
+        text = line[match.end():]
+        if match.group(1).upper() == "B" and self.front is not None and self.back is None:
+            self.back = [text]
+            return None
+
+        card = self.take_card()
+        if match.group(1).upper() == "F":
+            self.front = [text]
+        return card
+
+    def take_card(self):
+        front = "\n".join(self.front or []).strip()
+        back = "\n".join(self.back or []).strip()
+        self.front = self.back = None
+        return (front, back) if front and back else None
+
+
+def parse_flashcards(text):
+    """Parse a whole generated text into the (front, back) of its cards, in order."""
+    parser = FlashcardParser()
+    return parser.feed(text) + parser.close()
+
+
+def add_flashcards(deck, cards, user_id):
+    """
+    Add cards at the end of a deck, in order, writing no other card.
+
+    The database allocates the ids. The ORM inserts the cards with insertmanyvalues sorted by parameter
+    order, so each card gets its own id back: in batches on backends that can match the rows RETURNING
+    gives back to the parameters, one statement per card on SQLite.
+
+    Args:
+        deck (FlashcardDeck): The deck the cards are added to.
+        cards (list of tuple): The (front, back) of each card.
+        user_id (int): The owner of the cards.
+
+    Returns:
+        list of Flashcard: The new flashcards.
+    """
+    if not cards:
+        return []
+
+    ranks = append_ranks(Flashcard, deck.id, len(cards))
+    first_position = Flashcard.query.filter_by(deck_id=deck.id).count() + 1
+
+    flashcards = [
+        Flashcard(
+            term=front,
+            definition=back,
+            rank=rank,
+            user_id=user_id,
+            deck_id=deck.id,
+        )
+        for (front, back), rank in zip(cards, ranks)
+    ]
+    # Known positions spare serializing the cards a count query each
+    for offset, flashcard in enumerate(flashcards):
+        flashcard.position = first_position + offset
+
+    db.session.add_all(flashcards)
+    return flashcards
@@ -1,7 +1,12 @@
+from collections import OrderedDict
 from functools import wraps
-from flask import session, jsonify
-from models import User, Note, FlashcardDeck
+from flask import current_app, session, jsonify, request, make_response, send_file
+from models import db, User, Note, FlashcardDeck
+from writebuffer import buffered_generation
+import hashlib
+import os
 import re
+import threading
 
 
 def login_required(f):
@@ -33,6 +38,143 @@ def logout_required(f):
     return decorated_function
 
 
+# Last rendered /data payload per user, keyed by ETag. Least recently used users fall out once the
+# payloads add up to more than PAYLOAD_CACHE_BYTES.
+PAYLOAD_CACHE_BYTES = 64 * 1024 * 1024
+payload_cache = OrderedDict()
+payload_cache_lock = threading.Lock()
+payload_cache_bytes = 0
+
+
+def cache_payload(user_id, etag, body, mimetype):
+    """Keep the payload rendered for a user, evicting the least recently used ones over PAYLOAD_CACHE_BYTES."""
+    global payload_cache_bytes
+    if len(body) > PAYLOAD_CACHE_BYTES:
+        return
+
+    with payload_cache_lock:
+        previous = payload_cache.pop(user_id, None)
+        if previous is not None:
+            payload_cache_bytes -= len(previous[1])
+
+        payload_cache[user_id] = (etag, body, mimetype)
+        payload_cache_bytes += len(body)
+        while payload_cache_bytes > PAYLOAD_CACHE_BYTES:
+            _, (_, evicted, _) = payload_cache.popitem(last=False)
+            payload_cache_bytes -= len(evicted)
+
+
+def cached_payload(user_id, etag):
+    """Return the (body, mimetype) cached for a user if it was rendered for this ETag, else None."""
+    with payload_cache_lock:
+        cached = payload_cache.get(user_id)
+        if cached is None or cached[0] != etag:
+            return None
+        payload_cache.move_to_end(user_id)
+        return cached[1], cached[2]
+
+
+def conditional_on_data_version(f=None, *, cache=False):
+    """
+    Decorates read routes to support conditional requests based on the user's data version.
+
+    The route gets a strong ETag derived from the user's data version, the number of their updates that
+    went through the write-behind buffer and the request path. Requests whose If-None-Match matches are
+    answered with 304 without running the route.
+
+    Args:
+        cache (bool): Whether to keep the last payload rendered for each user in memory and serve it while
+            the version has not changed. Only the request without query args is cached, so each user has
+            at most one entry.
+    """
+    if f is None:
+        return lambda f: conditional_on_data_version(f, cache=cache)
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user_id = session.get("user_id")
+        if user_id is None:
+            return f(*args, **kwargs)
+
+        data_version = db.session.query(User.data_version).filter_by(id=user_id).scalar()
+        buffered = buffered_generation(user_id)
+        etag = hashlib.sha256(f"{user_id}:{data_version}:{buffered}:{request.full_path}".encode()).hexdigest()
+        cacheable = cache and not request.args
+
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+
+        elif cacheable and (cached := cached_payload(user_id, etag)) is not None:
+            body, mimetype = cached
+            response = make_response(body, 200)
+            response.mimetype = mimetype
+
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            if cacheable and not response.is_streamed:
+                cache_payload(user_id, etag, response.get_data(), response.mimetype)
+
+        response.set_etag(etag)
+        # Let clients keep the payload but revalidate it on every use
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+    return decorated_function
+
+
+# How long clients keep files served under a URL that always returns the same bytes
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60  # one year
+
+
+def send_stored_file(path, mimetype=None, download_name=None, etag=None, immutable=False):
+    """
+    Send a stored file with validators and byte-range support, so clients can cache it and seek through it.
+
+    Args:
+        path (str): Path of the file, relative to the app folder like the stored paths.
+        mimetype (str, optional): Type of the file. Guessed from the path by default.
+        download_name (str, optional): Name the client should give the file. The path's by default.
+        etag (str, optional): Strong ETag of the content, e.g. its hash. Derived from the file's
+            modification time and size by default.
+        immutable (bool): Whether the requested URL always returns these bytes, in which case clients
+            keep them for a year without revalidating. Otherwise they revalidate on every use.
+
+    Returns:
+        Response: The file, the requested range of it or a 304. When SENDFILE_MODE is set, the body is
+        left to the front proxy, which reads the file (and serves ranges) from the X-Sendfile path or
+        the X-Accel-Redirect location.
+    """
+    mode = current_app.config.get("SENDFILE_MODE")
+
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        download_name=download_name,
+        etag=etag or True,
+        max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        conditional=mode is None,
+    )
+
+    if mode is not None:
+        # Only answer 304s here, ranges are served by the proxy from the file itself
+        response = response.make_conditional(request)
+
+        if mode == "x-accel-redirect":
+            uploads_folder = os.path.join(current_app.root_path, current_app.config["UPLOADED_FILES_DEST"])
+            location = os.path.relpath(response.headers.pop("X-Sendfile"), uploads_folder).replace(os.sep, "/")
+            response.headers["X-Accel-Redirect"] = current_app.config["SENDFILE_PREFIX"].rstrip("/") + "/" + location
+
+    # Uploads belong to one user, keep them out of shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.immutable = True
+
+    return response
+
+
 def generate_untitled_name(item_type):
     """
     Generate a unique untitled name for a given item type (e.g., note, flashcard).
@@ -0,0 +1,64 @@
+import os
+from PIL import Image, ImageOps
+
+
+# Variants generated for each flashcard image: name -> longest side in pixels.
+# The uploaded image itself is kept and served as the "original" variant.
+IMAGE_VARIANTS = {
+    "thumbnail": 256,
+    "card": 1024,
+}
+
+VARIANT_FORMAT = "WEBP"
+VARIANT_EXTENSION = ".webp"
+VARIANT_QUALITY = 80
+
+
+def variant_path(image_path, variant):
+    """Return the path of a variant of an image, next to the image itself."""
+    root, _ = os.path.splitext(image_path)
+    return f"{root}_{variant}{VARIANT_EXTENSION}"
+
+
+def image_files(image_path):
+    """Return the paths of an image and of its variants."""
+    return (image_path, *(variant_path(image_path, variant) for variant in IMAGE_VARIANTS))
+
+
+def make_image_variants(image_path, progress=None):
+    """
+    Generate the resized variants of an image.
+
+    Each variant is written to a temporary file then moved into place, so readers never see a partial
+    image. Images smaller than a variant are re-encoded without being enlarged.
+
+    Args:
+        image_path (str): Path of the uploaded image.
+        progress (callable, optional): Called with (variants done, total variants).
+    """
+    with Image.open(image_path) as image:
+        # Apply the camera orientation, which is lost once the metadata is dropped
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+
+        for done, (variant, max_side) in enumerate(IMAGE_VARIANTS.items(), start=1):
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+            path = variant_path(image_path, variant)
+            temporary_path = f"{path}.tmp"
+            resized.save(temporary_path, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+            os.replace(temporary_path, path)
+
+            if progress:
+                progress(done, len(IMAGE_VARIANTS))
+
+
+def remove_image(image_path):
+    """Remove an image and its variants, ignoring the ones that do not exist."""
+    for path in image_files(image_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,213 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, or_, select, update
+from models import db, Job
+
+
+logger = logging.getLogger(__name__)
+
+# Number of jobs run concurrently by the local worker pool
+JOB_WORKERS = 4
+
+# Delay before retrying a failed job, doubled after each attempt
+RETRY_DELAY = 2  # seconds
+
+# A job is claimed by a process for LEASE_DURATION, renewed every HEARTBEAT_INTERVAL while it runs. Once
+# its lease expired, the process running it is taken for dead and any other process runs it again, so
+# several server processes can share the queue. Pending jobs left alone for as long were queued by a
+# process that died before running them.
+LEASE_DURATION = timedelta(seconds=60)
+HEARTBEAT_INTERVAL = 20  # seconds
+
+# Registered job kinds: kind -> (handler, on_failure)
+handlers = {}
+
+# Kinds of the maintenance jobs queued periodically: kind -> interval
+periodic_jobs = {}
+
+executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+flask_app = None
+
+# Owner of the leases of this process, set once it serves its first request (after forking, if the
+# server forks its workers)
+worker_id = None
+worker_lock = threading.Lock()
+
+# Ids of the jobs running in this process, whose leases the heartbeat renews
+running_jobs = set()
+running_jobs_lock = threading.Lock()
+
+
+def job_handler(kind, on_failure=None, every=None):
+    """
+    Decorates a function to run jobs of the given kind.
+
+    The handler is called with the job and a progress(done, total) callback. When it raises, the job is
+    retried until it runs out of attempts, then on_failure(job) is called if given.
+
+    With every (a timedelta), the heartbeat also queues a job of this kind, without user, whenever none
+    was queued in that long.
+    """
+    def decorator(f):
+        handlers[kind] = (f, on_failure)
+        if every is not None:
+            periodic_jobs[kind] = every
+        return f
+    return decorator
+
+
+def init_jobs(app):
+    """
+    Run the jobs of an app in a local worker pool.
+
+    Nothing is queried here, so the app can be imported before its database is migrated: the heartbeat
+    resuming the jobs left by stopped processes starts with the first request.
+    """
+    global flask_app
+    flask_app = app
+    app.before_request(start_worker)
+
+
+def start_worker():
+    """Start the heartbeat of this process, once."""
+    global worker_id
+    with worker_lock:
+        if worker_id is not None:
+            return
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    threading.Thread(target=heartbeat, name="job-heartbeat", daemon=True).start()
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def heartbeat():
+    """Renew the leases of the jobs running in this process and resume the jobs of dead ones, periodically."""
+    while True:
+        try:
+            with flask_app.app_context():
+                renew_leases()
+                resume_jobs()
+                queue_periodic_jobs()
+        except Exception:
+            logger.exception("Job heartbeat failed")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def renew_leases():
+    with running_jobs_lock:
+        job_ids = list(running_jobs)
+    if job_ids:
+        db.session.execute(
+            update(Job)
+            .where(Job.id.in_(job_ids), Job.owner == worker_id)
+            .values(lease_expires_at=utcnow() + LEASE_DURATION)
+        )
+        db.session.commit()
+
+
+def resume_jobs():
+    """Queue the jobs whose lease expired and the pending jobs nobody ran for a whole lease."""
+    now = utcnow()
+    expired = db.session.scalars(
+        update(Job)
+        .where(Job.status == "running", or_(Job.lease_expires_at.is_(None), Job.lease_expires_at < now))
+        .values(status="pending", owner=None, lease_expires_at=None)
+        .returning(Job.id)
+    ).all()
+    forgotten = db.session.scalars(
+        select(Job.id).where(Job.status == "pending", Job.modified_at < now - LEASE_DURATION)
+    ).all()
+    db.session.commit()
+
+    for job_id in {*expired, *forgotten}:
+        submit_job(job_id)
+
+
+def queue_periodic_jobs():
+    """Queue the periodic jobs not queued for their whole interval."""
+    now = utcnow()
+    for kind, interval in periodic_jobs.items():
+        last_queued = db.session.scalar(select(func.max(Job.created_at)).where(Job.kind == kind))
+        if last_queued is not None and last_queued > now - interval:
+            continue
+
+        # Several processes may queue the same run, periodic jobs do nothing the second time
+        job = Job(kind=kind)
+        db.session.add(job)
+        db.session.commit()
+        submit_job(job.id)
+
+
+def submit_job(job_id, delay=0):
+    """Queue a committed job for the worker pool, optionally after a delay in seconds."""
+    if delay:
+        timer = threading.Timer(delay, submit_job, args=(job_id,))
+        timer.daemon = True
+        timer.start()
+    else:
+        executor.submit(run_job, job_id)
+
+
+def run_job(job_id):
+    """Claim a pending job and run its handler, recording progress, retries and the outcome."""
+    with flask_app.app_context():
+        # Claim the job atomically so it only runs once even if it was queued twice, or by several processes
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "pending")
+            .values(
+                status="running",
+                attempts=Job.attempts + 1,
+                owner=worker_id,
+                lease_expires_at=utcnow() + LEASE_DURATION,
+            )
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+
+        with running_jobs_lock:
+            running_jobs.add(job_id)
+        job = db.session.get(Job, job_id)
+        handler, on_failure = handlers[job.kind]
+
+        def progress(done, total):
+            job.progress = done
+            job.total = total
+            db.session.commit()
+
+        try:
+            handler(job, progress)
+            job.status = "done"
+            job.error = None
+            db.session.commit()
+
+        except Exception as e:
+            logger.exception("Job %s (%s) failed on attempt %s", job.id, job.kind, job.attempts)
+            db.session.rollback()
+
+            job.error = str(e)
+            if job.attempts < job.max_attempts:
+                job.status = "pending"
+                db.session.commit()
+                submit_job(job.id, RETRY_DELAY * 2 ** (job.attempts - 1))
+            else:
+                job.status = "failed"
+                if on_failure:
+                    on_failure(job)
+                db.session.commit()
+
+        finally:
+            with running_jobs_lock:
+                running_jobs.discard(job_id)
+            db.session.remove()
+
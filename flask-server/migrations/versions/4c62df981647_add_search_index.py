@@ -0,0 +1,86 @@
+"""Add the full-text search index
+
+Revision ID: 4c62df981647
+Revises: 1d0f658fd97d
+Create Date: 2026-10-18 03:52:10.418733
+
+"""
+import copy
+import itertools
+import json
+from alembic import op
+import sqlalchemy as sa
+from models import File, Note, Flashcard
+from patches import PatchError, apply_patch
+from search import ITEM_TYPES, SEARCH_TABLE, create_search_index, item_rowid, note_text
+
+
+# revision identifiers, used by Alembic.
+revision = '4c62df981647'
+down_revision = '1d0f658fd97d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    # The app creates the index empty when it starts, fill it whether it exists or not
+    create_search_index(connection)
+    connection.execute(sa.text(f"DELETE FROM {SEARCH_TABLE}"))
+
+    # Read with SQL rather than the models, whose columns may not match the tables of this revision
+    rows = []
+
+    def add_row(Model, item_id, title, body, user_id, file_id):
+        rows.append({
+            "rowid": item_rowid(Model, item_id),
+            "title": title,
+            "body": body,
+            "owner": f"u{user_id}",
+            "item_type": ITEM_TYPES[Model][1],
+            "item_id": item_id,
+            "file_id": file_id,
+        })
+
+    pages = connection.execute(sa.text("SELECT file_id, text FROM file_page ORDER BY file_id, number"))
+    texts = {
+        file_id: "".join(page.text for page in file_pages)
+        for file_id, file_pages in itertools.groupby(pages, key=lambda page: page.file_id)
+    }
+    for file in connection.execute(sa.text("SELECT id, name, user_id FROM file")):
+        add_row(File, file.id, file.name, texts.get(file.id, ""), file.user_id, file.id)
+
+    # Notes are indexed with the patches still in their log applied, as patches.note_content does
+    patches = connection.execute(sa.text("SELECT note_id, operations FROM note_patch ORDER BY note_id, version"))
+    logs = {
+        note_id: [json.loads(patch.operations) for patch in note_patches]
+        for note_id, note_patches in itertools.groupby(patches, key=lambda patch: patch.note_id)
+    }
+    for note in connection.execute(sa.text("SELECT id, name, content, user_id, file_id FROM note")):
+        content = json.loads(note.content) if note.content else {}
+        try:
+            for operations in logs.get(note.id, []):
+                content = apply_patch(copy.deepcopy(content), operations)
+        except PatchError:
+            content = json.loads(note.content) if note.content else {}
+        add_row(Note, note.id, note.name, note_text(content), note.user_id, note.file_id)
+
+    flashcards = connection.execute(sa.text(
+        "SELECT flashcard.id, term, definition, flashcard.user_id, deck.file_id "
+        "FROM flashcard LEFT JOIN deck ON deck.id = flashcard.deck_id"
+    ))
+    for flashcard in flashcards:
+        add_row(Flashcard, flashcard.id, flashcard.term, flashcard.definition, flashcard.user_id, flashcard.file_id)
+
+    if rows:
+        connection.execute(
+            sa.text(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, owner, item_type, item_id, file_id) "
+                "VALUES (:rowid, :title, :body, :owner, :item_type, :item_id, :file_id)"
+            ),
+            rows,
+        )
+
+
+def downgrade():
+    op.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
@@ -0,0 +1,79 @@
+"""Cascade deletes through foreign keys
+
+Revision ID: f0f4d6585e95
+Revises: c8a5ad17ca90
+Create Date: 2026-10-18 02:47:21.513786
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0f4d6585e95'
+down_revision = 'c8a5ad17ca90'
+branch_labels = None
+depends_on = None
+
+
+# The foreign keys were created unnamed, this names them when the tables are reflected so they can be dropped
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+# (column, referred table, ondelete) of the foreign keys changed, per table
+FOREIGN_KEYS = {
+    'deck': [('file_id', 'file', 'CASCADE')],
+    'file': [('subject_id', 'subject', 'SET NULL'), ('project_id', 'project', 'SET NULL')],
+    'file_page': [('file_id', 'file', 'CASCADE')],
+    'file_tag': [('file_id', 'file', 'CASCADE'), ('tag_id', 'tag', 'CASCADE')],
+    'flashcard': [('deck_id', 'deck', 'CASCADE')],
+    'job': [('file_id', 'file', 'SET NULL')],
+    'note': [('file_id', 'file', 'CASCADE'), ('subject_id', 'subject', 'SET NULL'), ('project_id', 'project', 'SET NULL')],
+    'note_tag': [('note_id', 'note', 'CASCADE'), ('tag_id', 'tag', 'CASCADE')],
+    'project_tag': [('project_id', 'project', 'CASCADE'), ('tag_id', 'tag', 'CASCADE')],
+    'subject_tag': [('subject_id', 'subject', 'CASCADE'), ('tag_id', 'tag', 'CASCADE')],
+    'todo': [('file_id', 'file', 'CASCADE')],
+}
+
+# Foreign key columns indexed so cascades do not scan the referencing table for each deleted row
+# (flashcard.deck_id, todo.file_id and file_page.file_id are already)
+INDEXED_COLUMNS = {
+    'deck': ['file_id'],
+    'file': ['project_id', 'subject_id'],
+    'file_tag': ['file_id', 'tag_id'],
+    'job': ['file_id'],
+    'note': ['file_id', 'project_id', 'subject_id'],
+    'note_tag': ['note_id', 'tag_id'],
+    'project_tag': ['project_id', 'tag_id'],
+    'subject_tag': ['subject_id', 'tag_id'],
+}
+
+
+def upgrade():
+    # Rows still pointing to items deleted while foreign keys were not enforced
+    for table, foreign_keys in FOREIGN_KEYS.items():
+        for column, referred, ondelete in foreign_keys:
+            orphaned = f"{column} IS NOT NULL AND {column} NOT IN (SELECT id FROM {referred})"
+            if ondelete == 'CASCADE':
+                op.execute(f"DELETE FROM {table} WHERE {orphaned}")
+            else:
+                op.execute(f"UPDATE {table} SET {column} = NULL WHERE {orphaned}")
+
+    for table, foreign_keys in FOREIGN_KEYS.items():
+        with op.batch_alter_table(table, schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+            for column in INDEXED_COLUMNS.get(table, []):
+                batch_op.create_index(batch_op.f(f'ix_{table}_{column}'), [column], unique=False)
+            for column, referred, ondelete in foreign_keys:
+                name = f'fk_{table}_{column}_{referred}'
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, referred, [column], ['id'], ondelete=ondelete)
+
+
+def downgrade():
+    for table, foreign_keys in FOREIGN_KEYS.items():
+        with op.batch_alter_table(table, schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+            for column, referred, ondelete in foreign_keys:
+                name = f'fk_{table}_{column}_{referred}'
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, referred, [column], ['id'])
+            for column in INDEXED_COLUMNS.get(table, []):
+                batch_op.drop_index(batch_op.f(f'ix_{table}_{column}'))
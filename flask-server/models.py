@@ -1,5 +1,10 @@
+import hashlib
+import sqlite3
 from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, query_expression
 
 # Initialize the SQLAlchemy database instance
 db = SQLAlchemy() 
@@ -11,12 +16,17 @@ class User(db.Model):
     email = db.Column(db.String(345), unique=True, nullable=False)
     password = db.Column(db.Text, nullable=False)
     joined_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
+
+    # Generation counter bumped by every flush that writes the user's data (see bump_data_versions)
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 class Tag(db.Model):
     """Tag model representing tags that can be associated with files, subjects, projects, and notes."""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     color = db.Column(db.String(50), default='#eae9ec')
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     
     # Foreign key to associate the tag with a user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -27,30 +37,145 @@ class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), unique=True, nullable=False)
     path = db.Column(db.String(255), nullable=False)
-    content = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    modified_at = db.Column(db.DateTime, onupdate=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     type = db.Column(db.String(100), nullable=False)
 
+    # Stored content of the file, shared by every file with the same bytes (files uploaded before the
+    # blob store have none and keep their own copy at path)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blob.hash'), index=True)
+    blob = db.relationship('Blob', backref=db.backref('files', lazy=True))
+
     # Foreign key to associate the file with a user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('files', lazy=True))
 
     # Relationships to optional Subject and Project models
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'))
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='SET NULL'), index=True)
     subject = db.relationship('Subject', backref=db.backref('files', lazy=True))
 
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='SET NULL'), index=True)
     project = db.relationship('Project', backref=db.backref('files', lazy=True))
 
     # Many-to-many relationship with Tag model
     tags = db.relationship('Tag', secondary='file_tag', backref=db.backref('files', lazy=True))
 
+    # Extracted text, stored out of row one page per FilePage so loading a File stays cheap
+    pages = db.relationship('FilePage', back_populates='file', lazy=True, order_by='FilePage.number', cascade='all, delete-orphan', passive_deletes=True)
+    # sha256 of the extracted text, set with the pages, which names the file's retrieval index (see retrieval.py)
+    content_hash = db.Column(db.String(64), index=True)
+
+    @property
+    def content(self):
+        """The full extracted text of the file, or None if nothing was extracted."""
+        if not self.pages:
+            return None
+        return "".join(page.text for page in self.pages)
+
+    def set_content(self, pages):
+        """
+        Replace the extracted text of the file.
+
+        Args:
+            pages (list of str): The extracted text of each page, in order.
+        """
+        # Existing pages are rewritten in place: new rows would be inserted before the old ones are deleted,
+        # clashing with them on (file_id, number)
+        existing = list(self.pages)
+        offset = 0
+        digest = hashlib.sha256()
+        for number, text in enumerate(pages, start=1):
+            if number <= len(existing):
+                page = existing[number - 1]
+                page.offset, page.length, page.text, page.token_count = offset, len(text), text, None
+            else:
+                self.pages.append(FilePage(number=number, offset=offset, length=len(text), text=text))
+            offset += len(text)
+            digest.update(text.encode())
+        del self.pages[len(pages):]
+        self.content_hash = digest.hexdigest()
+
+    def read_content(self, offset=0, length=None):
+        """
+        Read a slice of the extracted text, loading only the pages it overlaps.
+
+        Args:
+            offset (int): Character offset of the slice in the full text.
+            length (int, optional): Number of characters to read. Defaults to the rest of the text.
+
+        Returns:
+            str: The requested slice of the text.
+        """
+        query = FilePage.query.filter(
+            FilePage.file_id == self.id,
+            FilePage.offset + FilePage.length > offset,
+        )
+        if length is not None:
+            query = query.filter(FilePage.offset < offset + length)
+
+        pages = query.order_by(FilePage.number).all()
+        if not pages:
+            return ""
+
+        text = "".join(page.text for page in pages)
+        start = max(offset - pages[0].offset, 0)
+        return text[start:] if length is None else text[start:start + length]
+
+    def add_property(self, property):
+        """Attach a subject, project, tag or note to the file, replacing its subject or project."""
+        if isinstance(property, Subject):
+            self.subject = property
+        elif isinstance(property, Project):
+            self.project = property
+        elif isinstance(property, Tag):
+            if property not in self.tags:
+                self.tags.append(property)
+        elif isinstance(property, Note):
+            if property not in self.notes:
+                self.notes.append(property)
+
+    def remove_property(self, property):
+        """Detach a subject, project, tag or note from the file."""
+        if isinstance(property, Subject):
+            self.subject = None
+        elif isinstance(property, Project):
+            self.project = None
+        elif isinstance(property, Tag):
+            if property in self.tags:
+                self.tags.remove(property)
+        elif isinstance(property, Note):
+            if property in self.notes:
+                self.notes.remove(property)
+
+class FilePage(db.Model):
+    """FilePage model storing the extracted text of a file, one row per page."""
+    __tablename__ = 'file_page'
+    __table_args__ = (db.UniqueConstraint('file_id', 'number'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    number = db.Column(db.Integer, nullable=False)
+    offset = db.Column(db.Integer, nullable=False) # character offset of the page in the full text
+    length = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    token_count = db.Column(db.Integer) # counted when the page is first sent to the model
+
+    # Foreign key to associate the page with a file
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), nullable=False, index=True)
+    file = db.relationship('File', back_populates='pages')
+
+class Blob(db.Model):
+    """Blob model representing uploaded content stored once under its SHA-256, whatever the number of files using it."""
+    hash = db.Column(db.String(64), primary_key=True) # sha256 hex digest of the content
+    path = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0) # number of files using the blob
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
 class FileTag(db.Model):
     """Association model for many-to-many relationship between Files and Tags."""
     id = db.Column(db.Integer, primary_key=True)
-    file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=False)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), nullable=False)
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), nullable=False, index=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False, index=True)
 
 class Subject(db.Model):
     """Subject model representing subjects associated with a user."""
@@ -61,7 +186,7 @@ class Subject(db.Model):
     level = db.Column(db.String(50))
     progress = db.Column(db.Integer, db.CheckConstraint('progress >= 0 AND progress <= 100'), default=0)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    modified_at = db.Column(db.DateTime, onupdate=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
 
     # Foreign key to associate the subject with a user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -73,8 +198,8 @@ class Subject(db.Model):
 class SubjectTag(db.Model):
     """Association model for many-to-many relationship between Subjects and Tags."""
     id = db.Column(db.Integer, primary_key=True)
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='CASCADE'), nullable=False, index=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False, index=True)
 
 class Project(db.Model):
     """Project model representing projects associated with a user."""
@@ -82,7 +207,7 @@ class Project(db.Model):
     name = db.Column(db.String(255), unique=True, nullable=False)
     color = db.Column(db.String(50), default='#eae9ec')
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     progress = db.Column(db.Integer, db.CheckConstraint('progress >= 0 AND progress <= 100'), default=0)
     
     # Foreign key to associate the project with a user
@@ -95,39 +220,59 @@ class Project(db.Model):
 class ProjectTag(db.Model):
     """Association model for many-to-many relationship between Projects and Tags."""
     id = db.Column(db.Integer, primary_key=True)
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'), nullable=False, index=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False, index=True)
 
 class Note(db.Model):
     """Note model representing notes associated with users, files, subjects, and projects."""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), unique=True, nullable=False)
-    content = db.Column(db.JSON, default={})
+    content = db.Column(db.JSON, default={}) # snapshot, without the patches still in the log (see patches.py)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # bumped by every content change
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     
     # Foreign key to associate the note with a user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('notes', lazy=True))
 
     # Foreign keys to associate the note with optional File, Subject, and Project
-    file_id = db.Column(db.Integer, db.ForeignKey('file.id'))
-    file = db.relationship('File', backref=db.backref('notes', lazy=True))
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), index=True)
+    file = db.relationship('File', backref=db.backref('notes', lazy=True, cascade='all, delete', passive_deletes=True))
 
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'))
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='SET NULL'), index=True)
     subject = db.relationship('Subject', backref=db.backref('notes', lazy=True))
 
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='SET NULL'), index=True)
     project = db.relationship('Project', backref=db.backref('notes', lazy=True))
  
     # Many-to-many relationship with Tag model
     tags = db.relationship('Tag', secondary='note_tag', backref=db.backref('notes', lazy=True))
 
+    # Updates only apply to the version they were made from, the version is set by the content changes themselves
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": False}
+
 class NoteTag(db.Model):
     """Association model for many-to-many relationship between Notes and Tags."""
     id = db.Column(db.Integer, primary_key=True)
-    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), nullable=False)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id', ondelete='CASCADE'), nullable=False, index=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False, index=True)
+
+class NotePatch(db.Model):
+    """NotePatch model logging the JSON Patch operations applied to a note since its content snapshot."""
+    __tablename__ = 'note_patch'
+    __table_args__ = (db.UniqueConstraint('note_id', 'version'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False) # version of the note once the operations are applied
+    operations = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # Foreign key to associate the patch with a note
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id', ondelete='CASCADE'), nullable=False)
+    note = db.relationship('Note', backref=db.backref(
+        'patches', lazy=True, order_by='NotePatch.version', cascade='all, delete-orphan', passive_deletes=True,
+    ))
 
 class FlashcardDeck(db.Model):
     """FlashcardDeck model representing a collection of flashcards."""
@@ -137,7 +282,7 @@ class FlashcardDeck(db.Model):
     name = db.Column(db.String(255), unique=True, nullable=False)
     description = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     last_reviewed_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
     # Foreign key to associate the flashcard deck with a user
@@ -145,34 +290,194 @@ class FlashcardDeck(db.Model):
     user = db.relationship('User', backref=db.backref('flashcard_decks', lazy=True))
 
     # Foreign key to associate the flashcard deck with a file
-    file_id = db.Column(db.Integer, db.ForeignKey('file.id'))
-    file = db.relationship('File', backref=db.backref('flashcard_decks', lazy=True))
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'), index=True)
+    file = db.relationship('File', backref=db.backref('flashcard_decks', lazy=True, cascade='all, delete', passive_deletes=True))
 
 class Flashcard(db.Model):
+    __table_args__ = (db.Index('ix_flashcard_deck_id_rank', 'deck_id', 'rank'),)
+
     id = db.Column(db.Integer, primary_key=True)
     term = db.Column(db.String(255), nullable=False)
     definition = db.Column(db.Text, nullable=False)
-    order = db.Column(db.Integer, nullable=False)
+    rank = db.Column(db.Float, nullable=False) # sparse sort key within the deck, see ordering.py
     image_path = db.Column(db.String(255))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     
     # Foreign key to associate the flashcard with a user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('flashcards', lazy=True))
 
     # Foreign key to associate the flashcard with a deck
-    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id'))
-    deck = db.relationship('FlashcardDeck', backref=db.backref('flashcards', lazy=True))
+    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id', ondelete='CASCADE'))
+    deck = db.relationship('FlashcardDeck', backref=db.backref('flashcards', lazy=True, order_by='Flashcard.rank', cascade='all, delete', passive_deletes=True))
 
 class Todo(db.Model):
+    __table_args__ = (db.Index('ix_todo_file_id_rank', 'file_id', 'rank'),)
+
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String(255), nullable=False)
     done = db.Column(db.Boolean, default=False, nullable=False)
-    order = db.Column(db.Integer, nullable=False)
+    rank = db.Column(db.Float, nullable=False) # sparse sort key within the file, see ordering.py
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     
     # Foreign key to associate the todo with a user
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('todos', lazy=True))
 
     # Foreign key to associate the todo with a file
-    file_id = db.Column(db.Integer, db.ForeignKey('file.id'))
-    file = db.relationship('File', backref=db.backref('todos', lazy=True))
\ No newline at end of file
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='CASCADE'))
+    file = db.relationship('File', backref=db.backref('todos', lazy=True, order_by='Todo.rank', cascade='all, delete', passive_deletes=True))
+
+
+# 1-based position of an item among the items sharing its parent, only loaded by the queries asking for it
+# (see ordering.with_positions), ordering.item_position counts it for single items
+Flashcard.position = query_expression()
+Todo.position = query_expression()
+
+
+class Tombstone(db.Model):
+    """Tombstone model recording deleted items so clients can sync deletions."""
+    id = db.Column(db.Integer, primary_key=True)
+    item_type = db.Column(db.String(50), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+    # Foreign key to associate the tombstone with a user
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+
+
+class Job(db.Model):
+    """Job model representing background work (e.g. text extraction) queued for the local worker pool."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True) # pending, running, done or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    payload = db.Column(db.JSON, default={}) # kind specific options, e.g. the extraction mode
+    owner = db.Column(db.String(100)) # process holding the lease of a running job, see jobs.py
+    lease_expires_at = db.Column(db.DateTime) # when the owner is taken for dead unless it renewed the lease
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    # Foreign key to associate the job with a user, none for periodic maintenance jobs
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user = db.relationship('User', backref=db.backref('jobs', lazy=True))
+
+    # Foreign key to associate the job with the file it works on
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='SET NULL'), index=True)
+    file = db.relationship('File', backref=db.backref('jobs', lazy=True))
+
+
+class Upload(db.Model):
+    """Upload model representing a chunked upload in progress, resumable from the bytes received so far."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False) # total size announced by the client
+    received = db.Column(db.Integer, nullable=False, default=0) # bytes written to the staging file
+    path = db.Column(db.String(255), nullable=False) # staging file
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    modified_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    # Foreign key to associate the upload with a user
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship('User', backref=db.backref('uploads', lazy=True))
+
+
+class PageTextCache(db.Model):
+    """PageTextCache model caching the extracted text of a document page for an extraction mode."""
+    __tablename__ = 'page_text_cache'
+
+    document_hash = db.Column(db.String(64), primary_key=True) # sha256 of the document bytes
+    mode = db.Column(db.String(50), primary_key=True)
+    page_number = db.Column(db.Integer, primary_key=True) # 0-based
+    text = db.Column(db.Text, nullable=False)
+
+
+class CompletionCache(db.Model):
+    """CompletionCache model storing AI completions by a hash of the request that produced them."""
+    __tablename__ = 'completion_cache'
+
+    key = db.Column(db.String(64), primary_key=True) # sha256 of (model, prompt, max_tokens)
+    model = db.Column(db.String(100), nullable=False)
+    completion = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    used_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+
+@event.listens_for(Engine, "connect")
+def enable_foreign_keys(dbapi_connection, connection_record):
+    """
+    Have SQLite enforce foreign keys on every connection, which it does not by default.
+
+    Deleting a file or deck then removes the rows that belong to it (ON DELETE CASCADE) in the same
+    statement, instead of leaving them behind with a dangling id.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+# Models whose writes are bookkeeping rather than user data, and so do not bump the data version
+UNVERSIONED_MODELS = (User, Tombstone, Job, Upload)
+
+# Models whose deletions are recorded as tombstones
+TRACKED_DELETIONS = (File, Subject, Project, Tag, Note, FlashcardDeck, Flashcard, Todo)
+
+
+@event.listens_for(Session, "before_flush")
+def bump_data_versions(session, flush_context, instances):
+    """
+    Bump the data version of every user whose data is created, updated or deleted by a flush.
+
+    Read routes derive their ETags from this version, so any write made through the ORM invalidates
+    the user's cached payloads without each route having to remember to do it.
+    """
+    user_ids = {
+        item.user_id
+        for item in (*session.new, *session.dirty, *session.deleted)
+        if not isinstance(item, UNVERSIONED_MODELS)
+        and getattr(item, "user_id", None) is not None
+        and (item not in session.dirty or session.is_modified(item))
+    }
+
+    bump_data_version(session, user_ids)
+
+
+def bump_data_version(session, user_ids):
+    """Bump the data version of users, for writes made without the ORM that the listener does not see."""
+    if user_ids:
+        session.execute(
+            update(User)
+            .where(User.id.in_(user_ids))
+            # Keep modified_at as is, bumping the version is not a change to the user row itself
+            .values(data_version=User.data_version + 1, modified_at=User.modified_at)
+            .execution_options(synchronize_session=False)
+        )
+
+
+@event.listens_for(Session, "before_flush")
+def track_modifications(session, flush_context, instances):
+    """
+    Touch modified_at on items whose collections changed and record tombstones for deleted items.
+
+    Column updates already set modified_at through onupdate, but changes that only touch association
+    tables (e.g. adding a tag to a file) do not update the item's own row.
+    """
+    now = datetime.now(timezone.utc)
+
+    for item in session.dirty:
+        if hasattr(item, "modified_at") and session.is_modified(item):
+            item.modified_at = now
+
+    for item in session.deleted:
+        if isinstance(item, TRACKED_DELETIONS):
+            session.add(Tombstone(
+                item_type=item.__tablename__,
+                item_id=item.id,
+                user_id=item.user_id,
+                deleted_at=now,
+            ))
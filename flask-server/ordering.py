@@ -0,0 +1,207 @@
+from datetime import datetime, timezone
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import with_expression
+from models import db, File, FlashcardDeck, Flashcard, Todo, Job
+
+
+# Items are kept in order by a sparse float rank within their parent (the deck of a flashcard, the file of
+# a todo). Inserting or moving an item only sets its own rank, between the ranks of its new neighbours, and
+# deleting one leaves the others as they are. Their 1-based position is derived from the ranks when read.
+
+# Parent column and parent model of each ordered model
+ORDERED_MODELS = {
+    Flashcard: ("deck_id", FlashcardDeck),
+    Todo: ("file_id", File),
+}
+
+# Gap between the ranks of consecutive items when they are appended or rebalanced
+RANK_GAP = 1024.0
+
+# Once the gap around a moved item is narrower than this, about 20 moves into the same spot, the parent's
+# ranks are spread out again in the background
+MIN_RANK_GAP = RANK_GAP / (1 << 20)
+
+
+def parent_column(Model):
+    """Return the column holding the deck or file items of a model are ordered in."""
+    return getattr(Model, ORDERED_MODELS[Model][0])
+
+
+def parent_id(item):
+    """Return the id of the deck or file an item is ordered in."""
+    return getattr(item, ORDERED_MODELS[type(item)][0])
+
+
+def touch_parent(Model, parent_value):
+    """
+    Touch modified_at on the parent of a list whose order changed.
+
+    Positions of the other items change without their rows being written, the parent's serialization
+    carries them to clients syncing changes. Being a write, it also takes the database write lock before
+    ranks are read, so concurrent moves in the same list cannot pick the same rank.
+    """
+    Parent = ORDERED_MODELS[Model][1]
+    if parent_value is not None:
+        db.session.execute(
+            update(Parent)
+            .where(Parent.id == parent_value)
+            .values(modified_at=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+
+
+def position_window(Model):
+    """Return the position of items as a window function, valid when all items of each parent are loaded."""
+    return func.row_number().over(partition_by=parent_column(Model), order_by=(Model.rank, Model.id))
+
+
+def with_positions(Model):
+    """Loader option computing positions with position_window, for queries loading whole decks or files."""
+    return with_expression(Model.position, position_window(Model))
+
+
+def with_user_positions(query, Model, user_id):
+    """
+    Load positions on a query over some of a user's items, e.g. a page of them.
+
+    The window runs over every item of the user in a subquery, so the positions are right whichever
+    items the query itself selects.
+    """
+    positions = (
+        select(Model.id, position_window(Model).label("position"))
+        .where(Model.user_id == user_id)
+        .subquery()
+    )
+    return query.outerjoin(positions, positions.c.id == Model.id).options(
+        with_expression(Model.position, positions.c.position),
+    )
+
+
+def item_position(item):
+    """Return the 1-based position of an item, counting the items before it when it was not loaded with one."""
+    if item.position is not None:
+        return item.position
+
+    Model = type(item)
+    return db.session.scalar(
+        select(func.count()).where(parent_column(Model) == parent_id(item), Model.rank <= item.rank)
+    )
+
+
+def neighbour_ranks(Model, parent_value, position=None, exclude_id=None):
+    """Return the ranks of the items that would come before and after an item placed at a position, or last."""
+    query = select(Model.rank).where(parent_column(Model) == parent_value)
+    if exclude_id is not None:
+        query = query.where(Model.id != exclude_id)
+
+    if position is not None and position <= 1:
+        return None, db.session.scalar(query.order_by(Model.rank, Model.id).limit(1))
+
+    if position is not None:
+        ranks = db.session.scalars(query.order_by(Model.rank, Model.id).offset(position - 2).limit(2)).all()
+        if ranks:
+            return ranks[0], ranks[1] if len(ranks) > 1 else None
+
+    # At the end, past the last item
+    return db.session.scalar(query.order_by(Model.rank.desc()).limit(1)), None
+
+
+def rank_between(before, after):
+    """Return a rank between two ranks, either of which may be None for the ends of the list."""
+    if before is None and after is None:
+        return RANK_GAP
+    if before is None:
+        return after - RANK_GAP
+    if after is None:
+        return before + RANK_GAP
+    return (before + after) / 2
+
+
+def place_item(item, position=None):
+    """
+    Set the rank of an item so it lands at a position in its parent, at the end by default.
+
+    Only the item itself and its parent's modified_at are written. When floats run out of room between
+    the neighbours, the parent is rebalanced right away, which should not happen while background
+    rebalancing keeps up.
+
+    Args:
+        item (Flashcard or Todo): The item, new or moved. Its parent must be set.
+        position (int, optional): The 1-based position the item should have once placed.
+
+    Returns:
+        bool: Whether the gap around the item is narrow enough that the parent should be rebalanced.
+    """
+    Model = type(item)
+    parent_value = parent_id(item)
+
+    # A new item has no rank yet, it must not be flushed by the queries reading its neighbours
+    with db.session.no_autoflush:
+        touch_parent(Model, parent_value)
+        before, after = neighbour_ranks(Model, parent_value, position, item.id)
+
+        rank = rank_between(before, after)
+        if before is not None and after is not None and not before < rank < after:
+            rebalance(Model, parent_value)
+            before, after = neighbour_ranks(Model, parent_value, position, item.id)
+            rank = rank_between(before, after)
+
+    item.rank = rank
+    return before is not None and after is not None and after - before < MIN_RANK_GAP
+
+
+def append_ranks(Model, parent_value, count):
+    """Return the ranks of count items appended in order to a parent, taking its write lock first."""
+    touch_parent(Model, parent_value)
+    last, _ = neighbour_ranks(Model, parent_value)
+    start = last if last is not None else 0.0
+    return [start + RANK_GAP * (index + 1) for index in range(count)]
+
+
+def rebalance(Model, parent_value):
+    """Spread the ranks of a parent's items RANK_GAP apart again, keeping their order."""
+    touch_parent(Model, parent_value)
+    ids = db.session.scalars(
+        select(Model.id).where(parent_column(Model) == parent_value).order_by(Model.rank, Model.id)
+    ).all()
+    if ids:
+        # Positions stay the same, so only the ranks change, in a single executemany
+        db.session.execute(
+            update(Model),
+            [{"id": id, "rank": (index + 1) * RANK_GAP} for index, id in enumerate(ids)],
+        )
+
+
+def request_rebalance(item):
+    """
+    Queue a background rebalance of an item's parent, unless one is already pending.
+
+    Returns:
+        Job or None: The new job, to submit once committed.
+    """
+    payload = {"table": type(item).__tablename__, "parent_id": parent_id(item)}
+    pending = Job.query.filter_by(kind="rebalance_order", status="pending", user_id=item.user_id)
+    if any(job.payload == payload for job in pending):
+        return None
+
+    job = Job(kind="rebalance_order", user_id=item.user_id, payload=payload)
+    db.session.add(job)
+    return job
+
+
+def move_item(item, position):
+    """
+    Place a flashcard or todo at a 1-based position among its siblings, writing only its own rank.
+
+    Returns:
+        Job or None: A rebalance of its siblings' ranks, to submit once committed, if they got crowded.
+    """
+    if place_item(item, position):
+        return request_rebalance(item)
+    return None
+
+
+def rebalance_job(job):
+    """Rebalance the parent a rebalance_order job was queued for."""
+    Model = next(Model for Model in ORDERED_MODELS if Model.__tablename__ == job.payload["table"])
+    rebalance(Model, job.payload["parent_id"])
@@ -0,0 +1,278 @@
+import copy
+from sqlalchemy import inspect
+from models import db, NotePatch, Job
+
+
+# Notes are edited with JSON Patch (RFC 6902) operations made against a version of their content. The
+# operations are appended to the note's log instead of rewriting its content, which is only a snapshot:
+# readers apply the operations still in the log to it (note_content). The log is folded into the snapshot
+# by a background job a little after the edits, or right away once it grows long.
+
+# Patches kept in a note's log before the request adding one folds them into the content itself
+MAX_PENDING_PATCHES = 50
+
+# Delay before a note patched since its last snapshot is compacted, so a burst of edits is folded at once
+COMPACTION_DELAY = 30  # seconds
+
+# Most operations accepted in one patch
+MAX_PATCH_OPERATIONS = 1000
+
+
+class PatchError(Exception):
+    """A patch that cannot be applied to a note, made against another version or not matching its content."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def parse_pointer(pointer):
+    """Split a JSON pointer (e.g. "/blocks/0/data/text") into its unescaped reference tokens."""
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+        raise PatchError(f"Invalid path {pointer!r}")
+    if not pointer:
+        return []
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def array_index(array, token, end=False):
+    """Return the index a token refers to in an array, "-" and len(array) meaning the end when end is allowed."""
+    if end and token == "-":
+        return len(array)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise PatchError(f"Invalid array index {token!r}")
+
+    index = int(token)
+    if index > len(array) or (index == len(array) and not end):
+        raise PatchError(f"Array index {index} out of range")
+    return index
+
+
+def resolve(document, tokens):
+    """Return the value tokens refer to in a document."""
+    for token in tokens:
+        if isinstance(document, dict):
+            if token not in document:
+                raise PatchError(f"Path not found: {token!r} is missing")
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[array_index(document, token)]
+        else:
+            raise PatchError(f"Path not found: {token!r} is not in a container")
+    return document
+
+
+def add(document, tokens, value):
+    if not tokens:
+        return value
+
+    parent, token = resolve(document, tokens[:-1]), tokens[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(array_index(parent, token, end=True), value)
+    else:
+        raise PatchError(f"Cannot add {token!r} to a value that is not a container")
+    return document
+
+
+def remove(document, tokens):
+    if not tokens:
+        raise PatchError("Cannot remove the whole document")
+
+    parent, token = resolve(document, tokens[:-1]), tokens[-1]
+    if isinstance(parent, list):
+        del parent[array_index(parent, token)]
+    else:
+        resolve(parent, [token])
+        del parent[token]
+    return document
+
+
+def replace(document, tokens, value):
+    if not tokens:
+        return value
+
+    parent, token = resolve(document, tokens[:-1]), tokens[-1]
+    if isinstance(parent, list):
+        parent[array_index(parent, token)] = value
+    else:
+        resolve(parent, [token])
+        parent[token] = value
+    return document
+
+
+def apply_operation(document, operation):
+    """Apply one JSON Patch operation to a document in place, returning the document."""
+    if not isinstance(operation, dict):
+        raise PatchError("Operation must be an object")
+
+    op = operation.get("op")
+    tokens = parse_pointer(operation.get("path"))
+
+    if op in ("add", "replace", "test") and "value" not in operation:
+        raise PatchError(f"{op} operation requires a value")
+
+    if op == "add":
+        # Values are copied so editing the document never changes the operations kept in the log
+        return add(document, tokens, copy.deepcopy(operation["value"]))
+    if op == "replace":
+        return replace(document, tokens, copy.deepcopy(operation["value"]))
+    if op == "remove":
+        return remove(document, tokens)
+    if op == "test":
+        if resolve(document, tokens) != operation["value"]:
+            raise PatchError(f"Test failed at {operation['path']}", 409)
+        return document
+    if op in ("move", "copy"):
+        source = parse_pointer(operation.get("from"))
+        value = resolve(document, source)
+        if op == "copy":
+            return add(document, tokens, copy.deepcopy(value))
+        if tokens[:len(source)] == source and len(tokens) > len(source):
+            raise PatchError("Cannot move a value into itself")
+        return add(remove(document, source), tokens, value)
+
+    raise PatchError(f"Unsupported operation {op}")
+
+
+def apply_patch(document, operations):
+    """
+    Apply JSON Patch operations to a document, in place where possible.
+
+    Returns:
+        The patched document, a new value when the whole document is replaced.
+    """
+    for operation in operations:
+        document = apply_operation(document, operation)
+    return document
+
+
+def replay(note):
+    """Return a copy of a note's content snapshot with the patches of its log applied."""
+    content = copy.deepcopy(note.content or {})
+    for patch in note.patches:
+        content = apply_patch(content, patch.operations)
+    return content
+
+
+def buffered_change(note):
+    """Return the change to a note's content held by the write-behind buffer (see writebuffer.py), if any."""
+    return inspect(note).info.get("buffered_change")
+
+
+def note_content(note):
+    """Return the current content of a note, its snapshot with the patches still in its log applied."""
+    change = buffered_change(note)
+    if change is not None:
+        return change["content"]
+    return replay(note) if note.patches else note.content
+
+
+def note_version(note):
+    """Return the current version of a note."""
+    change = buffered_change(note)
+    return change["version"] if change is not None else note.version
+
+
+def check_version(note, base_version):
+    """Refuse a change made against another version of a note than its current one."""
+    if base_version is not None and base_version != note_version(note):
+        raise PatchError(f"Note changed since version {base_version}", 409)
+
+
+def patched_content(note, operations, base_version):
+    """
+    Return the content of a note with JSON Patch operations made against a version of it applied.
+
+    The note itself is left as is.
+
+    Args:
+        note (Note): The note to patch.
+        operations (list): JSON Patch operations, as sent by the client.
+        base_version (int): The version of the note the operations were made against.
+    """
+    if not isinstance(base_version, int) or isinstance(base_version, bool):
+        raise PatchError("baseVersion must be an integer")
+    check_version(note, base_version)
+
+    if not isinstance(operations, list) or not operations:
+        raise PatchError("patch must be a non-empty list of operations")
+    if len(operations) > MAX_PATCH_OPERATIONS:
+        raise PatchError(f"A patch can't have more than {MAX_PATCH_OPERATIONS} operations")
+
+    change = buffered_change(note)
+    content = copy.deepcopy(change["content"]) if change is not None else replay(note)
+    content = apply_patch(content, operations)
+    if not isinstance(content, dict):
+        raise PatchError("Note content must be an object")
+    return content
+
+
+def patch_note(note, operations, base_version):
+    """
+    Apply JSON Patch operations made against a version of a note to its content.
+
+    Only the operations are written, to the note's log, along with the new version of the note.
+
+    Returns:
+        Job or None: A compact_note job to submit, with COMPACTION_DELAY, once committed.
+    """
+    # Applied to a copy first, so the log only ever holds operations that apply
+    content = patched_content(note, operations, base_version)
+    return log_patch(note, operations, content, note.version + 1)
+
+
+def log_patch(note, operations, content, version):
+    """
+    Append operations to a note's log, compacting it once it is long.
+
+    Args:
+        note (Note): The note patched.
+        operations (list): JSON Patch operations taking the note's current content to content.
+        content (dict): The content of the note once patched.
+        version (int): The version of the note once patched.
+
+    Returns:
+        Job or None: A compact_note job to submit, with COMPACTION_DELAY, once committed.
+    """
+    note.version = version
+    note.patches.append(NotePatch(version=version, operations=operations))
+
+    if len(note.patches) >= MAX_PENDING_PATCHES:
+        compact_note(note, content)
+        return None
+
+    if len(note.patches) == 1:
+        job = Job(kind="compact_note", user_id=note.user_id, payload={"note_id": note.id})
+        db.session.add(job)
+        return job
+    return None
+
+
+def replace_note_content(note, content, base_version=None):
+    """Replace the whole content of a note, against a version of it when base_version is given."""
+    check_version(note, base_version)
+
+    note.content = content
+    note.version += 1
+    note.patches.clear()
+
+
+def compact_note(note, content=None):
+    """
+    Fold the patches of a note's log into its content snapshot.
+
+    The version does not change, clients editing the note can keep patching it. The search index already
+    holds the patched content, indexed as each patch was logged.
+
+    Args:
+        note (Note): The note to compact.
+        content (dict, optional): The current content of the note, when already computed.
+    """
+    if not note.patches:
+        return
+
+    note.content = replay(note) if content is None else content
+    note.patches.clear()
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import zlib
+import numpy as np
+from flask import current_app
+from ai import CHUNK_TOKENS, call_api, get_client, page_token_counts, plan_chunks
+from models import db, File
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks files are split into for retrieval, in tokens
+RETRIEVAL_CHUNK_TOKENS = 256
+
+# Number of chunks retrieved for a query, as long as they fit in CHUNK_TOKENS together
+TOP_K = 8
+
+# Provider used to embed chunks and queries, one of EMBEDDING_PROVIDERS
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "hashing")
+
+HASHING_DIMENSIONS = 1 << 12
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+OPENAI_EMBEDDING_BATCH = 256  # texts per request
+
+WORD = re.compile(r"\w+")
+
+
+class HashingEmbeddings:
+    """
+    Offline embeddings hashing the words of a text into a fixed number of dimensions.
+
+    Needs no model nor network, so it always works, at the cost of only matching texts that share words.
+    """
+
+    name = f"hashing-{HASHING_DIMENSIONS}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), HASHING_DIMENSIONS), dtype=np.float32)
+        for row, text in enumerate(texts):
+            # Word pairs were tried too, they crowd the dimensions and rank matching chunks lower
+            words = WORD.findall(text.lower())
+            if not words:
+                continue
+
+            hashes = np.array([zlib.crc32(word.encode()) for word in words], dtype=np.uint32)
+            # The top bit gives each feature a sign, so collisions cancel out rather than add up
+            signs = np.where(hashes >> 31, -1.0, 1.0)
+            counts = np.bincount(hashes % HASHING_DIMENSIONS, weights=signs, minlength=HASHING_DIMENSIONS)
+            # Dampen words repeated many times in a chunk
+            vectors[row] = np.sign(counts) * np.log1p(np.abs(counts))
+
+        return normalize(vectors)
+
+
+class OpenAIEmbeddings:
+    """Embeddings of the OpenAI API, requested through the gateway in batches."""
+
+    name = OPENAI_EMBEDDING_MODEL
+
+    def embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), OPENAI_EMBEDDING_BATCH):
+            response = call_api(
+                get_client().embeddings.create,
+                model=OPENAI_EMBEDDING_MODEL,
+                input=texts[start:start + OPENAI_EMBEDDING_BATCH],
+            )
+            vectors.extend(item.embedding for item in response.data)
+        return normalize(np.array(vectors, dtype=np.float32))
+
+
+EMBEDDING_PROVIDERS = {
+    "hashing": HashingEmbeddings,
+    "openai": OpenAIEmbeddings,
+}
+
+
+def normalize(vectors):
+    """Scale rows to unit length, so dot products are cosine similarities. Zero rows are left as is."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def get_provider(name=None):
+    """Return the embedding provider configured by EMBEDDING_PROVIDER."""
+    name = name or EMBEDDING_PROVIDER
+    if name not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"Unknown embedding provider {name}")
+    return EMBEDDING_PROVIDERS[name]()
+
+
+def embeddings_folder(provider):
+    """Return the folder of the indexes built with a provider."""
+    return os.path.join(current_app.config["UPLOADED_FILES_DEST"], "embeddings", provider.name)
+
+
+def index_paths(provider, digest):
+    """Return the paths of the vectors and chunks of the index of an extracted text, by its sha256."""
+    folder = embeddings_folder(provider)
+    return os.path.join(folder, f"{digest}.npy"), os.path.join(folder, f"{digest}.json")
+
+
+def unused_indexes(digests):
+    """
+    Return the paths of the indexes, with every provider, of extracted texts no file has anymore.
+
+    Vectors come before chunks, so removing them in order never leaves vectors without their chunks.
+    """
+    used = set(db.session.scalars(db.select(File.content_hash).where(File.content_hash.in_(digests))))
+    return [
+        path
+        for digest in set(digests) - used
+        for provider in EMBEDDING_PROVIDERS.values()
+        for path in index_paths(provider, digest)
+    ]
+
+
+def build_index(file, provider, vectors_path, chunks_path):
+    """Split a file into chunks, embed them and write them next to each other, moving each file into place."""
+    chunks = plan_chunks(page_token_counts(file), RETRIEVAL_CHUNK_TOKENS)
+    vectors = provider.embed(chunks) if chunks else np.zeros((0, 1), dtype=np.float32)
+
+    folder = os.path.dirname(vectors_path)
+    os.makedirs(folder, exist_ok=True)
+
+    # Chunks are written first, so an index whose vectors exist is always complete
+    fd, temporary_path = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, "w") as f:
+        json.dump(chunks, f)
+    os.replace(temporary_path, chunks_path)
+
+    fd, temporary_path = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, vectors)
+    os.replace(temporary_path, vectors_path)
+
+
+def file_index(file, provider=None):
+    """
+    Return the chunks of a file and their embeddings, building and storing them the first time.
+
+    Indexes are stored per extracted text (File.content_hash) and provider, so files with the same content
+    share one, which is removed once no file has that text anymore (see unused_indexes). The embeddings
+    are memory-mapped rather than read, so only the pages of the matrix the search touches are loaded.
+
+    Returns:
+        tuple: (list of chunk texts, float32 array of one unit row per chunk)
+    """
+    provider = provider or get_provider()
+    if file.content_hash is None:
+        return [], np.zeros((0, 1), dtype=np.float32)
+
+    vectors_path, chunks_path = index_paths(provider, file.content_hash)
+
+    if not os.path.exists(vectors_path):
+        build_index(file, provider, vectors_path, chunks_path)
+
+    with open(chunks_path) as f:
+        chunks = json.load(f)
+    return chunks, np.load(vectors_path, mmap_mode="r")
+
+
+def top_chunks(vectors, query_vector, k=TOP_K):
+    """Return the indexes of the k rows most similar to the query, most similar first."""
+    if not len(vectors):
+        return []
+
+    scores = vectors @ query_vector
+    k = min(k, len(scores))
+    # Partial sort: only the k best are ordered
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])].tolist()
+
+
+def search_file(file, query, k=TOP_K):
+    """
+    Return the chunks of a file most relevant to a query, in document order.
+
+    Falls back to the offline hashing embeddings when the configured provider fails.
+    """
+    provider = get_provider()
+    try:
+        chunks, vectors = file_index(file, provider)
+        query_vector = provider.embed([query])[0]
+    except Exception:
+        if isinstance(provider, HashingEmbeddings):
+            raise
+        logger.warning("Embedding with %s failed, falling back to hashing", provider.name, exc_info=True)
+        provider = HashingEmbeddings()
+        chunks, vectors = file_index(file, provider)
+        query_vector = provider.embed([query])[0]
+
+    return [chunks[index] for index in sorted(top_chunks(vectors, query_vector, k))]
+
+
+def relevant_material(file, query, budget=CHUNK_TOKENS):
+    """Return the parts of a file that relate to a query, or the whole file if it fits in the budget."""
+    pieces = page_token_counts(file)
+    if sum(tokens for _, tokens in pieces) <= budget:
+        return "".join(text for text, _ in pieces)
+
+    k = min(max(budget // RETRIEVAL_CHUNK_TOKENS, 1), TOP_K)
+    return "\n...\n".join(search_file(file, query, k))
+
+
+def index_file(file):
+    """Build the index of a file ahead of its first search. Failures are logged, the search builds it again."""
+    try:
+        file_index(file)
+    except Exception:
+        logger.exception("Indexing file %s for retrieval failed", file.id)
@@ -0,0 +1,248 @@
+import html
+import re
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session, selectinload
+from models import db, File, FilePage, Note, Flashcard
+from patches import note_content
+
+
+# Name of the FTS5 table indexing files, notes and flashcards
+SEARCH_TABLE = "search_index"
+
+# Each item owns exactly one index row, whose rowid encodes the item type and id
+ITEM_TYPES = {File: (0, "file"), Note: (1, "note"), Flashcard: (2, "flashcard")}
+
+# Title matches weigh more than body matches when ranking results
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+
+
+def search_rowid(item):
+    """Return the rowid of the index row of a file, note or flashcard."""
+    return item_rowid(type(item), item.id)
+
+
+def item_rowid(Model, item_id):
+    """Return the rowid of the index row of the file, note or flashcard with the given id."""
+    type_code, _ = ITEM_TYPES[Model]
+    return item_id * len(ITEM_TYPES) + type_code
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keep the search index and its shadow tables out of Alembic autogenerate."""
+    return not (type_ == "table" and name.startswith(SEARCH_TABLE))
+
+
+def create_search_index(connection):
+    """
+    Create the search index if it does not exist yet, empty.
+
+    Safe whatever the schema of the other tables, the index is filled by the migration that adds it and
+    can be filled again with rebuild_search_index.
+    """
+    # owner holds "u<user_id>" so results are scoped per user by the index itself
+    connection.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "title, body, owner, item_type UNINDEXED, item_id UNINDEXED, file_id UNINDEXED, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    ))
+
+
+def rebuild_search_index():
+    """Fill the search index again from every file, note and flashcard."""
+    connection = db.session.connection()
+    create_search_index(connection)
+    connection.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+
+    for item in File.query.options(selectinload(File.pages)).yield_per(100):
+        index_item(connection, item)
+    for item in Note.query.options(selectinload(Note.patches)).yield_per(100):
+        index_item(connection, item)
+    for item in Flashcard.query.options(selectinload(Flashcard.deck)).yield_per(100):
+        index_item(connection, item)
+
+    db.session.commit()
+
+
+def note_text(content):
+    """
+    Extract the plain text of a note from its editor JSON content.
+
+    Args:
+        content (dict): The note content, a dictionary with a list of editor blocks.
+
+    Returns:
+        str: The text of every block, without markup.
+    """
+    strings = []
+
+    def collect(value):
+        if isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, list):
+            for element in value:
+                collect(element)
+        elif isinstance(value, dict):
+            for element in value.values():
+                collect(element)
+
+    for block in (content or {}).get("blocks", []):
+        collect(block.get("data"))
+
+    return html.unescape(re.sub(r"<[^>]+>", " ", "\n".join(strings)))
+
+
+def item_document(item):
+    """Return the (title, body, file_id) indexed for a file, note or flashcard."""
+    if isinstance(item, File):
+        return item.name, item.content or "", item.id
+    if isinstance(item, Note):
+        return item.name, note_text(note_content(item)), item.file_id
+    return item.term, item.definition, item.deck.file_id if item.deck else None
+
+
+def index_item(connection, item):
+    """Insert or replace the index row of an item."""
+    index_items(connection, [item])
+
+
+def index_items(connection, items):
+    """Insert or replace the index rows of items, in one statement of each kind for all of them."""
+    rows = []
+    for item in items:
+        title, body, file_id = item_document(item)
+        rows.append({
+            "rowid": search_rowid(item),
+            "title": title,
+            "body": body,
+            "owner": f"u{item.user_id}",
+            "item_type": ITEM_TYPES[type(item)][1],
+            "item_id": item.id,
+            "file_id": file_id,
+        })
+
+    if not rows:
+        return
+
+    connection.execute(
+        text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"),
+        [{"rowid": row["rowid"]} for row in rows],
+    )
+    connection.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, owner, item_type, item_id, file_id) "
+            "VALUES (:rowid, :title, :body, :owner, :item_type, :item_id, :file_id)"
+        ),
+        rows,
+    )
+
+
+def unindex_items(connection, items):
+    """Remove the index rows of items."""
+    for Model in {type(item) for item in items}:
+        unindex_ids(connection, Model, [item.id for item in items if type(item) is Model])
+
+
+def unindex_ids(connection, Model, ids):
+    """Remove the index rows of the files, notes or flashcards with the given ids."""
+    rowids = [{"rowid": item_rowid(Model, item_id)} for item_id in ids]
+    if rowids:
+        connection.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"), rowids)
+
+
+# Attributes whose changes require reindexing an item. Notes are reindexed with their patches applied
+# whenever one is added to their log (see patches.py).
+INDEXED_ATTRIBUTES = {
+    File: ("name", "content_hash"),
+    Note: ("name", "content", "patches", "file_id"),
+    Flashcard: ("term", "definition", "deck_id"),
+}
+
+
+@event.listens_for(Session, "after_flush")
+def update_search_index(session, flush_context):
+    """Keep the search index in step with every flush that writes files, notes or flashcards."""
+    reindexed = set()
+    removed = set()
+
+    for item in session.new:
+        if isinstance(item, FilePage):
+            reindexed.add(item.file)
+        elif type(item) in ITEM_TYPES:
+            reindexed.add(item)
+
+    for item in session.dirty:
+        attributes = INDEXED_ATTRIBUTES.get(type(item), ())
+        state = inspect(item)
+        if any(state.attrs[attribute].history.has_changes() for attribute in attributes):
+            reindexed.add(item)
+
+    for item in session.deleted:
+        if type(item) in ITEM_TYPES:
+            removed.add(item)
+
+    if not reindexed and not removed:
+        return
+
+    connection = session.connection()
+    unindex_items(connection, removed)
+    index_items(connection, [
+        item for item in reindexed - removed if item is not None and item not in session.deleted
+    ])
+
+
+def build_match_query(query, user_id):
+    """
+    Build an FTS5 MATCH expression from free text typed by a user.
+
+    Every word must match, in the title or the body. Words ending with * and the last word, which
+    may still be being typed, are matched as prefixes.
+    """
+    words = re.findall(r"\w+\*?", query)
+    if not words:
+        return None
+
+    terms = []
+    for index, word in enumerate(words):
+        is_prefix = word.endswith("*") or index == len(words) - 1
+        terms.append(f'"{word.rstrip("*")}"' + ("*" if is_prefix else ""))
+
+    return f'owner : "u{user_id}" AND {{title body}} : ({" ".join(terms)})'
+
+
+def search_items(user_id, query, limit=20):
+    """
+    Search a user's files, notes and flashcards.
+
+    Args:
+        user_id (int): The id of the user whose items are searched.
+        query (str): Free text typed by the user.
+        limit (int): Maximum number of results.
+
+    Returns:
+        list of dict: Results ranked by relevance, with a highlighted snippet of the match.
+    """
+    match = build_match_query(query, user_id)
+    if match is None:
+        return []
+
+    rows = db.session.execute(
+        text(
+            f"SELECT item_type, item_id, file_id, title, "
+            f"snippet({SEARCH_TABLE}, 1, '<b>', '</b>', '…', 12) AS snippet "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match "
+            f"ORDER BY bm25({SEARCH_TABLE}, :title_weight, :body_weight, 0.0) LIMIT :limit"
+        ),
+        {"match": match, "title_weight": TITLE_WEIGHT, "body_weight": BODY_WEIGHT, "limit": limit},
+    )
+
+    return [
+        {
+            "type": row.item_type,
+            "id": row.item_id,
+            "fileId": row.file_id,
+            "label": row.title,
+            "snippet": row.snippet,
+        }
+        for row in rows
+    ]
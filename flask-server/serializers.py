@@ -0,0 +1,207 @@
+from sqlalchemy.orm import defer, selectinload
+from models import File, Tag, Note, FlashcardDeck, Flashcard, Todo, Subject, Project
+from ordering import ORDERED_MODELS, item_position, with_positions, with_user_positions
+from patches import note_content, note_version
+
+
+def serialize(item, item_fields, fields=None):
+    """
+    Serialize a model instance into a dictionary.
+
+    Args:
+        item (db.Model): The model instance to serialize.
+        item_fields (dict): Mapping of output field names to getter functions.
+        fields (iterable, optional): Output fields to include. Defaults to all fields.
+
+    Returns:
+        dict: The serialized item. Attributes of fields that are not selected are never accessed,
+        so deferred columns and unloaded relationships stay unloaded.
+    """
+    return {
+        name: getter(item)
+        for name, getter in item_fields.items()
+        if fields is None or name in fields
+    }
+
+
+TAG_FIELDS = {
+    "id": lambda tag: tag.id,
+    "name": lambda tag: tag.name,
+    "color": lambda tag: tag.color,
+}
+
+SUBJECT_FIELDS = {
+    "id": lambda subject: subject.id,
+    "name": lambda subject: subject.name,
+    "color": lambda subject: subject.color,
+}
+
+PROJECT_FIELDS = {
+    "id": lambda project: project.id,
+    "name": lambda project: project.name,
+    "color": lambda project: project.color,
+}
+
+FLASHCARD_FIELDS = {
+    "id": lambda flashcard: flashcard.id,
+    "term": lambda flashcard: flashcard.term,
+    "definition": lambda flashcard: flashcard.definition,
+    "order": lambda flashcard: item_position(flashcard), # 1-based position in the deck
+    "imagePath": lambda flashcard: flashcard.image_path,
+    "deckId": lambda flashcard: flashcard.deck_id,
+}
+
+TODO_FIELDS = {
+    "id": lambda todo: todo.id,
+    "content": lambda todo: todo.content,
+    "done": lambda todo: todo.done,
+    "order": lambda todo: item_position(todo), # 1-based position in the file
+    "fileId": lambda todo: todo.file_id,
+}
+
+NOTE_FIELDS = {
+    "type": lambda note: Note.__tablename__,
+    "id": lambda note: note.id,
+    "name": lambda note: note.name,
+    "content": lambda note: note_content(note),
+    "version": lambda note: note_version(note), # version patches of the content are made against
+    "modified_at": lambda note: note.modified_at,
+    "fileId": lambda note: note.file_id,
+}
+
+DECK_FIELDS = {
+    "type": lambda deck: FlashcardDeck.__tablename__,
+    "id": lambda deck: deck.id,
+    "name": lambda deck: deck.name,
+    "modified_at": lambda deck: deck.modified_at,
+    "fileId": lambda deck: deck.file_id,
+    "flashcards": lambda deck: [serialize(flashcard, FLASHCARD_FIELDS) for flashcard in deck.flashcards],
+}
+
+FILE_FIELDS = {
+    "id": lambda file: file.id,
+    "name": lambda file: file.name,
+    "type": lambda file: file.type,
+    "version": lambda file: file.blob_hash,
+    "content": lambda file: file.content,
+    "created_at": lambda file: file.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+    "subject": lambda file: [serialize(file.subject, SUBJECT_FIELDS)] if file.subject else [],
+    "project": lambda file: [serialize(file.project, PROJECT_FIELDS)] if file.project else [],
+    "notes": lambda file: [serialize(note, NOTE_FIELDS) for note in file.notes],
+    "flashcard_decks": lambda file: [serialize(deck, DECK_FIELDS) for deck in file.flashcard_decks],
+    "todos": lambda file: [serialize(todo, TODO_FIELDS) for todo in file.todos],
+    "tags": lambda file: [serialize(tag, TAG_FIELDS) for tag in file.tags],
+}
+
+JOB_FIELDS = {
+    "id": lambda job: job.id,
+    "kind": lambda job: job.kind,
+    "status": lambda job: job.status,
+    "progress": lambda job: job.progress,
+    "total": lambda job: job.total,
+    "attempts": lambda job: job.attempts,
+    "error": lambda job: job.error,
+    "fileId": lambda job: job.file_id,
+}
+
+UPLOAD_FIELDS = {
+    "id": lambda upload: upload.id,
+    "name": lambda upload: upload.name,
+    "size": lambda upload: upload.size,
+    "offset": lambda upload: upload.received,
+}
+
+
+# Collections served by the sectioned data API.
+# "deferred" maps heavy output fields to the columns that are only loaded when the field is selected,
+# "relationships" maps nested output fields to the loader options that fetch them in bulk. Nested flashcards
+# and todos are loaded with every sibling, so their positions are computed in the same query.
+COLLECTIONS = {
+    "files": {
+        "model": File,
+        "fields": FILE_FIELDS,
+        "deferred": {},
+        "relationships": {
+            "content": selectinload(File.pages),
+            "subject": selectinload(File.subject),
+            "project": selectinload(File.project),
+            "notes": selectinload(File.notes).selectinload(Note.patches),
+            "flashcard_decks": selectinload(File.flashcard_decks).selectinload(FlashcardDeck.flashcards).options(
+                with_positions(Flashcard),
+            ),
+            "todos": selectinload(File.todos).options(with_positions(Todo)),
+            "tags": selectinload(File.tags),
+        },
+    },
+    "notes": {
+        "model": Note,
+        "fields": NOTE_FIELDS,
+        "deferred": {"content": Note.content},
+        "relationships": {"content": selectinload(Note.patches)},
+    },
+    "decks": {
+        "model": FlashcardDeck,
+        "fields": DECK_FIELDS,
+        "deferred": {},
+        "relationships": {"flashcards": selectinload(FlashcardDeck.flashcards).options(with_positions(Flashcard))},
+    },
+    "flashcards": {
+        "model": Flashcard,
+        "fields": FLASHCARD_FIELDS,
+        "deferred": {},
+        "relationships": {},
+    },
+    "todos": {
+        "model": Todo,
+        "fields": TODO_FIELDS,
+        "deferred": {},
+        "relationships": {},
+    },
+    "tags": {
+        "model": Tag,
+        "fields": TAG_FIELDS,
+        "deferred": {},
+        "relationships": {},
+    },
+    "subjects": {
+        "model": Subject,
+        "fields": SUBJECT_FIELDS,
+        "deferred": {},
+        "relationships": {},
+    },
+    "projects": {
+        "model": Project,
+        "fields": PROJECT_FIELDS,
+        "deferred": {},
+        "relationships": {},
+    },
+}
+
+
+def collection_query(collection, user_id, fields=None):
+    """
+    Build the query for a collection, loading only what the selected fields need.
+
+    Args:
+        collection (dict): An entry of COLLECTIONS.
+        user_id (int): The id of the user owning the items.
+        fields (iterable, optional): Output fields to include. Defaults to all fields.
+
+    Returns:
+        Query: A query over the user's items, ordered by id.
+    """
+    Model = collection["model"]
+    options = [
+        defer(column) for name, column in collection["deferred"].items()
+        if fields is not None and name not in fields
+    ] + [
+        loader for name, loader in collection["relationships"].items()
+        if fields is None or name in fields
+    ]
+
+    query = Model.query.filter(Model.user_id == user_id).options(*options)
+    # Only some of a parent's flashcards or todos may be selected, e.g. on a page, positions are computed apart
+    if Model in ORDERED_MODELS and (fields is None or "order" in fields):
+        query = with_user_positions(query, Model, user_id)
+
+    return query.order_by(Model.id)
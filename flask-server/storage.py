@@ -0,0 +1,289 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import Counter
+from flask import current_app
+from sqlalchemy import delete, event, inspect
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models import db, Blob, File, Upload
+
+
+# Size of the blocks read from uploads while they are written and hashed
+BLOCK_SIZE = 1 << 20  # 1 MiB
+
+
+def blobs_folder():
+    """Return the folder of the content-addressed blob store."""
+    return os.path.join(current_app.config["UPLOADED_FILES_DEST"], "blobs")
+
+
+def staging_folder():
+    """Return the folder uploads are written to before they are moved into the blob store."""
+    return os.path.join(current_app.config["UPLOADED_FILES_DEST"], "staging")
+
+
+def blob_path(digest):
+    """Return the path of the blob with the given sha256, fanned out by its first two hex digits."""
+    return os.path.join(blobs_folder(), digest[:2], digest)
+
+
+def stage_stream(stream):
+    """
+    Write a stream to a new staging file, hashing it as it is written.
+
+    Args:
+        stream (file-like): The uploaded content.
+
+    Returns:
+        tuple: (staging path, sha256 hex digest, size in bytes)
+    """
+    os.makedirs(staging_folder(), exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=staging_folder())
+
+    digest = hashlib.sha256()
+    size = 0
+    with os.fdopen(fd, "wb") as f:
+        for block in iter(lambda: stream.read(BLOCK_SIZE), b""):
+            digest.update(block)
+            f.write(block)
+            size += len(block)
+
+    return path, digest.hexdigest(), size
+
+
+def store_blob(staging_path, digest, size):
+    """
+    Move a staged file into the blob store, unless the same content is already stored.
+
+    Args:
+        staging_path (str): Path of the staged file, which is moved or removed.
+        digest (str): The sha256 hex digest of the staged file.
+        size (int): The size of the staged file in bytes.
+
+    Returns:
+        tuple: (Blob, whether the content was already stored). New blobs are inserted with no references,
+        files using them are counted when they are flushed, and their content is removed again if the
+        transaction is not committed.
+    """
+    blob = db.session.get(Blob, digest)
+    created = False
+
+    try:
+        if blob is None:
+            # Inserted right away, so a concurrent upload of the same content that stored it meanwhile is
+            # found here rather than clashing with this one on commit
+            created = db.session.execute(
+                insert(Blob)
+                .values(hash=digest, path=blob_path(digest), size=size, ref_count=0)
+                .on_conflict_do_nothing(index_elements=[Blob.hash])
+            ).rowcount == 1
+            blob = db.session.get(Blob, digest)
+
+        if not created and os.path.exists(blob.path):
+            os.remove(staging_path)
+            return blob, True
+
+        os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+        os.replace(staging_path, blob.path)
+
+    except BaseException:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+        raise
+
+    if created:
+        db.session.info.setdefault("stored_paths", []).append(blob.path)
+    return blob, False
+
+
+# Running sha256 of chunked uploads, keyed by upload id: (bytes hashed, hash object).
+# Lost on restart, in which case the staged bytes are hashed again when the upload resumes.
+upload_hashes = {}
+upload_hashes_lock = threading.Lock()
+
+
+def create_upload(user_id, name, size):
+    """Start a chunked upload, returning its Upload added to the session."""
+    os.makedirs(staging_folder(), exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=staging_folder(), prefix="upload_")
+    os.close(fd)
+
+    upload = Upload(user_id=user_id, name=name, size=size, received=0, path=path)
+    db.session.add(upload)
+    return upload
+
+
+def resume_hash(upload):
+    """Return the sha256 of the bytes received so far by an upload, hashing the staged bytes if needed."""
+    with upload_hashes_lock:
+        hashed, digest = upload_hashes.pop(upload.id, (None, None))
+
+    if hashed == upload.received:
+        return digest
+
+    digest = hashlib.sha256()
+    remaining = upload.received
+    with open(upload.path, "rb") as f:
+        while remaining:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise ValueError("Staged upload is shorter than the bytes received")
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+def write_chunk(upload, stream):
+    """
+    Append a chunk to an upload's staging file, hashing it as it is written.
+
+    Upload.received only counts bytes that were written and hashed, so when the stream breaks off the
+    upload can be resumed from that offset. Bytes past it, from a chunk interrupted earlier, are discarded.
+
+    Args:
+        upload (Upload): The upload, whose received count is advanced.
+        stream (file-like): The chunk content.
+
+    Raises:
+        ValueError: If the chunk goes past the announced size of the upload.
+    """
+    digest = resume_hash(upload)
+
+    try:
+        with open(upload.path, "r+b") as f:
+            f.truncate(upload.received)
+            f.seek(upload.received)
+            for block in iter(lambda: stream.read(BLOCK_SIZE), b""):
+                if upload.received + len(block) > upload.size:
+                    raise ValueError("Chunk goes past the size of the upload")
+                f.write(block)
+                digest.update(block)
+                upload.received += len(block)
+    finally:
+        with upload_hashes_lock:
+            upload_hashes[upload.id] = (upload.received, digest)
+
+
+def finish_upload(upload):
+    """
+    Hand over the staging file of a fully received upload and forget the upload.
+
+    Returns:
+        tuple: (staging path, sha256 hex digest, size in bytes), as returned by stage_stream.
+    """
+    digest = resume_hash(upload).hexdigest()
+    db.session.delete(upload)
+    return upload.path, digest, upload.received
+
+
+def discard_upload(upload):
+    """Delete an upload and its staging file."""
+    with upload_hashes_lock:
+        upload_hashes.pop(upload.id, None)
+    db.session.delete(upload)
+    # Removed once the deletion is committed, like the content of deleted blobs
+    db.session.info.setdefault("orphaned_paths", []).append(upload.path)
+
+
+def reusable_pages(blob):
+    """Return the extracted pages of another file with the same content, or None if there is none yet."""
+    source = File.query.filter(File.blob_hash == blob.hash, File.pages.any()).first()
+    return [page.text for page in source.pages] if source else None
+
+
+@event.listens_for(Session, "before_flush")
+def count_blob_references(session, flush_context, instances):
+    """Keep Blob.ref_count equal to the number of files using each blob."""
+    deltas = Counter()
+    blobs = {}
+
+    def count(blob, delta):
+        blobs[blob.hash] = blob
+        deltas[blob.hash] += delta
+
+    for item in session.new:
+        if isinstance(item, File) and item.blob is not None:
+            count(item.blob, 1)
+
+    for item in session.dirty:
+        if isinstance(item, File):
+            history = inspect(item).attrs.blob.history
+            for blob in history.added:
+                if blob is not None:
+                    count(blob, 1)
+            for blob in history.deleted:
+                if blob is not None:
+                    count(blob, -1)
+
+    orphaned_paths = session.info.setdefault("orphaned_paths", [])
+    for item in session.deleted:
+        if isinstance(item, File):
+            if item.blob is not None:
+                count(item.blob, -1)
+            else:
+                # Files uploaded before the blob store own their copy
+                orphaned_paths.append(item.path)
+
+    for digest, delta in deltas.items():
+        blob = blobs[digest]
+        if not delta:
+            continue
+        if blob in session.new:
+            blob.ref_count += delta
+        else:
+            # Incremented in SQL so concurrent uploads of the same content do not lose counts
+            blob.ref_count = Blob.ref_count + delta
+
+    session.info.setdefault("released_blobs", set()).update(
+        digest for digest, delta in deltas.items() if delta < 0
+    )
+
+
+@event.listens_for(Session, "after_flush")
+def delete_orphaned_blobs(session, flush_context):
+    """Delete the rows of blobs no file uses anymore, their content is removed once committed."""
+    released = session.info.pop("released_blobs", set())
+    if released:
+        session.info.setdefault("orphaned_paths", []).extend(release_blobs(session, released))
+
+
+def release_blobs(session, digests):
+    """Delete the rows of the given blobs that no file uses anymore, returning the paths of their content."""
+    return session.execute(
+        delete(Blob)
+        .where(Blob.hash.in_(digests), Blob.ref_count <= 0)
+        .returning(Blob.path)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+
+
+@event.listens_for(Session, "after_commit")
+def remove_orphaned_content(session):
+    """Remove the content of deleted blobs and of deleted files that had no blob."""
+    # The content of the blobs stored in the transaction is kept
+    session.info.pop("stored_paths", None)
+    for path in session.info.pop("orphaned_paths", []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@event.listens_for(Session, "after_rollback")
+def keep_orphaned_content(session):
+    """Keep the content of blobs and files whose deletion was rolled back."""
+    session.info.pop("released_blobs", None)
+    session.info.pop("orphaned_paths", None)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def remove_uncommitted_content(session, transaction):
+    """Remove the content moved into the blob store for blobs whose rows were rolled back or never committed."""
+    if transaction.parent is None:
+        for path in session.info.pop("stored_paths", []):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,99 @@
+import itertools
+import os
+import tempfile
+import pytest
+from sqlalchemy import event
+
+# The app creates its database when imported and keeps sessions and uploads in the working directory,
+# they are all kept in a temporary folder instead
+workdir = tempfile.mkdtemp(prefix="learnmate-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'learnmate.db')}"
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+cwd = os.getcwd()
+os.chdir(workdir)
+from app import app as flask_app  # noqa: E402
+from models import db, User  # noqa: E402
+os.chdir(cwd)
+
+flask_app.config["TESTING"] = True
+flask_app.config["UPLOADED_FILES_DEST"] = os.path.join(workdir, "uploads")
+
+user_numbers = itertools.count(1)
+
+
+@pytest.fixture
+def app():
+    """The app. Tests open an app context around their own database work, requests open their own."""
+    return flask_app
+
+
+def create_user(app):
+    """Add a user whose items do not clash with the ones of other tests, returning its id."""
+    number = next(user_numbers)
+    with app.app_context():
+        user = User(username=f"user{number}", email=f"user{number}@example.com", password="password")
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def login(app, user_id):
+    """Return a test client logged in as a user."""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    return client
+
+
+@pytest.fixture
+def make_user(app):
+    """Return a function adding a user, see create_user."""
+    return lambda: create_user(app)
+
+
+@pytest.fixture
+def make_client(app):
+    """Return a function logging a test client in as a user, see login."""
+    return lambda user_id: login(app, user_id)
+
+
+@pytest.fixture
+def user_id(make_user):
+    return make_user()
+
+
+@pytest.fixture
+def client(make_client, user_id):
+    """A test client logged in as the user of user_id."""
+    return make_client(user_id)
+
+
+class QueryCounter:
+    """Counts the statements sent to the database while it is active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self.record)
+
+    def record(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@pytest.fixture
+def count_queries(app):
+    """Return a context manager counting the statements run inside it."""
+    with app.app_context():
+        engine = db.engine
+    return lambda: QueryCounter(engine)
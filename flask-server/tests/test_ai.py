@@ -0,0 +1,300 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from openai import OpenAI, RateLimitError
+import ai
+from models import db, CompletionCache, File, FlashcardDeck
+
+
+class StubAPI(ThreadingHTTPServer):
+    """
+    Local OpenAI-compatible server answering chat completions with the replies queued by a test.
+
+    A reply is (status, headers, body), where body is a JSON object or, for streamed completions, a list
+    of text pieces sent as server-sent events. Requests beyond the queued replies get a 500.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.replies = []
+        self.requests = []
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(request)
+        status, headers, body = self.server.replies.pop(0) if self.server.replies else (500, {}, {"error": {}})
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        if isinstance(body, list):
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for text in body:
+                self.wfile.write(f"data: {json.dumps(completion_chunk(text))}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        else:
+            content = json.dumps(body).encode()
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+
+def completion_chunk(text):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": ai.MODEL,
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+    }
+
+
+def completion(text):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": 0,
+        "model": ai.MODEL,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+    }
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    """A stub API the AI client talks to instead of OpenAI."""
+    server = StubAPI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(ai, "client", OpenAI(base_url=server.base_url, api_key="test", max_retries=0, timeout=5))
+    monkeypatch.setattr(ai, "breaker", ai.CircuitBreaker(ai.FAILURE_THRESHOLD, ai.BREAKER_COOLDOWN))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def events(response):
+    """Parse the server-sent events of a response into (event, data) pairs."""
+    parsed = []
+    for message in response.get_data(as_text=True).split("\n\n"):
+        if message:
+            event, data = message.split("\n")
+            parsed.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return parsed
+
+
+def test_completion_is_streamed_as_server_sent_events(client, stub_api):
+    stub_api.replies.append((200, {}, ["Mitochondria", " make", " energy."]))
+    completed = ai.stream_stats()["completed"]
+
+    response = client.post("/askAI/Notes/improve?stream=1", json={"notes": "mitochondria energy"})
+
+    assert response.mimetype == "text/event-stream"
+    assert events(response) == [
+        ("token", {"text": "Mitochondria"}),
+        ("token", {"text": " make"}),
+        ("token", {"text": " energy."}),
+        ("done", {}),
+    ]
+    assert stub_api.requests[0]["stream"] is True
+    stats = ai.stream_stats()
+    assert stats["completed"] == completed + 1
+    assert stats["first_token_p50"] is not None
+    assert ai.gateway_stats()["in_flight"] == 0
+
+
+def test_stream_left_by_the_client_is_closed(client, stub_api):
+    stub_api.replies.append((200, {}, ["Ribosomes", " make", " proteins."]))
+    disconnected = ai.stream_stats()["disconnected"]
+
+    response = client.post("/askAI/Notes/improve?stream=1", json={"notes": "ribosomes"}, buffered=False)
+    first_event = next(iter(response.response))
+    response.close()
+
+    assert b"Ribosomes" in first_event
+    assert ai.stream_stats()["disconnected"] == disconnected + 1
+    assert ai.gateway_stats()["in_flight"] == 0
+
+
+def test_stream_failing_before_it_starts_is_an_error_response(client, stub_api):
+    stub_api.replies.append((400, {}, {"error": {"message": "bad request", "type": "invalid_request_error"}}))
+
+    response = client.post("/askAI/Notes/improve?stream=1", json={"notes": "golgi"})
+
+    assert response.status_code == 500
+    assert ai.gateway_stats()["in_flight"] == 0
+
+
+RATE_LIMITED = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+
+
+def test_rate_limited_request_is_retried_after_the_requested_delay(stub_api, monkeypatch):
+    monkeypatch.setattr(ai, "BACKOFF_BASE", 0.01)
+    stub_api.replies += [(429, {"Retry-After": "0.3"}, RATE_LIMITED), (200, {}, completion("Cells divide."))]
+    retries = ai.gateway_stats()["retries"]
+
+    start = time.monotonic()
+    assert ai.complete("How do cells multiply?") == "Cells divide."
+
+    assert time.monotonic() - start >= 0.3
+    assert len(stub_api.requests) == 2
+    assert ai.gateway_stats()["retries"] == retries + 1
+
+
+def test_breaker_opens_after_repeated_rate_limits(client, stub_api, monkeypatch):
+    monkeypatch.setattr(ai, "BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(ai, "breaker", ai.CircuitBreaker(2, 60))
+    stub_api.replies += [(429, {"Retry-After": "0"}, RATE_LIMITED)] * (2 * ai.MAX_ATTEMPTS)
+
+    for call in range(2):
+        with pytest.raises(RateLimitError):
+            ai.complete(f"Question {call}")
+    assert len(stub_api.requests) == 2 * ai.MAX_ATTEMPTS
+    assert ai.gateway_stats()["breaker"] == "open"
+
+    # Refused without calling the API
+    response = client.post("/askAI/Notes/improve", json={"notes": "nucleus"})
+
+    assert response.status_code == 503
+    assert 0 < int(response.headers["Retry-After"]) <= 60
+    assert len(stub_api.requests) == 2 * ai.MAX_ATTEMPTS
+    assert ai.gateway_stats()["in_flight"] == 0
+
+
+def test_regenerated_flashcards_skip_the_completion_cache(app, client, user_id, stub_api):
+    with app.app_context():
+        file = File(name=f"cells of user {user_id}.txt", path="cells.txt", type="text/plain", user_id=user_id)
+        file.set_content([f"Cells of user {user_id} divide by mitosis."])
+        deck = FlashcardDeck(name=f"deck of user {user_id}", user_id=user_id, file=file)
+        db.session.add_all([file, deck])
+        db.session.commit()
+        file_id, deck_id = file.id, deck.id
+    stub_api.replies += [
+        (200, {}, completion("F: Mitosis\nB: Cell division")),
+        (200, {}, completion("F: Cell division\nB: Mitosis")),
+    ]
+
+    def generate(**options):
+        response = client.post(f"/generateFlashcards/{deck_id}", json={"fileId": file_id, **options})
+        return [flashcard["term"] for flashcard in response.json["flashcards"]]
+
+    assert generate() == ["Mitosis"]
+    assert generate() == ["Mitosis"]
+    assert generate(regenerate=True) == ["Cell division"]
+    assert len(stub_api.requests) == 2
+
+
+def test_slot_is_left_to_other_requests_during_the_backoff(stub_api, monkeypatch):
+    monkeypatch.setattr(ai, "BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(ai, "QUEUE_TIMEOUT", 0.2)
+    monkeypatch.setattr(ai, "MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(ai, "in_flight", threading.BoundedSemaphore(1))
+    stub_api.replies += [
+        (429, {"Retry-After": "0.5"}, RATE_LIMITED),
+        (200, {}, completion("Meanwhile.")),
+        (200, {}, completion("After the backoff.")),
+    ]
+    answers = []
+
+    retried = threading.Thread(target=lambda: answers.append(ai.complete("Retried question")))
+    retried.start()
+    time.sleep(0.1)
+    answers.append(ai.complete("Question asked during the backoff"))
+    retried.join()
+
+    assert answers == ["Meanwhile.", "After the backoff."]
+    assert ai.gateway_stats()["in_flight"] == 0
+
+
+def test_cached_completion_is_served_until_it_expires(app, user_id, stub_api, monkeypatch):
+    monkeypatch.setattr(ai, "memory_cache", OrderedDict())
+    prompt = f"What do the ribosomes of user {user_id} make?"
+    stub_api.replies += [(200, {}, completion("Proteins.")), (200, {}, completion("Proteins, still."))]
+    counters = dict(ai.cache_stats())
+
+    with app.app_context():
+        assert ai.complete(prompt, cache=True) == "Proteins."
+        assert ai.complete(prompt, cache=True) == "Proteins."
+        # From the database once the memory tier forgot it
+        ai.memory_cache.clear()
+        assert ai.complete(prompt, cache=True) == "Proteins."
+        assert len(stub_api.requests) == 1
+
+        key = ai.completion_key(ai.MODEL, prompt, ai.MAX_TOKENS)
+        db.session.get(CompletionCache, key).created_at = ai.utcnow() - ai.COMPLETION_TTL
+        db.session.commit()
+        ai.memory_cache.clear()
+        assert ai.complete(prompt, cache=True) == "Proteins, still."
+
+    stats = ai.cache_stats()
+    assert len(stub_api.requests) == 2
+    assert stats["misses"] == counters["misses"] + 2
+    assert stats["memory_hits"] == counters["memory_hits"] + 1
+    assert stats["database_hits"] == counters["database_hits"] + 1
+
+
+def test_uncached_prompts_always_reach_the_api(app, user_id, stub_api):
+    prompt = f"Improve the notes of user {user_id}."
+    stub_api.replies += [(200, {}, completion("Better.")), (200, {}, completion("Even better."))]
+
+    with app.app_context():
+        assert ai.complete(prompt) == "Better."
+        assert ai.complete(prompt) == "Even better."
+        assert db.session.get(CompletionCache, ai.completion_key(ai.MODEL, prompt, ai.MAX_TOKENS)) is None
+
+
+def test_chunks_are_filled_up_to_the_budget_in_document_order():
+    pieces = [("a" * 40, 4), ("b" * 60, 6), ("c" * 10, 1), ("d" * 250, 25)]
+
+    chunks = ai.plan_chunks(pieces, budget=10)
+
+    # Exactly the budget fits, one token more starts the next chunk, longer texts are split
+    assert chunks == ["a" * 40 + "b" * 60, "c" * 10 + "d" * 84, "d" * 84, "d" * 82]
+    assert "".join(chunks) == "".join(text for text, _ in pieces)
+
+
+def file_with_pages(app, user_id, token_counts):
+    """Add a file with a page of the given token count each, returning it detached with its id."""
+    with app.app_context():
+        file = File(name=f"long file of user {user_id}.txt", path="long.txt", type="text/plain", user_id=user_id)
+        file.set_content([f"Page {number} of user {user_id}. " for number in range(len(token_counts))])
+        for page, tokens in zip(file.pages, token_counts):
+            page.token_count = tokens
+        db.session.add(file)
+        db.session.commit()
+        return file.id
+
+
+@pytest.mark.parametrize("extra_tokens, requests", [(0, 0), (1, 2)])
+def test_material_is_summarized_once_it_is_over_the_budget(app, user_id, stub_api, extra_tokens, requests):
+    half = ai.CHUNK_TOKENS // 2
+    file_id = file_with_pages(app, user_id, [half, ai.CHUNK_TOKENS - half + extra_tokens])
+    stub_api.replies += [(200, {}, completion("Summary."))] * requests
+
+    with app.app_context():
+        material = ai.prompt_material(db.session.get(File, file_id))
+
+    assert len(stub_api.requests) == requests
+    if requests:
+        assert material == "Summary.\n" * requests
+        prompts = sorted(request["messages"][0]["content"] for request in stub_api.requests)
+        assert [prompt.removeprefix(ai.CHUNK_SUMMARY_PROMPT)[:6] for prompt in prompts] == ["Page 0", "Page 1"]
+    else:
+        assert material == f"Page 0 of user {user_id}. Page 1 of user {user_id}. "
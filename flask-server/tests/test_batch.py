@@ -0,0 +1,50 @@
+from models import db, File, Note
+
+
+def test_properties_are_attached_and_detached_in_a_batch(app, client, user_id):
+    with app.app_context():
+        file = File(name=f"batch file of user {user_id}.txt", path="file.txt", type="text/plain", user_id=user_id)
+        db.session.add(file)
+        db.session.commit()
+        file_id = file.id
+
+    response = client.post("/batch", json={"operations": [
+        {"op": "create", "type": "subject", "ref": "subject", "data": {"name": f"subject of user {user_id}"}},
+        {"op": "addProperty", "type": "subject", "id": "$subject", "data": {"fileId": file_id}},
+        {"op": "create", "type": "tag", "ref": "tag", "data": {"name": f"tag of user {user_id}"}},
+        {"op": "addProperty", "type": "tag", "id": "$tag", "data": {"fileId": file_id}},
+        {"op": "addProperty", "type": "tag", "id": "$tag", "data": {"fileId": file_id}},
+        {"op": "create", "type": "note", "ref": "note", "data": {"name": f"note of user {user_id}"}},
+        {"op": "addProperty", "type": "note", "id": "$note", "data": {"fileId": file_id}},
+    ]})
+
+    assert response.status_code == 200
+    subject_id, tag_id, note_id = (response.json["results"][index]["id"] for index in (0, 2, 5))
+    with app.app_context():
+        file = db.session.get(File, file_id)
+        assert file.subject_id == subject_id
+        assert [tag.id for tag in file.tags] == [tag_id]
+        assert db.session.get(Note, note_id).file_id == file_id
+
+    response = client.post("/batch", json={"operations": [
+        {"op": "removeProperty", "type": "subject", "id": subject_id, "data": {"fileId": file_id}},
+        {"op": "removeProperty", "type": "tag", "id": tag_id, "data": {"fileId": file_id}},
+        {"op": "removeProperty", "type": "note", "id": note_id, "data": {"fileId": file_id}},
+    ]})
+
+    assert response.status_code == 200
+    with app.app_context():
+        file = db.session.get(File, file_id)
+        assert file.subject_id is None
+        assert file.tags == []
+        assert db.session.get(Note, note_id).file_id is None
+
+
+def test_property_is_not_attached_to_a_missing_file(app, client, user_id):
+    response = client.post("/batch", json={"operations": [
+        {"op": "create", "type": "project", "ref": "project", "data": {"name": f"lone project of user {user_id}"}},
+        {"op": "addProperty", "type": "project", "id": "$project", "data": {"fileId": 0}},
+    ]})
+
+    assert response.status_code == 404
+    assert response.json["index"] == 1
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import helpers
+from models import db, File, Subject, Project, Tag, Note, NotePatch, FlashcardDeck, Flashcard, Todo
+
+
+def seed_library(app, user_id, file_count):
+    """Give a user file_count files, each with a subject, project, tag, patched note, deck and todo."""
+    with app.app_context():
+        for index in range(file_count):
+            name = f"u{user_id}-{index}"
+            file = File(
+                name=f"{name}.txt",
+                path=f"{name}.txt",
+                type="text/plain",
+                user_id=user_id,
+                subject=Subject(name=f"subject {name}", user_id=user_id),
+                project=Project(name=f"project {name}", user_id=user_id),
+                tags=[Tag(name=f"tag {name}", user_id=user_id)],
+            )
+            file.set_content([f"Text of {name}"])
+            note = Note(name=f"note {name}", content={"blocks": []}, version=1, user_id=user_id, file=file)
+            note.patches.append(NotePatch(version=1, operations=[{"op": "add", "path": "/time", "value": 1}]))
+            deck = FlashcardDeck(name=f"deck {name}", user_id=user_id, file=file)
+            deck.flashcards = [
+                Flashcard(term=f"term {rank}", definition="definition", rank=rank, user_id=user_id)
+                for rank in (1.0, 2.0)
+            ]
+            todo = Todo(content=f"todo {name}", rank=1.0, user_id=user_id, file=file)
+            db.session.add_all([file, note, deck, todo])
+        db.session.commit()
+
+
+def test_data_query_count_does_not_grow_with_library(app, make_user, make_client, count_queries):
+    counts = []
+    for file_count in (3, 30):
+        user_id = make_user()
+        seed_library(app, user_id, file_count)
+        client = make_client(user_id)
+
+        with count_queries() as counter:
+            response = client.get("/data")
+
+        assert response.status_code == 200
+        assert len(response.json["files"]) == file_count
+        assert response.json["notes"][0]["content"] == {"blocks": [], "time": 1}
+        counts.append(counter.count)
+
+    assert counts[0] == counts[1]
+
+
+def test_positions_of_a_page_of_flashcards_count_the_whole_deck(app, user_id, client):
+    with app.app_context():
+        deck = FlashcardDeck(name=f"positions of user {user_id}", user_id=user_id)
+        # Inserted out of order, the ranks decide the positions
+        flashcards = [
+            Flashcard(term=f"term {rank}", definition="definition", rank=rank, user_id=user_id)
+            for rank in (3.0, 1.0, 4.0, 2.0)
+        ]
+        deck.flashcards = flashcards
+        db.session.add(deck)
+        db.session.commit()
+        first_id = flashcards[0].id
+
+    response = client.get(f"/data/flashcards?fields=id,term,order&cursor={first_id}&limit=2")
+
+    assert [(item["term"], item["order"]) for item in response.json["items"]] == [("term 1.0", 1), ("term 4.0", 4)]
+
+
+def test_deck_update_query_count_does_not_grow_with_deck(app, make_user, make_client, count_queries):
+    counts = []
+    for flashcard_count in (5, 50):
+        user_id = make_user()
+        with app.app_context():
+            deck = FlashcardDeck(name=f"deck of user {user_id}", user_id=user_id)
+            deck.flashcards = [
+                Flashcard(term=f"term {rank}", definition="definition", rank=float(-rank), user_id=user_id)
+                for rank in range(flashcard_count)
+            ]
+            db.session.add(deck)
+            db.session.commit()
+            deck_id = deck.id
+        client = make_client(user_id)
+
+        with count_queries() as counter:
+            response = client.post(f"/updateFlashcardDeck/{deck_id}", json={"name": f"renamed deck of user {user_id}"})
+
+        flashcards = response.json["deck"]["flashcards"]
+        assert [flashcard["order"] for flashcard in flashcards] == list(range(1, flashcard_count + 1))
+        assert flashcards[0]["term"] == f"term {flashcard_count - 1}"
+        # Nor does any query count the siblings of each flashcard
+        assert not any("count(" in statement.lower() for statement in counter.statements)
+        counts.append(counter.count)
+
+    assert counts[0] == counts[1]
+
+
+def test_only_the_canonical_payload_is_cached_once_per_user(app, user_id, client, monkeypatch):
+    monkeypatch.setattr(helpers, "payload_cache", OrderedDict())
+    monkeypatch.setattr(helpers, "payload_cache_bytes", 0)
+    seed_library(app, user_id, 1)
+
+    client.get("/data/files?limit=1")
+    client.get("/data/changes")
+    assert user_id not in helpers.payload_cache
+
+    first = client.get("/data")
+    second = client.get("/data")
+
+    assert list(helpers.payload_cache) == [user_id]
+    assert second.get_data() == first.get_data()
+    assert helpers.payload_cache_bytes == len(first.get_data())
+
+
+def test_payload_cache_evicts_least_recently_used_users_over_its_size(app, make_user, make_client, monkeypatch):
+    monkeypatch.setattr(helpers, "payload_cache", OrderedDict())
+    monkeypatch.setattr(helpers, "payload_cache_bytes", 0)
+    user_ids = [make_user() for _ in range(3)]
+    first = make_client(user_ids[0]).get("/data")
+    make_client(user_ids[1]).get("/data")
+    # Served from the cache, which makes the first user the most recently used
+    make_client(user_ids[0]).get("/data")
+
+    # Room for the two payloads, give or take a longer username
+    monkeypatch.setattr(helpers, "PAYLOAD_CACHE_BYTES", helpers.payload_cache_bytes + 10)
+    third = make_client(user_ids[2]).get("/data")
+
+    assert list(helpers.payload_cache) == [user_ids[0], user_ids[2]]
+    assert helpers.payload_cache_bytes == len(first.get_data()) + len(third.get_data())
+
+
+def test_collection_pages_follow_their_cursors_to_the_end(app, user_id, client):
+    seed_library(app, user_id, 5)
+
+    names, cursor, pages = [], None, 0
+    while True:
+        response = client.get("/data/files", query_string={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        names += [file["name"] for file in response.json["items"]]
+        pages += 1
+        cursor = response.json["next_cursor"]
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert names == [f"u{user_id}-{index}.txt" for index in range(5)]
+
+
+def test_fields_select_the_output_of_a_collection(app, user_id, client):
+    seed_library(app, user_id, 1)
+
+    response = client.get("/data/notes?fields=id,name")
+
+    assert response.status_code == 200
+    assert [set(note) for note in response.json["items"]] == [{"id", "name"}]
+    assert client.get("/data/notes?fields=id,secret").status_code == 400
+    assert client.get("/data/notes?limit=0").status_code == 400
+    assert client.get("/data/unknown").status_code == 404
+
+
+def test_streamed_payload_is_the_same_bytes_as_the_built_one(app, user_id, client):
+    seed_library(app, user_id, 3)
+
+    built = client.get("/data")
+    streamed = client.get("/data?stream=1")
+
+    assert streamed.is_streamed
+    assert streamed.mimetype == built.mimetype
+    assert streamed.get_data() == built.get_data()
@@ -0,0 +1,86 @@
+import io
+import os
+import time
+from sqlalchemy import text
+from models import db, Blob, File, FilePage, Note, FlashcardDeck, Flashcard, Todo, Tombstone
+from tests.test_jobs import job_status
+
+
+def upload(app, client, name, content):
+    """Upload a file through /upload and wait for its text, returning the file."""
+    response = client.post("/upload", data={"files": (io.BytesIO(content), name)}, content_type="multipart/form-data")
+    assert response.status_code == 202
+    for job in response.json["jobs"]:
+        assert job_status(app, job["id"])[0] == "done"
+    with app.app_context():
+        file = File.query.filter_by(name=name).one()
+        db.session.expunge(file)
+        return file
+
+
+def wait_until_removed(path, timeout=5):
+    deadline = time.monotonic() + timeout
+    while os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return not os.path.exists(path)
+
+
+def test_deleting_a_file_removes_what_belongs_to_it_in_the_database(app, user_id, client):
+    file = upload(app, client, f"deleted-{user_id}.txt", f"Deleted notes of user {user_id}.".encode())
+    with app.app_context():
+        assert db.session.execute(text("PRAGMA foreign_keys")).scalar() == 1
+
+        note = Note(name=f"note of user {user_id}", content={"blocks": []}, user_id=user_id, file_id=file.id)
+        deck = FlashcardDeck(name=f"deck of user {user_id}", user_id=user_id, file_id=file.id)
+        deck.flashcards.append(Flashcard(term="cell", definition="unit of life", rank=1.0, user_id=user_id))
+        todo = Todo(content="revise", rank=1.0, user_id=user_id, file_id=file.id)
+        db.session.add_all([note, deck, todo])
+        db.session.commit()
+        removed = {
+            ("file", file.id),
+            ("note", note.id),
+            ("deck", deck.id),
+            ("flashcard", deck.flashcards[0].id),
+            ("todo", todo.id),
+        }
+
+    assert client.post(f"/delete/{file.id}").status_code == 200
+
+    with app.app_context():
+        for Model, item_id in [(File, file.id), (Note, note.id), (FlashcardDeck, deck.id), (Todo, todo.id)]:
+            assert db.session.get(Model, item_id) is None
+        assert not Flashcard.query.filter_by(deck_id=deck.id).count()
+        assert not FilePage.query.filter_by(file_id=file.id).count()
+
+        tombstones = Tombstone.query.filter_by(user_id=user_id).all()
+        assert {(tombstone.item_type, tombstone.item_id) for tombstone in tombstones} == removed
+
+
+def test_stored_content_is_removed_with_the_last_file_using_it(app, user_id, client):
+    content = f"Shared notes of user {user_id}.".encode()
+    first = upload(app, client, f"first-{user_id}.txt", content)
+    second = upload(app, client, f"second-{user_id}.txt", content)
+    assert first.blob_hash == second.blob_hash
+
+    client.post(f"/delete/{first.id}")
+
+    with app.app_context():
+        assert db.session.get(Blob, first.blob_hash).ref_count == 1
+    assert os.path.exists(first.path)
+
+    client.post(f"/delete/{second.id}")
+
+    with app.app_context():
+        assert db.session.get(Blob, second.blob_hash) is None
+    assert wait_until_removed(second.path)
+
+
+def test_items_of_other_users_are_not_deleted(app, user_id, make_user, make_client):
+    other_id = make_user()
+    file = upload(app, make_client(other_id), f"kept-{other_id}.txt", f"Kept notes of user {other_id}.".encode())
+
+    assert make_client(user_id).post(f"/delete/{file.id}").status_code == 404
+
+    with app.app_context():
+        assert db.session.get(File, file.id) is not None
+        assert db.session.get(Blob, file.blob_hash).ref_count == 1
@@ -0,0 +1,96 @@
+import hashlib
+import io
+import pytest
+from models import db, File
+
+PAGES = ["Cells divide. ", "Mitochondria make energy. ", "Ribosomes make proteins."]
+
+
+@pytest.fixture
+def file_id(app, user_id):
+    """A file of the user with the text of PAGES."""
+    with app.app_context():
+        file = File(name=f"cells of user {user_id}.txt", path="cells.txt", type="text/plain", user_id=user_id)
+        file.set_content(PAGES)
+        db.session.add(file)
+        db.session.commit()
+        return file.id
+
+
+def test_page_of_the_content_is_read_with_its_offset(client, file_id):
+    response = client.get(f"/files/{file_id}/content?page=2")
+
+    assert response.status_code == 200
+    assert response.json == {
+        "content": PAGES[1],
+        "offset": len(PAGES[0]),
+        "length": len(PAGES[1]),
+        "page": 2,
+        "pages": 3,
+        "size": len("".join(PAGES)),
+    }
+    assert client.get(f"/files/{file_id}/content?page=4").status_code == 404
+
+
+@pytest.mark.parametrize("offset, length", [(0, None), (5, 3), (10, 20), (len(PAGES[0]), len(PAGES[1])), (40, None), (100, 5)])
+def test_character_range_spans_the_pages_it_overlaps(client, file_id, offset, length):
+    query = {"offset": offset, **({"length": length} if length is not None else {})}
+
+    response = client.get(f"/files/{file_id}/content", query_string=query)
+
+    text = "".join(PAGES)
+    expected = text[offset:] if length is None else text[offset:offset + length]
+    assert response.json["content"] == expected
+    assert response.json["length"] == len(expected)
+
+
+def test_content_of_other_users_and_negative_ranges_are_refused(client, make_user, make_client, file_id):
+    assert client.get(f"/files/{file_id}/content?offset=-1").status_code == 400
+    assert client.get(f"/files/{file_id}/content?length=-1").status_code == 400
+    assert make_client(make_user()).get(f"/files/{file_id}/content").status_code == 404
+
+
+def upload(client, name, content):
+    """Upload a file through /upload, returning its id."""
+    response = client.post("/upload", data={"files": (io.BytesIO(content), name)}, content_type="multipart/form-data")
+    assert response.status_code == 202
+    return response.json["jobs"][0]["fileId"]
+
+
+def test_stored_file_is_served_by_range_and_revalidated_by_its_hash(client, user_id):
+    content = f"Stored notes of user {user_id} on the cell cycle.".encode()
+    stored_id = upload(client, f"stored-{user_id}.txt", content)
+    digest = hashlib.sha256(content).hexdigest()
+
+    response = client.get(f"/files/{stored_id}")
+    assert response.status_code == 200
+    assert response.get_data() == content
+    assert response.headers["ETag"] == f'"{digest}"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "immutable" not in response.headers["Cache-Control"]
+
+    response = client.get(f"/files/{stored_id}", headers={"Range": "bytes=7-11"})
+    assert response.status_code == 206
+    assert response.get_data() == content[7:12]
+    assert response.headers["Content-Range"] == f"bytes 7-11/{len(content)}"
+
+    assert client.get(f"/files/{stored_id}", headers={"If-None-Match": f'"{digest}"'}).status_code == 304
+
+    # URLs versioned with the hash are kept by clients for good
+    response = client.get(f"/files/{stored_id}?v={digest}")
+    assert "immutable" in response.headers["Cache-Control"]
+    assert "private" in response.headers["Cache-Control"]
+
+
+def test_proxy_serves_the_body_of_stored_files(app, client, user_id, monkeypatch):
+    content = f"Proxied notes of user {user_id}.".encode()
+    stored_id = upload(client, f"proxied-{user_id}.txt", content)
+    monkeypatch.setitem(app.config, "SENDFILE_MODE", "x-accel-redirect")
+    monkeypatch.setitem(app.config, "USE_X_SENDFILE", True)
+
+    response = client.get(f"/files/{stored_id}", headers={"Range": "bytes=0-3"})
+
+    assert response.status_code == 200
+    assert response.get_data() == b""
+    assert response.headers["X-Accel-Redirect"].startswith(app.config["SENDFILE_PREFIX"])
+    assert "X-Sendfile" not in response.headers
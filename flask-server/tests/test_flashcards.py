@@ -0,0 +1,17 @@
+from flashcards import add_flashcards
+from models import db, FlashcardDeck, Flashcard
+
+
+def test_added_flashcards_get_ids_from_the_database_in_order(app, user_id):
+    with app.app_context():
+        deck = FlashcardDeck(name=f"deck of user {user_id}", user_id=user_id)
+        db.session.add(deck)
+        db.session.commit()
+
+        flashcards = add_flashcards(deck, [(f"term {index}", "definition") for index in range(5)], user_id)
+        db.session.commit()
+
+        stored = db.session.execute(
+            db.select(Flashcard.id, Flashcard.term).filter_by(deck_id=deck.id).order_by(Flashcard.rank)
+        ).all()
+        assert [(flashcard.id, flashcard.term) for flashcard in flashcards] == [tuple(row) for row in stored]
@@ -0,0 +1,83 @@
+import io
+import os
+import pytest
+from PIL import Image
+import jobs
+from images import IMAGE_VARIANTS, variant_path
+from models import db, Flashcard, FlashcardDeck
+from tests.test_jobs import job_status
+
+
+@pytest.fixture
+def flashcard_id(app, user_id):
+    with app.app_context():
+        deck = FlashcardDeck(name=f"deck of user {user_id}", user_id=user_id)
+        deck.flashcards.append(Flashcard(term="cell", definition="unit of life", rank=1.0, user_id=user_id))
+        db.session.add(deck)
+        db.session.commit()
+        return deck.flashcards[0].id
+
+
+def upload_image(client, flashcard_id, size):
+    """Upload a PNG of the given (width, height) as the image of a flashcard, returning its variants job."""
+    content = io.BytesIO()
+    Image.new("RGB", size, "teal").save(content, "PNG")
+    content.seek(0)
+    response = client.post(
+        f"/uploadFlashcardImage/{flashcard_id}",
+        data={"image": (content, "cell.png")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    return response.json["job"]["id"]
+
+
+def served_image(client, flashcard_id, size):
+    response = client.get(f"/getFlashcardImage/{flashcard_id}?size={size}")
+    assert response.status_code == 200
+    return Image.open(io.BytesIO(response.get_data()))
+
+
+@pytest.mark.parametrize("size, expected", [
+    ((2000, 1000), {"thumbnail": (256, 128), "card": (1024, 512)}),
+    ((600, 300), {"thumbnail": (256, 128), "card": (600, 300)}),
+])
+def test_variants_are_webp_images_fitting_their_size(app, client, flashcard_id, size, expected):
+    job_id = upload_image(client, flashcard_id, size)
+    assert job_status(app, job_id)[0] == "done"
+
+    for variant in IMAGE_VARIANTS:
+        image = served_image(client, flashcard_id, variant)
+        assert image.format == "WEBP"
+        assert image.size == expected[variant]
+
+    original = served_image(client, flashcard_id, "original")
+    assert (original.format, original.size) == ("PNG", size)
+
+
+def test_original_is_served_until_the_variants_exist(app, client, flashcard_id):
+    job_id = upload_image(client, flashcard_id, (300, 300))
+    assert job_status(app, job_id)[0] == "done"
+    with app.app_context():
+        image_path = db.session.get(Flashcard, flashcard_id).image_path
+    # As before the job generated it
+    os.remove(variant_path(image_path, "card"))
+
+    assert served_image(client, flashcard_id, "card").format == "PNG"
+    assert served_image(client, flashcard_id, "thumbnail").format == "WEBP"
+    assert client.get(f"/getFlashcardImage/{flashcard_id}?size=poster").status_code == 400
+
+
+def test_variants_of_a_file_that_is_not_an_image_fail(app, client, flashcard_id, monkeypatch):
+    monkeypatch.setattr(jobs, "RETRY_DELAY", 0.01)
+
+    response = client.post(
+        f"/uploadFlashcardImage/{flashcard_id}",
+        data={"image": (io.BytesIO(b"not an image"), "cell.png")},
+        content_type="multipart/form-data",
+    )
+
+    assert job_status(app, response.json["job"]["id"])[0] == "failed"
+    with app.app_context():
+        image_path = db.session.get(Flashcard, flashcard_id).image_path
+    assert not any(os.path.exists(variant_path(image_path, variant)) for variant in IMAGE_VARIANTS)
@@ -0,0 +1,75 @@
+import time
+from datetime import datetime, timedelta, timezone
+import jobs
+from app import SYNC_RETENTION
+from models import db, Job, Tombstone
+
+
+def add_job(app, user_id, **columns):
+    with app.app_context():
+        job = Job(kind="remove_files", payload={"paths": []}, user_id=user_id, **columns)
+        db.session.add(job)
+        db.session.commit()
+        return job.id
+
+
+def job_status(app, job_id, timeout=5):
+    """Return the status of a job once it is no longer pending or running, or after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    with app.app_context():
+        while True:
+            job = db.session.get(Job, job_id)
+            if job.status not in ("pending", "running") or time.monotonic() > deadline:
+                return job.status, job.owner
+            db.session.expire(job)
+            time.sleep(0.05)
+
+
+def test_jobs_of_dead_processes_are_run_again(app, user_id):
+    now = jobs.utcnow()
+    expired = add_job(app, user_id, status="running", owner="dead", lease_expires_at=now - timedelta(seconds=1))
+    forgotten = add_job(app, user_id, status="pending", modified_at=now - 2 * jobs.LEASE_DURATION)
+
+    with app.app_context():
+        jobs.resume_jobs()
+
+    assert job_status(app, expired)[0] == "done"
+    assert job_status(app, forgotten)[0] == "done"
+
+
+def test_job_leased_by_a_live_process_is_left_to_it(app, user_id):
+    job_id = add_job(app, user_id, status="running", owner="alive", lease_expires_at=jobs.utcnow() + jobs.LEASE_DURATION)
+
+    with app.app_context():
+        jobs.resume_jobs()
+
+    assert job_status(app, job_id, timeout=0.5) == ("running", "alive")
+
+
+def test_expired_tombstones_are_pruned_by_a_periodic_job(app, user_id, client):
+    now = jobs.utcnow()
+    with app.app_context():
+        # Earlier runs of the periodic job would keep it from being queued again
+        Job.query.filter_by(kind="prune_tombstones").delete()
+        expired = Tombstone(item_type="note", item_id=1, user_id=user_id, deleted_at=now - SYNC_RETENTION - timedelta(days=1))
+        recent = Tombstone(item_type="note", item_id=2, user_id=user_id, deleted_at=now)
+        db.session.add_all([expired, recent])
+        db.session.commit()
+        expired_id, recent_id = expired.id, recent.id
+
+    # Reading changes leaves them alone
+    since = int((datetime.now(timezone.utc) - timedelta(days=1)).timestamp() * 1_000_000)
+    assert client.get(f"/data/changes?since={since}").status_code == 200
+    with app.app_context():
+        assert db.session.get(Tombstone, expired_id) is not None
+
+    with app.app_context():
+        jobs.queue_periodic_jobs()
+        jobs.queue_periodic_jobs()
+        job_ids = db.session.scalars(db.select(Job.id).filter_by(kind="prune_tombstones")).all()
+
+    assert len(job_ids) == 1
+    assert job_status(app, job_ids[0])[0] == "done"
+    with app.app_context():
+        assert db.session.get(Tombstone, expired_id) is None
+        assert db.session.get(Tombstone, recent_id) is not None
@@ -0,0 +1,24 @@
+from tests.test_search import create_note
+
+
+def paragraph(text):
+    return {"type": "paragraph", "data": {"text": text}}
+
+
+def test_outdated_patch_is_refused_with_the_current_content(app, client, user_id):
+    note = create_note(app, client, user_id)
+    response = client.post(f"/updateNote/{note['id']}", json={"content": {"blocks": [paragraph("cells")]}})
+    version = response.json["note"]["version"]
+    response = client.post(f"/updateNote/{note['id']}", json={
+        "patch": [{"op": "add", "path": "/blocks/-", "value": paragraph("edited elsewhere")}],
+        "baseVersion": version,
+    })
+
+    response = client.post(f"/updateNote/{note['id']}", json={
+        "patch": [{"op": "replace", "path": "/blocks/0", "value": paragraph("edited here")}],
+        "baseVersion": version,
+    })
+
+    assert response.status_code == 409
+    assert response.json["version"] == version + 1
+    assert response.json["content"]["blocks"] == [paragraph("cells"), paragraph("edited elsewhere")]
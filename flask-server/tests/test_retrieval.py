@@ -0,0 +1,71 @@
+import os
+import time
+import pytest
+from app import store_file_text
+from models import db, File
+from retrieval import HashingEmbeddings, file_index, index_paths
+
+TEXT = ["Mitochondria are the powerhouse of the cell. " * 50, "Ribosomes make proteins. " * 50]
+
+
+def add_file(user_id, name, pages):
+    file = File(name=name, path=name, type="text/plain", user_id=user_id)
+    file.set_content(pages)
+    db.session.add(file)
+    db.session.commit()
+    return file
+
+
+def wait_for_removal(paths, timeout=5):
+    """Wait for the background job removing files from disk."""
+    deadline = time.monotonic() + timeout
+    while any(os.path.exists(path) for path in paths) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def indexed_files(app, user_id, request):
+    """Two files of a user with the same text, found in no other test, indexed with the hashing embeddings."""
+    pages = TEXT + [f"Studied in {request.node.name}."]
+    with app.app_context():
+        files = [add_file(user_id, f"retrieval {copy} of user {user_id}.txt", pages) for copy in (1, 2)]
+        file_index(files[0], HashingEmbeddings())
+        paths = index_paths(HashingEmbeddings, files[0].content_hash)
+        return [file.id for file in files], paths
+
+
+def test_index_is_named_by_the_stored_text_hash(app, indexed_files):
+    (file_id, other_id), paths = indexed_files
+
+    with app.app_context():
+        file, other = db.session.get(File, file_id), db.session.get(File, other_id)
+        assert file.content_hash == other.content_hash
+        assert all(os.path.exists(path) for path in paths)
+
+        # Shared by the file with the same text, without building it again
+        chunks, vectors = file_index(other, HashingEmbeddings())
+        assert len(chunks) == len(vectors) > 0
+
+
+def test_index_is_removed_with_the_last_file_having_its_text(app, client, indexed_files):
+    (file_id, other_id), paths = indexed_files
+
+    assert client.post(f"/delete/{file_id}").status_code == 200
+    wait_for_removal(paths, timeout=0.5)
+    assert all(os.path.exists(path) for path in paths)
+
+    assert client.post(f"/delete/{other_id}").status_code == 200
+    wait_for_removal(paths)
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_index_of_the_previous_text_is_removed_when_a_file_is_extracted_again(app, user_id):
+    with app.app_context():
+        file = add_file(user_id, f"reextracted of user {user_id}.txt", ["Photosynthesis happens in chloroplasts."])
+        file_index(file, HashingEmbeddings())
+        paths = index_paths(HashingEmbeddings, file.content_hash)
+
+        store_file_text(file, ["Photosynthesis   happens in chloroplasts, laid out."])
+        db.session.commit()
+
+        assert not any(os.path.exists(path) for path in paths)
@@ -0,0 +1,49 @@
+from models import db, File
+
+
+def create_note(app, client, user_id):
+    with app.app_context():
+        file = File(name=f"search file of user {user_id}.txt", path="file.txt", type="text/plain", user_id=user_id)
+        db.session.add(file)
+        db.session.commit()
+        file_id = file.id
+
+    response = client.post(f"/createNote/{file_id}/search note of user {user_id}")
+    return response.json["note"]
+
+
+def search(client, query):
+    return [(item["type"], item["id"]) for item in client.get(f"/api/search?query={query}").json["items"]]
+
+
+def test_patched_note_is_searchable_before_compaction(app, client, user_id):
+    note = create_note(app, client, user_id)
+    client.post(f"/updateNote/{note['id']}", json={"content": {"blocks": [{"type": "paragraph", "data": {"text": "cells"}}]}})
+
+    response = client.post(f"/updateNote/{note['id']}", json={
+        "patch": [{"op": "add", "path": "/blocks/-", "value": {"type": "paragraph", "data": {"text": "mitochondria"}}}],
+        "baseVersion": 1,
+    })
+
+    assert response.status_code == 200
+    assert search(client, "mitochondria") == [("note", note["id"])]
+    assert search(client, "cells") == [("note", note["id"])]
+
+
+def test_patch_removing_text_unindexes_it(app, client, user_id):
+    note = create_note(app, client, user_id)
+    client.post(f"/updateNote/{note['id']}", json={"content": {"blocks": [{"type": "paragraph", "data": {"text": "ribosome"}}]}})
+
+    client.post(f"/updateNote/{note['id']}", json={"patch": [{"op": "remove", "path": "/blocks/0"}], "baseVersion": 1})
+
+    assert search(client, "ribosome") == []
+
+
+def test_rebuilt_index_finds_existing_items(app, client, user_id):
+    note = create_note(app, client, user_id)
+    client.post(f"/updateNote/{note['id']}", json={"content": {"blocks": [{"type": "paragraph", "data": {"text": "lysosome"}}]}})
+
+    result = app.test_cli_runner().invoke(args=["rebuild-search-index"])
+
+    assert result.exit_code == 0
+    assert search(client, "lysosome") == [("note", note["id"])]
@@ -0,0 +1,57 @@
+import hashlib
+import io
+import os
+import storage
+from models import db, Blob, File
+from storage import blob_path, stage_stream, store_blob
+
+
+def stage(content):
+    return stage_stream(io.BytesIO(content))
+
+
+def test_content_stored_by_a_concurrent_upload_is_shared(app, user_id, monkeypatch):
+    content = f"raced content of user {user_id}".encode()
+    digest = hashlib.sha256(content).hexdigest()
+
+    def store_concurrently(digest):
+        # The other upload stores the same content between the lookup of the blob and its insert
+        path = blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        with db.engine.begin() as connection:
+            connection.execute(db.insert(Blob).values(hash=digest, path=path, size=len(content), ref_count=1))
+        return path
+
+    with app.app_context():
+        staging_path, digest, size = stage(content)
+        monkeypatch.setattr(storage, "blob_path", store_concurrently)
+
+        blob, already_stored = store_blob(staging_path, digest, size)
+        db.session.add(File(name=f"raced of user {user_id}.txt", path=blob.path, type="text/plain", user_id=user_id, blob=blob))
+        db.session.commit()
+
+        assert already_stored
+        assert not os.path.exists(staging_path)
+        assert db.session.get(Blob, digest).ref_count == 2
+
+
+def test_content_of_a_blob_that_is_not_committed_is_removed(app, user_id):
+    with app.app_context():
+        staging_path, digest, size = stage(f"rolled back content of user {user_id}".encode())
+        blob, already_stored = store_blob(staging_path, digest, size)
+        path = blob.path
+        assert not already_stored and os.path.exists(path)
+
+        db.session.rollback()
+
+        assert not os.path.exists(path)
+        assert db.session.get(Blob, digest) is None
+
+    with app.app_context():
+        staging_path, digest, size = stage(f"abandoned content of user {user_id}".encode())
+        path = store_blob(staging_path, digest, size)[0].path
+
+    # Nor kept when the session is closed without committing
+    assert not os.path.exists(path)
@@ -0,0 +1,60 @@
+import hashlib
+import os
+import storage
+from models import db, File, Upload
+
+
+def start_upload(client, name, size):
+    response = client.post("/uploads", json={"name": name, "size": size})
+    assert response.status_code == 201
+    return response.json["upload"]["id"]
+
+
+def put_chunk(client, upload_id, offset, chunk):
+    return client.put(f"/uploads/{upload_id}?offset={offset}", data=chunk)
+
+
+def test_upload_is_resumed_from_the_bytes_received(app, user_id, client):
+    content = f"Chunked notes of user {user_id} on cell division.".encode()
+    name = f"chunked-{user_id}.txt"
+    upload_id = start_upload(client, name, len(content))
+
+    assert put_chunk(client, upload_id, 0, content[:10]).json["upload"]["offset"] == 10
+    # As after a restart: the hash of the bytes received so far is read back from the staging file
+    storage.upload_hashes.clear()
+    offset = client.get(f"/uploads/{upload_id}").json["upload"]["offset"]
+    assert offset == 10
+    assert put_chunk(client, upload_id, offset, content[offset:]).status_code == 200
+
+    response = client.post(f"/uploads/{upload_id}/complete")
+
+    assert response.status_code == 202
+    with app.app_context():
+        file = File.query.filter_by(name=name, user_id=user_id).one()
+        assert file.blob_hash == hashlib.sha256(content).hexdigest()
+        with open(file.path, "rb") as f:
+            assert f.read() == content
+        assert db.session.get(Upload, upload_id) is None
+
+
+def test_chunk_sent_again_is_refused_with_the_offset_to_resume_from(app, user_id, client):
+    content = f"Repeated chunk of user {user_id}.".encode()
+    upload_id = start_upload(client, f"repeated-{user_id}.txt", len(content))
+    put_chunk(client, upload_id, 0, content[:8])
+
+    response = put_chunk(client, upload_id, 0, content[:8])
+
+    assert response.status_code == 409
+    assert response.json["upload"]["offset"] == 8
+    with app.app_context():
+        upload = db.session.get(Upload, upload_id)
+        assert upload.received == 8
+        assert os.path.getsize(upload.path) == 8
+
+
+def test_incomplete_or_oversized_uploads_are_refused(client, user_id):
+    upload_id = start_upload(client, f"oversized-{user_id}.txt", 4)
+
+    assert client.post(f"/uploads/{upload_id}/complete").status_code == 400
+    assert put_chunk(client, upload_id, 0, b"too long").status_code == 400
+    assert client.post("/uploads", json={"name": f"empty-{user_id}.txt", "size": 0}).status_code == 400
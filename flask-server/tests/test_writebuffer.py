@@ -0,0 +1,119 @@
+import pytest
+import writebuffer
+from models import db, File, FlashcardDeck, Flashcard, Todo
+
+
+@pytest.fixture
+def write_behind(app, monkeypatch):
+    """Buffer autosaves for a window longer than the test, which flushes the buffer itself."""
+    monkeypatch.setattr(writebuffer, "window", 60)
+    yield
+    writebuffer.flush_writes()
+    if writebuffer.timer is not None:
+        writebuffer.timer.cancel()
+        writebuffer.timer = None
+
+
+@pytest.fixture
+def file_id(app, user_id):
+    with app.app_context():
+        file = File(name=f"file of user {user_id}.txt", path="file.txt", type="text/plain", user_id=user_id)
+        db.session.add(file)
+        db.session.commit()
+        return file.id
+
+
+def create_todo(client, file_id):
+    response = client.post(f"/createTodo/{file_id}/1")
+    assert response.status_code == 200
+    return response.json["todo"]["id"]
+
+
+def todo_contents(client):
+    return {todo["id"]: todo["content"] for todo in client.get("/data/todos?fields=id,content").json["items"]}
+
+
+def test_updates_are_buffered_until_flushed(app, client, file_id, write_behind):
+    todo_id = create_todo(client, file_id)
+
+    response = client.post(f"/updateTodo/{todo_id}", json={"content": "buffered"})
+
+    assert response.status_code == 200
+    assert todo_contents(client)[todo_id] == "buffered"
+    with app.app_context():
+        assert db.session.scalar(db.select(Todo.content).filter_by(id=todo_id)) == ""
+
+    writebuffer.flush_writes()
+
+    with app.app_context():
+        assert db.session.scalar(db.select(Todo.content).filter_by(id=todo_id)) == "buffered"
+
+
+def test_deleted_row_does_not_pass_its_buffered_update_on(app, client, file_id, write_behind):
+    todo_id = create_todo(client, file_id)
+    client.post(f"/updateTodo/{todo_id}", json={"content": "buffered"})
+    assert client.post(f"/deleteTodo/{todo_id}").status_code == 200
+
+    # SQLite gives the next row the id of the deleted one
+    second_id = create_todo(client, file_id)
+    assert second_id == todo_id
+    assert todo_contents(client) == {second_id: ""}
+
+    writebuffer.flush_writes()
+    assert todo_contents(client) == {second_id: ""}
+
+
+@pytest.mark.parametrize("delete", ["deck", "batch"])
+def test_rows_deleted_with_their_parent_or_in_a_batch_drop_their_buffered_update(app, client, user_id, file_id, write_behind, delete):
+    with app.app_context():
+        deck = FlashcardDeck(name=f"deck of user {user_id}", user_id=user_id, file_id=file_id)
+        deck.flashcards.append(Flashcard(term="term", definition="definition", rank=1.0, user_id=user_id))
+        db.session.add(deck)
+        db.session.commit()
+        deck_id, flashcard_id = deck.id, deck.flashcards[0].id
+
+    client.post(f"/updateFlashcard/{flashcard_id}", json={"term": "buffered"})
+    if delete == "deck":
+        response = client.post(f"/deleteFlashcardDeck/{deck_id}")
+    else:
+        response = client.post("/batch", json={"operations": [{"op": "delete", "type": "flashcard", "id": flashcard_id}]})
+
+    assert response.status_code == 200
+    assert (Flashcard, flashcard_id) not in writebuffer.pending
+
+
+
+def test_empty_update_is_not_buffered(app, client, user_id, file_id, write_behind):
+    response = client.post(f"/createNote/{file_id}/note of user {user_id}")
+    note_id = response.json["note"]["id"]
+    client.post(f"/updateNote/{note_id}", json={"content": {"blocks": [{"type": "paragraph", "data": {"text": "kept"}}]}})
+
+    assert client.post(f"/updateNote/{note_id}", json={}).status_code == 400
+    assert client.post(f"/updateNote/{note_id}", json={"baseVersion": 1}).status_code == 400
+
+    writebuffer.flush_writes()
+    response = client.get("/data/notes?fields=id,content")
+    assert response.json["items"][0]["content"]["blocks"][0]["data"]["text"] == "kept"
+
+
+def test_failing_update_is_dropped_without_holding_back_the_others(app, client, file_id, write_behind, monkeypatch):
+    monkeypatch.setattr(writebuffer, "failures", {})
+    written_id, failing_id = create_todo(client, file_id), create_todo(client, file_id)
+    client.post(f"/updateTodo/{written_id}", json={"content": "buffered"})
+    client.post(f"/updateTodo/{failing_id}", json={"content": "failing"})
+    # Breaks the NOT NULL constraint of the column
+    writebuffer.pending[(Todo, failing_id)]["values"]["content"] = None
+
+    writebuffer.flush_writes()
+
+    with app.app_context():
+        assert db.session.scalar(db.select(Todo.content).filter_by(id=written_id)) == "buffered"
+    assert list(writebuffer.pending) == [(Todo, failing_id)]
+
+    for attempt in range(writebuffer.MAX_WRITE_ATTEMPTS - 1):
+        writebuffer.flush_writes()
+
+    assert not writebuffer.pending
+    assert not writebuffer.failures
+    with app.app_context():
+        assert db.session.scalar(db.select(Todo.content).filter_by(id=failing_id)) == ""
@@ -0,0 +1,181 @@
+import bisect
+import re
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import db, File, Note, FlashcardDeck, Subject, Project, Tag
+
+
+# Named items offered by autocomplete and the type reported for each
+ITEM_TYPES = {
+    File: "file",
+    Note: "note",
+    FlashcardDeck: "deck",
+    Subject: "subject",
+    Project: "project",
+    Tag: "tag",
+}
+
+# Maximum number of users whose index is kept in memory, least recently used ones are evicted first
+MAX_CACHED_USERS = 1000
+
+
+def name_keys(name):
+    """Return the lowercase suffixes of a name starting at each word, so any word can be typed first."""
+    name = name.lower()
+    return [name[match.start():] for match in re.finditer(r"[^\W_]+", name)]
+
+
+class PrefixIndex:
+    """Names of one user's items, kept in a sorted array and searched by prefix with bisect."""
+
+    def __init__(self):
+        self.keys = []  # sorted (key, item_type, item_id)
+        self.items = {}  # (item_type, item_id) -> (name, file_id)
+
+    def add(self, item_type, item_id, name, file_id=None):
+        """Add an item, replacing any previous entry for it."""
+        self.remove(item_type, item_id)
+        self.items[(item_type, item_id)] = (name, file_id)
+        for key in name_keys(name):
+            bisect.insort(self.keys, (key, item_type, item_id))
+
+    def remove(self, item_type, item_id):
+        """Remove an item if it is indexed."""
+        item = self.items.pop((item_type, item_id), None)
+        if item is None:
+            return
+
+        for key in name_keys(item[0]):
+            index = bisect.bisect_left(self.keys, (key, item_type, item_id))
+            if index < len(self.keys) and self.keys[index] == (key, item_type, item_id):
+                del self.keys[index]
+
+    def search(self, prefix, limit=10):
+        """
+        Find the items with a word starting with the prefix.
+
+        Args:
+            prefix (str): The text typed so far.
+            limit (int): Maximum number of results.
+
+        Returns:
+            list of dict: Matching items, in alphabetical order of the matched key.
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        index = bisect.bisect_left(self.keys, (prefix,))
+        while index < len(self.keys) and len(results) < limit:
+            key, item_type, item_id = self.keys[index]
+            if not key.startswith(prefix):
+                break
+
+            if (item_type, item_id) not in seen:
+                seen.add((item_type, item_id))
+                name, file_id = self.items[(item_type, item_id)]
+                results.append({"type": item_type, "id": item_id, "fileId": file_id, "label": name})
+            index += 1
+
+        return results
+
+
+# Per-user indexes, in least recently used order
+indexes = OrderedDict()
+indexes_lock = threading.Lock()
+
+
+def item_file_id(item):
+    """Return the id of the file an item belongs to, if any."""
+    if isinstance(item, File):
+        return item.id
+    return getattr(item, "file_id", None)
+
+
+def build_index(user_id):
+    """Build the prefix index of a user from the database, loading only ids and names."""
+    index = PrefixIndex()
+    for Model, item_type in ITEM_TYPES.items():
+        columns = [Model.id, Model.name]
+        if hasattr(Model, "file_id"):
+            columns.append(Model.file_id)
+
+        for row in db.session.query(*columns).filter(Model.user_id == user_id):
+            file_id = row.id if Model is File else getattr(row, "file_id", None)
+            index.add(item_type, row.id, row.name, file_id)
+
+    return index
+
+
+def autocomplete(user_id, prefix, limit=10):
+    """Return the user's items whose name has a word starting with the prefix."""
+    with indexes_lock:
+        index = indexes.get(user_id)
+        if index is not None:
+            indexes.move_to_end(user_id)
+
+    if index is None:
+        # Built outside the lock so a slow build does not block other users
+        index = build_index(user_id)
+        with indexes_lock:
+            index = indexes.setdefault(user_id, index)
+            indexes.move_to_end(user_id)
+            while len(indexes) > MAX_CACHED_USERS:
+                indexes.popitem(last=False)
+
+    with indexes_lock:
+        return index.search(prefix, limit)
+
+
+@event.listens_for(Session, "after_flush")
+def collect_name_changes(session, flush_context):
+    """Record created, renamed and deleted items so cached indexes can be updated on commit."""
+    changes = session.info.setdefault("typeahead_changes", [])
+
+    for item in session.new:
+        if type(item) in ITEM_TYPES:
+            changes.append(("add", item.user_id, ITEM_TYPES[type(item)], item.id, item.name, item_file_id(item)))
+
+    for item in session.dirty:
+        if type(item) in ITEM_TYPES:
+            state = inspect(item)
+            if state.attrs.name.history.has_changes() or ("file_id" in state.attrs and state.attrs.file_id.history.has_changes()):
+                changes.append(("add", item.user_id, ITEM_TYPES[type(item)], item.id, item.name, item_file_id(item)))
+
+    for item in session.deleted:
+        if type(item) in ITEM_TYPES:
+            changes.append(("remove", item.user_id, ITEM_TYPES[type(item)], item.id, None, None))
+
+
+def record_removals(session, Model, rows):
+    """Record items deleted without the ORM, as (id, user_id) rows, so cached indexes drop them on commit."""
+    changes = session.info.setdefault("typeahead_changes", [])
+    for item_id, user_id in rows:
+        changes.append(("remove", user_id, ITEM_TYPES[Model], item_id, None, None))
+
+
+@event.listens_for(Session, "after_commit")
+def apply_name_changes(session):
+    """Apply committed name changes to the indexes of users that are cached."""
+    changes = session.info.pop("typeahead_changes", [])
+
+    with indexes_lock:
+        for action, user_id, item_type, item_id, name, file_id in changes:
+            index = indexes.get(user_id)
+            if index is None:
+                continue
+
+            if action == "add":
+                index.add(item_type, item_id, name, file_id)
+            else:
+                index.remove(item_type, item_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_name_changes(session):
+    """Forget name changes of a transaction that was rolled back."""
+    session.info.pop("typeahead_changes", None)
@@ -0,0 +1,267 @@
+import atexit
+import logging
+import signal
+import sys
+import threading
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from models import db, Note, Flashcard, Todo
+from patches import COMPACTION_DELAY, buffered_change, check_version, log_patch, note_version, patched_content, replace_note_content
+from jobs import submit_job
+
+
+# Autosave routes can leave their updates in a write-behind buffer instead of committing each of them.
+# Updates of the same row are merged in the buffer, and every buffered row is written in one transaction
+# at most WRITE_BEHIND_WINDOW seconds after the first of them, and when the server exits. Until then, the
+# buffered values are applied to the rows loaded from the database, so the writer reads its own writes.
+#
+# The buffer lives in the server process: it is only enabled (a positive WRITE_BEHIND_WINDOW) when a
+# single process serves the app.
+
+logger = logging.getLogger(__name__)
+
+# Request fields of the updates left in the buffer, per model. Other updates are written right away.
+BUFFERED_FIELDS = {
+    Note: {"content", "patch", "baseVersion"},
+    Flashcard: {"term", "definition"},
+    Todo: {"content", "done"},
+}
+
+# (model, id) -> buffered update. Flashcards and todos hold {"user_id", "values"}, notes hold
+# {"user_id", "base_version", "version", "content", "operations"}, operations being None when the
+# content was replaced. Entries are replaced rather than changed, so they can be read without the lock.
+pending = {}
+# Number of updates buffered per user, part of the ETags of their data
+generations = {}
+# (model, id) -> failed attempts at writing the buffered update, which is dropped after MAX_WRITE_ATTEMPTS
+failures = {}
+MAX_WRITE_ATTEMPTS = 3
+
+lock = threading.RLock()
+timer = None
+window = 0
+flask_app = None
+
+
+def init_write_buffer(app):
+    """Enable the buffer for an app when it sets a positive WRITE_BEHIND_WINDOW, in seconds."""
+    global flask_app, window
+    flask_app = app
+    window = app.config.get("WRITE_BEHIND_WINDOW") or 0
+    if not window:
+        return
+
+    atexit.register(flush_writes)
+
+    # Exit through atexit on SIGTERM too, unless the server handles the signal itself
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def buffered_generation(user_id):
+    """Return the number of updates of a user that went through the buffer."""
+    return generations.get(user_id, 0)
+
+
+def write_behind(Model, data):
+    """
+    Tell whether an update of a Model row with request data is left in the buffer.
+
+    Otherwise the buffer is flushed, so the update is written after the ones buffered before it.
+    """
+    if window and data and data.keys() <= BUFFERED_FIELDS[Model]:
+        return True
+
+    flush_writes()
+    return False
+
+
+def schedule():
+    """Flush the buffer once the window has passed."""
+    global timer
+    if timer is None:
+        timer = threading.Timer(window, flush_writes)
+        timer.daemon = True
+        timer.start()
+
+
+def buffer_changes(item):
+    """Move the column changes made to a flashcard or todo from the session to the buffer."""
+    state = inspect(item)
+    values = {attr.key: attr.value for attr in state.attrs if attr.history.has_changes()}
+    if not values:
+        return
+
+    key = (type(item), item.id)
+    with lock:
+        entry = pending.get(key)
+        pending[key] = {"user_id": item.user_id, "values": {**(entry["values"] if entry else {}), **values}}
+        generations[item.user_id] = buffered_generation(item.user_id) + 1
+        schedule()
+
+    # Committed, so the session has nothing left to write
+    for name, value in values.items():
+        set_committed_value(item, name, value)
+
+
+def buffer_note(note, base_version, content=None, operations=None):
+    """
+    Leave a replace of a note's content, or JSON Patch operations, in the buffer.
+
+    Raises PatchError as replace_note_content and patch_note do.
+
+    Returns:
+        int: The new version of the note.
+    """
+    key = (Note, note.id)
+    with lock:
+        # Rows buffered or written since the note was loaded
+        entry = pending.get(key)
+        if entry is not buffered_change(note):
+            db.session.refresh(note)
+
+        if operations is not None:
+            content = patched_content(note, operations, base_version)
+        else:
+            check_version(note, base_version)
+
+        replaced = operations is None or (entry is not None and entry["operations"] is None)
+        entry = {
+            "user_id": note.user_id,
+            "base_version": entry["base_version"] if entry else note.version,
+            "version": note_version(note) + 1,
+            "content": content,
+            "operations": None if replaced else [*(entry["operations"] if entry else []), *operations],
+        }
+        pending[key] = entry
+        inspect(note).info["buffered_change"] = entry
+        generations[note.user_id] = buffered_generation(note.user_id) + 1
+        schedule()
+
+    return entry["version"]
+
+
+def discard_writes(Model, ids):
+    """Drop the buffered updates of deleted rows, so rows created later with the same ids don't get them."""
+    with lock:
+        for item_id in ids:
+            pending.pop((Model, item_id), None)
+            failures.pop((Model, item_id), None)
+
+
+def write_note(note, entry):
+    """
+    Write the buffered change of a note, as one patch of its log when it was only patched.
+
+    Returns:
+        Job or None: A compact_note job to submit once committed.
+    """
+    if entry["operations"] is not None and note.version == entry["base_version"]:
+        return log_patch(note, entry["operations"], entry["content"], entry["version"])
+
+    # Replaced, or changed without the buffer in the meantime: the buffered content wins
+    replace_note_content(note, entry["content"])
+    note.version = max(note.version, entry["version"])
+    return None
+
+
+def write_entries(keys):
+    """
+    Write the buffered updates of (model, id) keys in one transaction.
+
+    Returns:
+        list: Ids of the compact_note jobs to submit.
+    """
+    compactions = []
+    # Written by the commit alone, so the flush listeners run once for all rows
+    with db.session.no_autoflush:
+        for Model in BUFFERED_FIELDS:
+            ids = [item_id for BufferedModel, item_id in keys if BufferedModel is Model]
+            if not ids:
+                continue
+
+            # Deleted rows are not found: their updates are dropped
+            for item in Model.query.filter(Model.id.in_(ids)):
+                entry = pending[(Model, item.id)]
+                if Model is Note:
+                    compactions.append(write_note(item, entry))
+                else:
+                    for name, value in entry["values"].items():
+                        setattr(item, name, value)
+
+    db.session.commit()
+    return [job.id for job in compactions if job is not None]
+
+
+def flush_writes():
+    """
+    Write every buffered update in one transaction.
+
+    When that fails, the updates are written one by one so a failing update does not hold back the others.
+    Failing updates stay in the buffer for the next window, and are dropped after MAX_WRITE_ATTEMPTS.
+    """
+    global timer
+    with lock:
+        timer = None
+        if not pending:
+            return
+
+        with flask_app.app_context():
+            db.session.info["flushing_writes"] = True
+            try:
+                compactions = write_entries(list(pending))
+                pending.clear()
+                failures.clear()
+
+            except Exception:
+                logger.exception("Could not write %s buffered updates at once, writing them one by one", len(pending))
+                db.session.rollback()
+
+                compactions = []
+                for key in list(pending):
+                    try:
+                        compactions += write_entries([key])
+                    except Exception:
+                        db.session.rollback()
+                        failures[key] = failures.get(key, 0) + 1
+                        Model, item_id = key
+                        if failures[key] < MAX_WRITE_ATTEMPTS:
+                            logger.exception("Could not write the buffered update of %s %s", Model.__name__, item_id)
+                            continue
+
+                        logger.exception(
+                            "Dropping the buffered update of %s %s after %s attempts: %r",
+                            Model.__name__, item_id, failures[key], pending[key],
+                        )
+                    del pending[key]
+                    failures.pop(key, None)
+
+                if pending:
+                    schedule()
+
+    for job_id in compactions:
+        submit_job(job_id, COMPACTION_DELAY)
+
+
+@event.listens_for(Note, "load")
+@event.listens_for(Flashcard, "load")
+@event.listens_for(Todo, "load")
+def overlay_buffered_changes(item, context):
+    """Apply the buffered update of a row to the item loaded from it."""
+    if context.session is not None and context.session.info.get("flushing_writes"):
+        return
+
+    entry = pending.get((type(item), item.id))
+    if isinstance(item, Note):
+        inspect(item).info["buffered_change"] = entry
+    elif entry is not None:
+        for name, value in entry["values"].items():
+            set_committed_value(item, name, value)
+
+
+@event.listens_for(Note, "refresh")
+@event.listens_for(Flashcard, "refresh")
+@event.listens_for(Todo, "refresh")
+def overlay_refreshed(item, context, attrs):
+    """Apply the buffered update of a row to an item reloaded from it, e.g. once expired by a commit."""
+    overlay_buffered_changes(item, context)